@@ -572,5 +572,5 @@ class Ui_MainWindow(object):
         self.videoModelChooseLabel.setText(_translate("MainWindow", "Choose Model:"))
         self.maxThresholdLabel.setText(_translate("MainWindow", "Min Continuous Detection Time:"))
         self.videoInsectChooseLabel.setText(_translate("MainWindow", "Choose Insect:"))
-from count import MyLabel
+from widgets import MyLabel
 from qfluentwidgets import ComboBox, DoubleSpinBox, LineEdit, NavigationInterface, ProgressRing, PushButton, Slider, SwitchButton, TableWidget, ToolButton
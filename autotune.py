@@ -0,0 +1,184 @@
+import os
+import time
+import socket
+import argparse
+import itertools
+from datetime import datetime
+
+import cv2
+import numpy as np
+import onnxruntime
+
+from detect import Detector, STRIDE, model_input_size, detection_agreement
+from sessions import PROFILE_DEFAULTS, load_session, save_host_profile
+
+NMS_BACKENDS = ["numpy", "cv2"]
+
+
+def sample_frames(video_path, count):
+    """`count` frames spread evenly over a video, all of its frames if it has fewer."""
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise ValueError(f"Error: cannot open the video {video_path}")
+    total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    frames = []
+    if 0 < count < total:
+        for frame_id in np.linspace(0, total - 1, count).round().astype(int):
+            cap.set(cv2.CAP_PROP_POS_FRAMES, int(frame_id))
+            flag, image = cap.read()
+            if flag:
+                frames.append(image)
+    else:
+        while True:
+            flag, image = cap.read()
+            if not flag:
+                break
+            frames.append(image)
+    cap.release()
+    if not frames:
+        raise ValueError(f"Error: no frame could be read from {video_path}")
+    return frames
+
+
+def thread_counts():
+    """1, 2, 4, ... intra-op threads up to the cores of this machine."""
+    cpus = os.cpu_count() or 1
+    counts = [1 << i for i in range(cpus.bit_length()) if 1 << i < cpus]
+    return counts + [cpus]
+
+
+def default_sizes(model):
+    """The input size of the model and two smaller ones if its input is dynamic, None is the model's own."""
+    shape = model.get_inputs()[0].shape
+    if isinstance(shape[2], int) and isinstance(shape[3], int):
+        return [None]
+    size = max(model_input_size(model))
+    smaller = [int(round(size * scale / STRIDE) * STRIDE) for scale in (0.75, 0.5)]
+    return [None] + [value for value in smaller if value >= 2 * STRIDE]
+
+
+def default_batches(model):
+    return [1, 2, 4, 8] if not isinstance(model.get_inputs()[0].shape[0], int) else [None]
+
+
+def time_detector(detector, frames, repeat):
+    """Best seconds per frame of `repeat` passes over the frames, with the detections of the last one."""
+    # the first run allocates the buffers of the session
+    detector.predict_batch(frames[:detector.batch_size])
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        outputs = detector.predict_batch(frames)
+        best = min(best, (time.perf_counter() - t0) / len(frames))
+    return best, outputs
+
+
+def autotune(model_path, frames, sizes=None, batches=None, threads=None, nms_backends=None, repeat=2, report=print):
+    """Latency and detection agreement of every combination of input size, batch, threads and NMS backend.
+
+    Agreement is against the reference configuration: the model's own input size,
+    one frame per run, default session options and the numpy NMS.
+    """
+    reference_model = load_session(model_path, "default")
+    reference = Detector(reference_model).predict_batch(frames)
+    sizes = sizes or default_sizes(reference_model)
+    batches = batches or default_batches(reference_model)
+    threads = threads or thread_counts()
+    nms_backends = nms_backends or NMS_BACKENDS
+
+    results = []
+    report(f"{'size':>6}{'batch':>7}{'threads':>9}{'nms':>7}{'latency(ms)':>13}{'fps':>8}{'agreement':>11}")
+    for thread_count in threads:
+        model = load_session(model_path, dict(PROFILE_DEFAULTS, intra_threads=thread_count))
+        for size, batch, nms_backend in itertools.product(sizes, batches, nms_backends):
+            detector = Detector(model, size, nms_backend=nms_backend, batch_size=batch or 1)
+            seconds, outputs = time_detector(detector, frames, repeat)
+            result = {
+                "tsize": size,
+                "batch": batch,
+                "threads": thread_count,
+                "nms_backend": nms_backend,
+                "latency_ms": round(seconds * 1e3, 3),
+                "agreement": round(detection_agreement(reference, outputs), 4),
+            }
+            results.append(result)
+            report(f"{size or detector.width:>6}{detector.batch_size:>7}{thread_count:>9}{nms_backend:>7}"
+                   f"{result['latency_ms']:>13.2f}{1e3 / result['latency_ms']:>8.1f}{result['agreement']:>11.3f}")
+    return results
+
+
+def choose(results, target_ms=None, floor=0.95):
+    """Best result of those agreeing at least `floor` with the reference, None if there is none.
+
+    Of those within the latency target the most accurate one wins and then the fastest,
+    without a target or when none meets it the fastest one wins.
+    """
+    passing = [result for result in results if result["agreement"] >= floor]
+    fast_enough = [result for result in passing if target_ms and result["latency_ms"] <= target_ms]
+    if fast_enough:
+        return max(fast_enough, key=lambda result: (round(result["agreement"], 3), -result["latency_ms"]))
+    return min(passing, key=lambda result: result["latency_ms"], default=None)
+
+
+def host_profile(best, model_path, video_path, target_ms, floor):
+    """The per-host profile of the chosen result, loaded by the engine and by sessions.load_session."""
+    settings = {"nms_backend": best["nms_backend"]}
+    if best["tsize"] is not None:
+        settings["tsize"] = best["tsize"]
+    if best["batch"] is not None:
+        settings["batch"] = best["batch"]
+    return {
+        "host": socket.gethostname(),
+        "cpus": os.cpu_count(),
+        "onnxruntime": onnxruntime.__version__,
+        "model": os.path.abspath(model_path),
+        "video": os.path.abspath(video_path),
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "target_ms": target_ms,
+        "floor": floor,
+        "latency_ms": best["latency_ms"],
+        "agreement": best["agreement"],
+        "settings": settings,
+        "session_profile": {"intra_threads": best["threads"]},
+    }
+
+
+def make_parser():
+    parser = argparse.ArgumentParser("InsectTrack autotune")
+    parser.add_argument("video", help="short sample clip of the videos this machine will track")
+    parser.add_argument("--model", required=True, help="onnx detection model")
+    parser.add_argument("--frames", type=int, default=64, help="frames sampled from the clip")
+    parser.add_argument("--target-ms",
+                        dest="target_ms",
+                        type=float,
+                        default=None,
+                        help="latency per frame that is fast enough, the most accurate configuration within it "
+                        "is chosen; without it the fastest")
+    parser.add_argument("--floor",
+                        type=float,
+                        default=0.95,
+                        help="lowest detection agreement (F1 of IoU-matched boxes) with the reference configuration")
+    parser.add_argument("--sizes", type=int, nargs="+", default=None, help="input sizes, by default the model's and smaller")
+    parser.add_argument("--batches", type=int, nargs="+", default=None, help="batch sizes, by default 1 2 4 8")
+    parser.add_argument("--threads", type=int, nargs="+", default=None, help="intra-op threads, by default 1 2 4 ... cores")
+    parser.add_argument("--nms", nargs="+", default=None, choices=NMS_BACKENDS, help="nms backends, by default all")
+    parser.add_argument("--repeat", type=int, default=2, help="passes over the frames, the best time is kept")
+    parser.add_argument("--output", default=None, help="profile file, by default the one of this host the engine loads")
+    parser.add_argument("--dry-run", dest="dry_run", default=False, action="store_true", help="do not write the profile")
+    return parser
+
+
+if __name__ == "__main__":
+    args = make_parser().parse_args()
+    frames = sample_frames(args.video, args.frames)
+    results = autotune(args.model, frames, args.sizes, args.batches, args.threads, args.nms, args.repeat)
+    best = choose(results, args.target_ms, args.floor)
+    if best is None:
+        raise ValueError(f"Error: no configuration agrees at least {args.floor} with the reference, lower --floor")
+    if args.target_ms and best["latency_ms"] > args.target_ms:
+        print(f'Warning: no configuration meets {args.target_ms} ms per frame, the fastest one is used')
+    profile = host_profile(best, args.model, args.video, args.target_ms, args.floor)
+    print("chosen:", profile["settings"], profile["session_profile"], f'{best["latency_ms"]:.2f} ms/frame, '
+          f'agreement {best["agreement"]:.3f}')
+    if not args.dry_run:
+        print(f"profile of this host written to {save_host_profile(profile, args.output)}")
@@ -0,0 +1,250 @@
+import os
+import csv
+import json
+import time
+import shutil
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from checkpoint import CHECKPOINT_NAME
+from sessions import SessionManager
+from zones import zone_spec
+
+JOB_NAME = "job.json"
+SUMMARY_NAME = "summary.csv"
+
+_progress = None  # frames tracked by every job, shared with the parent
+_totals = None
+_stop = None
+_sessions = None  # sessions of the worker, jobs of the same model share one
+
+
+def make_job(video, model, areas, max, min, settings=None, name=None):
+    """A job of the queue, areas are area dict values of the GUI or zone specs."""
+    return {
+        "name": name or os.path.splitext(os.path.basename(video))[0],
+        "video": video,
+        "model": model,
+        "areas": {area: zone_spec(value) for area, value in areas.items()},
+        "max": float(max),
+        "min": float(min),
+        "settings": dict(settings or {}),
+    }
+
+
+def load_manifest(path):
+    """Jobs of a json manifest, relative paths are taken from the folder of the manifest.
+
+    The manifest holds the defaults of every job ("model", "areas", "max", "min" and the
+    track.py "settings") and a "jobs" list of video paths or of dicts that override
+    them for one video ({"video": ..., "name": ..., "areas": ...}). The results of a job
+    go to <"output">/<name>, "output" is "batch" next to the manifest by default.
+    Returns the jobs and the output folder.
+    """
+    root = os.path.dirname(os.path.abspath(path))
+    with open(path) as f:
+        manifest = json.load(f)
+    output = os.path.join(root, manifest.get("output", "batch"))
+    jobs = []
+    for entry in manifest.get("jobs", []):
+        entry = {"video": entry} if isinstance(entry, str) else entry
+        spec = {key: manifest.get(key) for key in ("model", "areas", "max", "min", "settings")}
+        spec.update(entry)
+        missing = [key for key in ("video", "model", "areas", "max", "min") if spec.get(key) is None]
+        if missing:
+            raise ValueError(f"Error: job {entry} of {path} has no {', '.join(missing)}")
+        areas = spec["areas"]
+        if isinstance(areas, str):
+            with open(os.path.join(root, areas)) as f:
+                areas = json.load(f)
+        jobs.append(
+            make_job(os.path.join(root, spec["video"]), os.path.join(root, spec["model"]), areas, spec["max"],
+                     spec["min"], spec["settings"], spec.get("name")))
+    return assign_folders(jobs, output), output
+
+
+def assign_folders(jobs, output):
+    """Sets the result folder of every job under `output`, jobs of the same name get _2, _3, ..."""
+    seen = {}
+    for job in jobs:
+        name = job["name"]
+        seen[name] = seen.get(name, 0) + 1
+        if seen[name] > 1:
+            name = job["name"] = f"{name}_{seen[name]}"
+        job["output"] = os.path.join(output, name)
+    return jobs
+
+
+def video_stamp(video):
+    stat = os.stat(video)
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def read_record(job):
+    path = os.path.join(job["output"], JOB_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_record(job, record):
+    os.makedirs(job["output"], exist_ok=True)
+    with open(os.path.join(job["output"], JOB_NAME), 'w') as f:
+        json.dump(record, f, indent=2)
+
+
+def job_state(job):
+    """"done" for a job finished on the same video, "resume" for one with a checkpoint, else "new"."""
+    if os.path.exists(os.path.join(job["output"], CHECKPOINT_NAME)):
+        return "resume"
+    record = read_record(job)
+    if record is not None and record["status"] == "done" and record["stamp"] == video_stamp(job["video"]):
+        return "done"
+    return "new"
+
+
+def init_worker(progress, totals, stop):
+    global _progress, _totals, _stop, _sessions
+    _progress, _totals, _stop = progress, totals, stop
+    _sessions = SessionManager(1)
+
+
+def run_job(index, job, threads):
+    """Tracks the video of a job into its folder in a worker process, returns the record of the run."""
+    from engine import VideoEngine
+
+    t0 = time.time()
+    settings = dict(job["settings"], save_dir=job["output"])
+    if job_state(job) == "resume":
+        settings["resume"] = job["output"]
+    elif os.path.exists(job["output"]):
+        # what a failed or stopped run without checkpoint left would be appended to
+        shutil.rmtree(job["output"])
+    model = _sessions.get(job["model"], job["settings"].get("session_profile"), threads)
+
+    def progress(frame, total):
+        # shared with the parent, which stops the job through the shared flag
+        _progress[index] = int(frame)
+        _totals[index] = int(total)
+        if _stop.value:
+            engine.stop()
+
+    engine = VideoEngine(model, job["video"], job["areas"], job["max"], job["min"], settings, argv=[],
+                         progress=progress)
+    num, area_time = engine.run()
+    record = {
+        "name": job["name"],
+        "video": job["video"],
+        "stamp": video_stamp(job["video"]),
+        "status": "done" if engine.completed else "stopped",
+        "frames": engine.frame_id,
+        "seconds": round(time.time() - t0, 2),
+        "num": num,
+        "time": area_time,
+    }
+    write_record(job, record)
+    return record
+
+
+def write_summary(output, records):
+    """summary.csv of the queue, one row per job with the count and the time of every area."""
+    areas = []
+    for record in records:
+        areas += [area for area in record.get("num", {}) if area not in areas]
+    os.makedirs(output, exist_ok=True)
+    path = os.path.join(output, SUMMARY_NAME)
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["job", "video", "status", "frames", "seconds"] + [f"{area} num" for area in areas] +
+                        [f"{area} time(s)" for area in areas])
+        for record in records:
+            writer.writerow([record["name"], record["video"], record["status"], record.get("frames", ""),
+                             record.get("seconds", "")] + [record.get("num", {}).get(area, "") for area in areas] +
+                            [record.get("time", {}).get(area, "") for area in areas])
+    return path
+
+
+def run_batch(jobs, output, workers=1, rerun=False, progress=None, finished=None, stopped=None):
+    """Runs the jobs in `workers` processes and writes the summary.csv of all of them to `output`.
+
+    Jobs already done are skipped unless `rerun`, jobs with a checkpoint are resumed.
+    `progress(index, frame, total)` is called for the running jobs while they run,
+    `finished(index, record)` once a job ends, and the running jobs are stopped once
+    `stopped()` returns True, keeping their checkpoints. Returns the records in job order.
+    """
+    records = [None] * len(jobs)
+    pending = []
+    for index, job in enumerate(jobs):
+        if not rerun and job_state(job) == "done":
+            records[index] = read_record(job)
+            if finished is not None:
+                finished(index, records[index])
+        else:
+            pending.append(index)
+
+    workers = max(1, min(workers, len(pending) or 1))
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    context = multiprocessing.get_context("spawn")
+    shared_progress = context.Array('q', len(jobs))
+    shared_totals = context.Array('q', len(jobs))
+    shared_stop = context.Value('b', 0)
+    with ProcessPoolExecutor(workers, mp_context=context, initializer=init_worker,
+                             initargs=(shared_progress, shared_totals, shared_stop)) as pool:
+        futures = {pool.submit(run_job, index, jobs[index], threads): index for index in pending}
+        running = set(futures)
+        while running:
+            done, running = wait(running, timeout=0.5, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = futures[future]
+                if future.cancelled():
+                    record = {"name": jobs[index]["name"], "video": jobs[index]["video"], "status": "stopped"}
+                elif future.exception() is not None:
+                    print(f'Warning: job {jobs[index]["name"]} failed: {future.exception()}')
+                    record = {
+                        "name": jobs[index]["name"],
+                        "video": jobs[index]["video"],
+                        "stamp": None,
+                        "status": "failed",
+                        "error": str(future.exception()),
+                    }
+                    write_record(jobs[index], record)
+                else:
+                    record = future.result()
+                records[index] = record
+                if finished is not None:
+                    finished(index, record)
+            if progress is not None:
+                for future in running:
+                    index = futures[future]
+                    if shared_totals[index]:
+                        progress(index, shared_progress[index], shared_totals[index])
+            if stopped is not None and stopped() and not shared_stop.value:
+                # jobs not started yet are dropped, the running ones stop at their next frame
+                shared_stop.value = 1
+                for future in running:
+                    future.cancel()
+
+    write_summary(output, records)
+    return records
+
+
+def make_parser():
+    parser = argparse.ArgumentParser("InsectTrack batch")
+    parser.add_argument("manifest", help="json manifest of the videos to track, see load_manifest")
+    parser.add_argument("--workers", type=int, default=1, help="videos tracked at the same time")
+    parser.add_argument("--rerun", default=False, action="store_true", help="also track the jobs already done")
+    return parser
+
+
+if __name__ == "__main__":
+    args = make_parser().parse_args()
+    jobs, output = load_manifest(args.manifest)
+
+    def report(index, record):
+        print(f'{record["name"]}: {record["status"]}', record.get("num", ""), record.get("error", ""))
+
+    records = run_batch(jobs, output, args.workers, args.rerun, finished=report)
+    print(f"{sum(record['status'] == 'done' for record in records)}/{len(records)} jobs done, "
+          f"summary in {os.path.join(output, SUMMARY_NAME)}")
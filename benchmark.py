@@ -0,0 +1,325 @@
+import os
+import time
+import argparse
+import tracemalloc
+import cv2
+import numpy as np
+
+from detect import Detector, nms, fast_nms
+from count import InsectCount
+from zones import ZoneGrid
+from tracker.kalman_filter import KalmanFilter
+from tracker.bot_sort import BoTSORT
+from tracker.array_bot_sort import ArrayBoTSORT
+from tests.helpers import (LegacyCount, id_switches, make_detections, make_track_args, stream_detections,
+                           tracker_rows, well_plate)
+
+
+def timeit(func, repeat):
+    """Best wall time of `repeat` calls, together with the result of the last call."""
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - t0)
+    return best, result
+
+
+def traced_peak(func):
+    """Peak bytes allocated by one call of `func`, as seen by tracemalloc."""
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def make_pred(num_boxes, num_anchors=33600, dup=5, size=1280, seed=0):
+    """Synthetic YOLOv8 output after the conf column is inserted (cx, cy, w, h, conf, cls).
+
+    `num_boxes` well separated objects, each with `dup` overlapping candidates above the
+    confidence threshold, so exactly `num_boxes` boxes survive NMS.
+    """
+    rng = np.random.default_rng(seed)
+    pred = np.zeros((num_anchors, 6), dtype=np.float32)
+    pred[:, :2] = rng.uniform(0, size, (num_anchors, 2))
+    pred[:, 2:4] = rng.uniform(5, 40, (num_anchors, 2))
+    pred[:, 4] = rng.uniform(0, 0.2, num_anchors)
+
+    side = int(np.ceil(np.sqrt(num_boxes)))
+    step = size / side
+    centers = np.stack(np.meshgrid(np.arange(side), np.arange(side)), -1).reshape(-1, 2)[:num_boxes]
+    centers = (centers + 0.5) * step
+    rows = rng.choice(num_anchors, num_boxes * dup, replace=False)
+    pred[rows, :2] = np.repeat(centers, dup, axis=0) + rng.uniform(-1, 1, (len(rows), 2))
+    pred[rows, 2:4] = step * 0.5
+    pred[rows, 4] = rng.uniform(0.5, 1.0, len(rows))
+    pred[:, 5] = pred[:, 4]
+    return pred
+
+
+def bench_nms(args):
+    print(f"{'boxes':>8}{'legacy(ms)':>14}{'numpy(ms)':>14}{'cv2(ms)':>14}{'kept':>16}")
+    for num_boxes in (10, 100, 1000):
+        pred = make_pred(num_boxes)
+        # the legacy path is quadratic in Python, one run is plenty at 1000 boxes
+        legacy, legacy_out = timeit(lambda: nms(pred.copy(), 0.3, 0.45), 1 if num_boxes >= 1000 else args.repeat)
+        vec, vec_out = timeit(lambda: fast_nms(pred, 0.3, 0.45), args.repeat)
+        ocv, ocv_out = timeit(lambda: fast_nms(pred, 0.3, 0.45, backend='cv2'), args.repeat)
+        kept = f"{len(legacy_out)}/{len(vec_out)}/{len(ocv_out)}"
+        print(f"{num_boxes:>8}{legacy * 1e3:>14.2f}{vec * 1e3:>14.2f}{ocv * 1e3:>14.2f}{kept:>16}")
+
+
+def legacy_preprocess(image, height=1280, width=1280):
+    img = image / 255.
+    img = cv2.resize(img, (width, height))
+    img = np.transpose(img, (2, 0, 1))
+    data = np.expand_dims(img, axis=0)
+    return data.astype(np.float32)
+
+
+class _NoSession(object):
+    """Stands in for an onnxruntime session when only preprocessing is measured."""
+
+    class _Arg(object):
+        name = ''
+        shape = [1, 3, 1280, 1280]
+
+    def get_inputs(self):
+        return [self._Arg()]
+
+    def get_outputs(self):
+        return [self._Arg()]
+
+
+def bench_preprocess(args):
+    detector = Detector(_NoSession())
+    print(f"{'frame':>12}{'legacy(ms)':>14}{'legacy(MB)':>14}{'new(ms)':>14}{'new(MB)':>14}")
+    for height, width in ((480, 640), (1080, 1920), (2160, 3840)):
+        image = np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=np.uint8)
+        detector.preprocess(image)  # first call warms up the buffers
+        legacy, _ = timeit(lambda: legacy_preprocess(image), args.repeat)
+        new, _ = timeit(lambda: detector.preprocess(image), args.repeat)
+        legacy_mb = traced_peak(lambda: legacy_preprocess(image)) / 2**20
+        new_mb = traced_peak(lambda: detector.preprocess(image)) / 2**20
+        print(f"{f'{width}x{height}':>12}{legacy * 1e3:>14.2f}{legacy_mb:>14.1f}{new * 1e3:>14.2f}{new_mb:>14.1f}")
+
+
+def make_states(kf, num_tracks, seed=0):
+    """`num_tracks` Kalman states after a few updates, with matching measurements."""
+    rng = np.random.default_rng(seed)
+    boxes = np.c_[rng.uniform(0, 1280, (num_tracks, 2)), rng.uniform(5, 40, (num_tracks, 2))]
+    states = [kf.initiate(box) for box in boxes]
+    for _ in range(3):
+        states = [kf.update(*kf.predict(mean, cov), mean[:4] + rng.normal(0, 1, 4)) for mean, cov in states]
+    mean = np.asarray([m for m, _ in states])
+    covariance = np.asarray([c for _, c in states])
+    measurement = mean[:, :4] + rng.normal(0, 1, (num_tracks, 4))
+    return mean, covariance, measurement
+
+
+def legacy_multi_predict(kf, mean, covariance):
+    sqr = np.square(np.c_[kf._std_weight_position * mean[:, [2, 3, 2, 3]],
+                          kf._std_weight_velocity * mean[:, [2, 3, 2, 3]]])
+    motion_cov = np.asarray([np.diag(sqr[i]) for i in range(len(mean))])
+    mean = np.dot(mean, kf._motion_mat.T)
+    left = np.dot(kf._motion_mat, covariance).transpose((1, 0, 2))
+    return mean, np.dot(left, kf._motion_mat.T) + motion_cov
+
+
+def bench_kalman(args):
+    kf = KalmanFilter()
+    print(f"{'tracks':>8}{'predict old(ms)':>18}{'predict new(ms)':>18}"
+          f"{'update loop(ms)':>18}{'update batch(ms)':>18}{'max diff':>12}")
+    for num_tracks in (10, 100, 1000):
+        mean, covariance, measurement = make_states(kf, num_tracks)
+        old, old_out = timeit(lambda: legacy_multi_predict(kf, mean, covariance), args.repeat)
+        new, new_out = timeit(lambda: kf.multi_predict(mean, covariance), args.repeat)
+        loop, loop_out = timeit(
+            lambda: [kf.update(m, c, z) for m, c, z in zip(mean, covariance, measurement)], args.repeat)
+        batch, batch_out = timeit(lambda: kf.multi_update(mean, covariance, measurement), args.repeat)
+        diff = max(np.abs(old_out[1] - new_out[1]).max(),
+                   np.abs(np.asarray([m for m, _ in loop_out]) - batch_out[0]).max(),
+                   np.abs(np.asarray([c for _, c in loop_out]) - batch_out[1]).max())
+        print(f"{num_tracks:>8}{old * 1e3:>18.2f}{new * 1e3:>18.2f}{loop * 1e3:>18.2f}{batch * 1e3:>18.2f}"
+              f"{diff:>12.1e}")
+
+
+def run_tracker(tracker, frames, image):
+    rows = []
+    for output in frames:
+        for t in tracker.update(output, image):
+            tlwh = t.tlwh
+            rows.append(f"{tracker.frame_id},{t.track_id},{tlwh[0]:.2f},{tlwh[1]:.2f},{tlwh[2]:.2f},{tlwh[3]:.2f}")
+    return rows
+
+
+def bench_tracker(args):
+    track_args = make_track_args()
+    image = np.zeros((1280, 1280, 3), dtype=np.uint8)
+    print(f"{'targets':>8}{'object(ms/frame)':>18}{'array(ms/frame)':>18}{'same output':>14}")
+    for num_targets in (10, 100, 500):
+        frames = make_detections(num_targets, args.frames or 300)
+        obj, obj_rows = timeit(lambda: run_tracker(BoTSORT(track_args), frames, image), args.repeat)
+        arr, arr_rows = timeit(lambda: run_tracker(ArrayBoTSORT(track_args), frames, image), args.repeat)
+        print(f"{num_targets:>8}{obj / len(frames) * 1e3:>18.2f}{arr / len(frames) * 1e3:>18.2f}"
+              f"{str(obj_rows == arr_rows):>14}")
+
+
+def bench_soak(args):
+    """Long run with constant track churn, fails when the traced memory keeps growing."""
+    num_frames = args.frames or 10_000_000
+    # a short lost buffer and a high respawn rate remove tracks every few frames
+    track_args = make_track_args(track_buffer=30)
+    tracker = {"object": BoTSORT, "array": ArrayBoTSORT}[args.backend](track_args)
+    image = np.zeros((8, 8, 3), dtype=np.uint8)
+    samples = []
+    sample_every = max(num_frames // 20, 1)
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    print(f"{'frame':>12}{'removed kept':>14}{'traced(MB)':>12}{'elapsed(s)':>12}")
+    for frame, output in enumerate(stream_detections(10, num_frames, respawn_rate=0.02), 1):
+        tracker.update(output, image)
+        if frame % sample_every == 0:
+            samples.append(tracemalloc.get_traced_memory()[0])
+            print(f"{frame:>12}{len(tracker.removed_stracks):>14}{samples[-1] / 2**20:>12.2f}"
+                  f"{time.perf_counter() - t0:>12.1f}")
+    tracemalloc.stop()
+    tracker.close()
+
+    # skip the first quarter, the removed track history fills up there
+    warm = samples[len(samples) // 4:]
+    growth = (warm[-1] - warm[0]) / 2**20
+    print(f"growth after warm-up: {growth:.2f} MB")
+    if growth > 1:
+        raise SystemExit(f"Error: memory grew by {growth:.2f} MB over {num_frames} frames")
+
+
+def bench_count(args):
+    num_frames = args.frames or 300
+    rng = np.random.default_rng(0)
+    print(f"{'insects':>8}{'areas':>10}{'legacy(ms/frame)':>22}{'batch(ms/frame)':>18}")
+    for num_insects, area_dict in ((30, well_plate(2, 2)), (300, well_plate(2, 2)), (300, well_plate()),
+                                   (300, well_plate(round=True))):
+        shape = "round" if isinstance(next(iter(area_dict.values())), dict) else "rect"
+        xy = rng.uniform(0, 1280, (num_insects, 2))
+        frames = []
+        for _ in range(num_frames):
+            xy += rng.normal(0, 3, xy.shape)
+            frames.append([np.array([x, y, 20., 20.]) for x, y in xy])
+        ids = list(range(1, num_insects + 1))
+
+        def per_track():
+            counter = LegacyCount(area_dict, 1280, 960, 30, 0.5, 0.2)
+            for tlwhs in frames:
+                for tlwh, id in zip(tlwhs, ids):
+                    counter.count(tlwh, id)
+                counter.update()
+
+        def batch():
+            counter = InsectCount(area_dict, 1280, 960, 30, 0.5, 0.2)
+            for tlwhs in frames:
+                counter.countFrame(tlwhs, ids)
+                counter.update()
+
+        # the legacy counting only knows rectangles
+        legacy = f"{timeit(per_track, args.repeat)[0] / num_frames * 1e3:.3f}" if shape == "rect" else "-"
+        batched, _ = timeit(batch, args.repeat)
+        print(f"{num_insects:>8}{f'{len(area_dict)} {shape}':>10}{legacy:>22}{batched / num_frames * 1e3:>18.3f}")
+
+
+def bench_zones(args):
+    num_frames = args.frames or 300
+    num_insects = 500
+    rng = np.random.default_rng(0)
+    print(f"{'areas':>10}{'all areas(ms/frame)':>22}{'grid(ms/frame)':>17}")
+    for (rows, cols, round) in ((4, 6, False), (4, 6, True), (8, 12, False), (8, 12, True), (16, 24, False),
+                                (16, 24, True)):
+        area_dict = well_plate(rows, cols, round=round)
+        xy = rng.uniform(0, 1280, (num_insects, 2))
+        frames = []
+        for _ in range(num_frames):
+            xy += rng.normal(0, 3, xy.shape)
+            frames.append(np.concatenate([xy, np.full(xy.shape, 20.)], axis=1))
+        ids = np.arange(1, num_insects + 1)
+        counter = InsectCount(area_dict, 1280, 960, 30, 0.5, 0.2)
+        grid = counter.grid or ZoneGrid(counter.areaBounds(), 1280, 960)
+
+        def run(grid):
+            counter.grid = grid
+            for tlwhs in frames:
+                counter.countFrame(tlwhs, ids)
+                counter.update()
+
+        full, _ = timeit(lambda: run(None), args.repeat)
+        indexed, _ = timeit(lambda: run(grid), args.repeat)
+        shape = "round" if round else "rect"
+        print(f"{f'{len(area_dict)} {shape}':>10}{full / num_frames * 1e3:>22.3f}{indexed / num_frames * 1e3:>17.3f}")
+
+
+def bench_stitch(args):
+    """Tracks of a sequential run against the stitched tracks of segments tracked on their own."""
+    from parallel import split_segments, stitch
+
+    num_frames = args.frames or 600
+    track_args = make_track_args()
+    image = np.zeros((1280, 1280, 3), dtype=np.uint8)
+    frames = make_detections(100, num_frames)
+    sequential = tracker_rows(ArrayBoTSORT(track_args), frames, image)
+    print(f"{'segments':>9}{'tracks':>8}{'id switches':>13}{'stitch(ms)':>12}")
+    print(f"{1:>9}{len(np.unique(sequential['id'])):>8}{0:>13}{'-':>12}")
+    for num_segments in (2, 4, 8):
+        segments = split_segments(num_frames, num_segments, args.overlap)
+        rows = [tracker_rows(ArrayBoTSORT(track_args), frames[start:end], image, start) for start, end in segments]
+        seconds, (stitched, _) = timeit(
+            lambda: stitch(segments, rows, track_args.track_buffer, track_args.match_thresh), args.repeat)
+        print(f"{num_segments:>9}{len(np.unique(stitched['id'])):>8}{id_switches(sequential, stitched):>13}"
+              f"{seconds * 1e3:>12.1f}")
+
+
+def bench_session(args):
+    """Load time of every session profile without and with the saved optimized graph, and its inference latency."""
+    from sessions import PROFILES, resolve_profile, optimized_path, load_session
+
+    if args.model is None:
+        raise ValueError("Error: the session benchmark needs --model")
+    print(f"{'profile':>16}{'cold load(ms)':>15}{'warm load(ms)':>15}{'latency(ms)':>13}")
+    for name in PROFILES:
+        level = resolve_profile(name)["optimization"]
+        cached = optimized_path(args.model, "extended" if level == "all" else level)
+        if os.path.exists(cached):
+            os.remove(cached)
+        cold, _ = timeit(lambda: load_session(args.model, name), 1)
+        warm, session = timeit(lambda: load_session(args.model, name), args.repeat)
+        detector = Detector(session)
+        images = [np.zeros((detector.height, detector.width, 3), dtype=np.uint8)] * detector.batch_size
+        detector.predict_batch(images)
+        times = []
+        for _ in range(args.repeat):
+            t0 = time.perf_counter()
+            detector.predict_batch(images)
+            times.append((time.perf_counter() - t0) / detector.batch_size)
+        print(f"{name:>16}{cold * 1e3:>15.1f}{warm * 1e3:>15.1f}{np.median(times) * 1e3:>13.2f}")
+
+
+def make_parser():
+    parser = argparse.ArgumentParser("InsectTrack benchmarks")
+    parser.add_argument("bench",
+                        choices=[
+                            "nms", "preprocess", "kalman", "tracker", "soak", "count", "zones", "stitch", "session"
+                        ],
+                        help="which benchmark to run")
+    parser.add_argument("--repeat", type=int, default=5, help="repetitions, the best time is reported")
+    parser.add_argument("--frames",
+                        type=int,
+                        default=None,
+                        help="frames fed to the tracker or counter, 300 by default and 10 million for soak")
+    parser.add_argument("--overlap", type=int, default=60, help="overlap frames of the stitch segments")
+    parser.add_argument("--backend", default="array", choices=["object", "array"], help="tracker backend of soak")
+    parser.add_argument("--model", default=None, help="onnx model of the session benchmark")
+    return parser
+
+
+if __name__ == "__main__":
+    args = make_parser().parse_args()
+    globals()["bench_" + args.bench](args)
@@ -0,0 +1,128 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+
+CACHE_VERSION = 1  # bump when the detector output changes for the same model and settings
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".insect_track", "detections")
+
+
+def video_digest(path, samples=16, block_size=1 << 20):
+    """Content hash of a video from its size and `samples` evenly spaced blocks.
+
+    Hashing every byte of a multi-hour recording would cost more than the cache
+    saves on short clips, a changed recording still changes its size or blocks.
+    """
+    size = os.path.getsize(path)
+    digest = hashlib.sha1(str(size).encode())
+    with open(path, 'rb') as f:
+        if size <= samples * block_size:
+            digest.update(f.read())
+        else:
+            for i in range(samples):
+                f.seek((size - block_size) * i // (samples - 1))
+                digest.update(f.read(block_size))
+    return digest.hexdigest()
+
+
+def file_digest(path):
+    """Hash of every byte of a file."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def model_digest(model):
+    """Hash of the ONNX model bytes behind an InferenceSession."""
+    model_bytes = getattr(model, "_model_bytes", None)
+    if model_bytes is not None:
+        return hashlib.sha1(model_bytes).hexdigest()
+    # a session loaded from a saved optimized graph is still the model of its source file
+    return file_digest(getattr(model, "source_path", None) or model._model_path)
+
+
+class DetectionCache(object):
+    """Per-frame detections of one video, model and set of detector settings on disk.
+
+    An entry is a directory named after the key holding `boxes.bin`, all detections
+    as float32 rows (x1, y1, x2, y2, conf, cls) read back through a memmap,
+    `index.npy` with the first row and row count of every frame, and `meta.json`.
+    The float32 rows are exact, the detector's boxes are integral and its scores
+    come from the float32 model output.
+
+    On a miss, `add` appends the detections of the next frames to a temporary
+    directory, which `close(complete=True)` renames into place, so an interrupted
+    run never leaves a partial entry behind.
+    """
+
+    def __init__(self, root, video_path, model, detector):
+        self.meta = {
+            "version": CACHE_VERSION,
+            "video": os.path.basename(video_path),
+            "video_digest": video_digest(video_path),
+            "model_digest": model_digest(model),
+            "input_size": [detector.height, detector.width],
+            "conf_thres": detector.conf_thres,
+            "iou_thres": detector.iou_thres,
+            "nms_backend": detector.nms_backend,
+        }
+        key = {k: v for k, v in self.meta.items() if k != "video"}
+        self.key = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+        self.path = os.path.join(root, self.key)
+        self.tmp_path = None
+
+        self.index = None
+        self.boxes = None
+        if os.path.exists(os.path.join(self.path, "meta.json")):
+            self.index = np.load(os.path.join(self.path, "index.npy"))
+            if self.index[:, 1].sum():
+                self.boxes = np.memmap(os.path.join(self.path, "boxes.bin"), dtype=np.float32, mode='r').reshape(-1, 6)
+            else:
+                self.boxes = np.empty((0, 6), dtype=np.float32)
+        else:
+            os.makedirs(root, exist_ok=True)
+            self.tmp_path = f"{self.path}.tmp-{os.getpid()}"
+            shutil.rmtree(self.tmp_path, ignore_errors=True)
+            os.makedirs(self.tmp_path)
+            self.boxes_file = open(os.path.join(self.tmp_path, "boxes.bin"), 'wb')
+            self.rows = []  # (first row, row count) per frame
+            self.num_rows = 0
+
+    @property
+    def hit(self):
+        return self.index is not None
+
+    def get(self, frame_id):
+        """Detections of a frame as the detector returns them, None past the cached frames."""
+        if frame_id >= len(self.index):
+            return None
+        start, count = self.index[frame_id]
+        return self.boxes[start:start + count].astype(np.float64)
+
+    def add(self, outputs):
+        for output in outputs:
+            self.boxes_file.write(np.ascontiguousarray(output, dtype=np.float32).tobytes())
+            self.rows.append((self.num_rows, len(output)))
+            self.num_rows += len(output)
+
+    def close(self, complete):
+        """Publishes the entry written on a miss if the whole video went through, else drops it."""
+        if self.tmp_path is None:
+            return
+        self.boxes_file.close()
+        if complete:
+            np.save(os.path.join(self.tmp_path, "index.npy"), np.asarray(self.rows, dtype=np.int64).reshape(-1, 2))
+            self.meta["frames"] = len(self.rows)
+            self.meta["detections"] = self.num_rows
+            with open(os.path.join(self.tmp_path, "meta.json"), 'w') as f:
+                json.dump(self.meta, f, indent=2)
+            try:
+                os.replace(self.tmp_path, self.path)
+            except OSError:
+                # another run published the same entry first
+                pass
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        self.tmp_path = None
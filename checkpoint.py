@@ -0,0 +1,58 @@
+import os
+import json
+import pickle
+
+CHECKPOINT_VERSION = 1  # bump when the pickled state changes
+CHECKPOINT_NAME = "checkpoint.pkl"
+
+
+def save_checkpoint(save_path, state):
+    """Pickles `state` as the checkpoint of a save folder.
+
+    The state goes to a temporary file first, which then replaces the previous
+    checkpoint, so a crash while writing still leaves the previous one whole.
+    """
+    path = os.path.join(save_path, CHECKPOINT_NAME)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(dict(state, version=CHECKPOINT_VERSION), f, protocol=pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(save_path):
+    """State saved by save_checkpoint, unpickling it truncates the outputs back to the checkpoint."""
+    path = os.path.join(save_path, CHECKPOINT_NAME)
+    if not os.path.exists(path):
+        raise ValueError(f"Error: no checkpoint to resume from in {save_path}")
+    with open(path, 'rb') as f:
+        state = pickle.load(f)
+    if state.get("version") != CHECKPOINT_VERSION:
+        raise ValueError(f"Error: the checkpoint in {save_path} was written by another version")
+    return state
+
+
+def remove_checkpoint(save_path):
+    for name in (CHECKPOINT_NAME, f"{CHECKPOINT_NAME}.tmp"):
+        path = os.path.join(save_path, name)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def find_checkpoint(video_path):
+    """Newest save folder next to a video with the checkpoint of an unfinished run of it, None without one."""
+    root = os.path.dirname(video_path) or '.'
+    name = os.path.basename(video_path)
+    for folder in sorted(os.listdir(root), reverse=True):
+        path = os.path.join(root, folder)
+        if not os.path.exists(os.path.join(path, CHECKPOINT_NAME)):
+            continue
+        try:
+            with open(os.path.join(path, "meta.json")) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if meta.get("video") == name:
+            return path
+    return None
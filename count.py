@@ -1,45 +1,20 @@
 import os
 import csv
+import json
+import sqlite3
+import argparse
+import numpy as np
 
-from PyQt5.QtWidgets import QLabel
-from PyQt5.QtCore import QRect
-from PyQt5.QtGui import QPainter
+from zones import ZoneGrid, ZoneRaster, zone_spec
 
-
-class MyLabel(QLabel):
-
-    def __init__(self, parent=None):
-        super(MyLabel, self).__init__(parent)
-        self.add_camera_event = False
-        self.rect_list = []
-        self.pen_list = []
-        self.new_rect = None
-
-    def addRect(self, x0, y0, w, h, pen):
-        self.pen_list.append(pen)
-        self.new_rect = QRect(x0, y0, w, h)
-        self.rect_list.append(self.new_rect)
-        self.update()
-
-        return [x0, y0, w, h, pen]
-
-    def removeItem(self, item):
-        self.rect_list.pop()
-        self.pen_list.pop()
-        self.update()
-
-    def paintEvent(self, event):
-        super().paintEvent(event)
-        if self.add_camera_event and len(self.rect_list) > 0:
-            painter = QPainter(self)
-            for index in range(len(self.rect_list)):
-                painter.setPen(self.pen_list[index])
-                painter.drawRect(self.rect_list[index])
+# below this many areas, or shaped areas, testing every area is faster than the grid
+GRID_MIN_AREAS = 128
+GRID_MIN_SHAPED = 16
 
 
 class InsectCount():
 
-    def __init__(self, area_dict, width, height, fps, max, min):
+    def __init__(self, area_dict, width, height, fps, max, min, bins_path=None, bin_seconds=60):
         '''
         time_dict = {'a_dict':{'c1':[t1, t2, t3, ...],
                                'c2':[t1, t2, t3, ...],
@@ -48,19 +23,72 @@ class InsectCount():
                      'b_dict':...,
                      'c_dict':...,
                      ...}
-        last_frame_dict={'c1':C1_COUNT_NUM,
-                         'c2':C2_COUNT_NUM,
-                         'c3':C3_COUNT_NUM,
-                         ...}
+
+        Counting appends to an EventLog, the record save builds time_dict from. An
+        insect entering an area starts a stay (ENTER), or goes on with its latest
+        stay there when it was in any area less than `max` seconds before (RESUME),
+        and leaving the area ends the segment (EXIT). While counting, stay_area[id]
+        holds the areas the insect had a stay in, one per slot, and stay_latest[id]
+        the row of its latest stay there in the stay_* arrays. last_hit[id] and
+        last_area[id] hold the clock of the last frame the insect was in an area and
+        that area.
+
+        Rectangles overlap boxes exactly, polygon and mask areas go to a ZoneRaster,
+        their overlap with a box is the number of area pixels inside it. With many
+        areas a ZoneGrid picks the few areas a box can overlap.
+
+        Counts also go into CountBins as they happen, written to `bins_path` bin
+        after bin, so a crash keeps all finished bins. stay_first holds the first
+        stay of the insect in the area, the row keeping whether it was counted and
+        its last bin.
         '''
         self.time_dict = {}
-        self.last_frame_dict = {}
         self.area_list = []
         self.frame_threshold = fps * min
         self.same_target_threshold = fps * max
+        shapes = []
+        self.shaped_areas = []
         for (key, value) in area_dict.items():
             self.time_dict[key + "_dict"] = {}
-            self.area_list.append(self.areaAdjust(value[:-1], width, height))
+            spec = zone_spec(value)
+            if isinstance(spec, dict):
+                shapes.append(spec)
+                self.shaped_areas.append(len(self.area_list))
+                self.area_list.append([0, 0, 0, 0])
+            else:
+                self.area_list.append(self.areaAdjust(spec, width, height))
+        self.area_names = list(self.time_dict.keys())
+        self.areas = np.asarray(self.area_list, dtype=np.float64).reshape(-1, 4)
+        self.zones = ZoneRaster(shapes, width, height) if shapes else None
+        self.shaped_index = np.full(len(self.areas), -1)
+        self.shaped_index[self.shaped_areas] = np.arange(len(self.shaped_areas))
+
+        self.grid = None
+        if len(self.areas) >= GRID_MIN_AREAS or len(self.shaped_areas) >= GRID_MIN_SHAPED:
+            self.grid = ZoneGrid(self.areaBounds(), width, height)
+
+        self.clock = 0  # frames counted so far, moved on by update
+        self.frame_clock = -1  # clock of the last counted frame
+        self.pending = []  # boxes given one by one to count
+        self.events = EventLog()
+        self.open_keys = np.zeros(0, dtype=np.int64)  # id * areas + area of the insects in an area at frame_clock
+        self.last_hit = np.full(1024, -np.inf)
+        self.last_area = np.zeros(1024, dtype=np.int64)
+        self.stay_area = np.full((1024, 4), -1, dtype=np.int64)
+        self.stay_latest = np.zeros((1024, 4), dtype=np.int64)
+        self.num_stays = 0
+        self.stay_len = np.zeros(1024)
+        self.stay_first = np.zeros(1024, dtype=np.int64)
+        self.stay_counted = np.zeros(1024, dtype=bool)
+        self.stay_bin = np.zeros(1024, dtype=np.int64)  # last bin + 1 the insect was counted in, 0 for none
+        self.bins = CountBins(self.area_names, fps, bin_seconds, bins_path)
+
+    def areaBounds(self):
+        """x0, y0, x1, y1 of every area in the video."""
+        bounds = np.concatenate([self.areas[:, :2], self.areas[:, :2] + self.areas[:, 2:]], axis=1)
+        if self.zones is not None:
+            bounds[self.shaped_areas] = self.zones.bounds
+        return bounds
 
     def areaAdjust(self, tlwh, width, height):
         temp_tlwh = [tlwh[0] / 796, tlwh[1] / 597, tlwh[2] / 796, tlwh[3] / 597]
@@ -102,75 +130,542 @@ class InsectCount():
         box0 = [tlwh0[0], tlwh0[1], tlwh0[0] + tlwh0[2], tlwh0[1] + tlwh0[3]]  # x0 y0 x1 y1
         box1 = [tlwh1[0], tlwh1[1], tlwh1[0] + tlwh1[2], tlwh1[1] + tlwh1[3]]
         p0 = [max(box0[0], box1[0]), max(box0[1], box1[1])]  # x y
-        p1 = [max(box0[2], box1[2]), max(box0[3], box1[3])]
+        p1 = [min(box0[2], box1[2]), min(box0[3], box1[3])]
         if p0[0] < p1[0] and p0[1] < p1[1]:
             return (p1[0] - p0[0]) * (p1[1] - p0[1])
         else:
             return 0
 
+    def bestArea(self, tlwhs):
+        """Overlap with the area every box overlaps most and that area's index, the first one on ties."""
+        tlwhs = np.asarray(tlwhs, dtype=np.float64).reshape(-1, 4)
+        if self.grid is not None:
+            return self.bestAreaGrid(tlwhs)
+        x0, y0 = tlwhs[:, 0:1], tlwhs[:, 1:2]
+        x1, y1 = x0 + tlwhs[:, 2:3], y0 + tlwhs[:, 3:4]
+        areas = self.areas
+        w = np.minimum(x1, areas[:, 0] + areas[:, 2]) - np.maximum(x0, areas[:, 0])
+        h = np.minimum(y1, areas[:, 1] + areas[:, 3]) - np.maximum(y0, areas[:, 1])
+        overlap = np.where((w > 0) & (h > 0), w * h, 0)
+        if self.zones is not None:
+            overlap[:, self.shaped_areas] = self.zones.overlap(tlwhs)
+        best_area = overlap.argmax(axis=1) if len(areas) else np.zeros(len(tlwhs), dtype=np.int64)
+        best = overlap[np.arange(len(tlwhs)), best_area] if len(areas) else np.zeros(len(tlwhs))
+        return best, best_area
+
+    def bestAreaGrid(self, tlwhs):
+        # same as bestArea, only the (box, area) pairs sharing a grid cell are tested
+        rows, areas = self.grid.pairs(tlwhs)
+        overlap = np.zeros(len(rows))
+        shaped = self.shaped_index[areas] >= 0 if self.zones is not None else np.zeros(len(rows), dtype=bool)
+        # the rectangle overlap only of the pairs with a rectangle area, with round ones there may be none
+        plain = np.flatnonzero(~shaped)
+        boxes = tlwhs[rows[plain]]
+        area_boxes = self.areas[areas[plain]]
+        w = np.minimum(boxes[:, 0] + boxes[:, 2], area_boxes[:, 0] + area_boxes[:, 2]) - np.maximum(
+            boxes[:, 0], area_boxes[:, 0])
+        h = np.minimum(boxes[:, 1] + boxes[:, 3], area_boxes[:, 1] + area_boxes[:, 3]) - np.maximum(
+            boxes[:, 1], area_boxes[:, 1])
+        overlap[plain] = np.where((w > 0) & (h > 0), w * h, 0)
+        if shaped.any():
+            overlap[shaped] = self.zones.overlap(tlwhs[rows[shaped]], self.shaped_index[areas[shaped]])
+
+        # the pairs come box by box, per box the largest overlap and the first area with it
+        best = np.zeros(len(tlwhs))
+        best_area = np.zeros(len(tlwhs), dtype=np.int64)
+        if not len(rows):
+            return best, best_area
+        starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+        group = np.cumsum(np.r_[False, rows[1:] != rows[:-1]])
+        group_best = np.maximum.reduceat(overlap, starts)
+        candidates = np.where((overlap == group_best[group]) & (overlap > 0), areas, len(self.areas))
+        group_area = np.minimum.reduceat(candidates, starts)
+        hit = group_area < len(self.areas)
+        best[rows[starts[hit]]] = group_best[hit]
+        best_area[rows[starts[hit]]] = group_area[hit]
+        return best, best_area
+
+    def countFrame(self, tlwhs, ids, step=1):
+        """Counts all tracks of one frame, `step` frames after the previous counted frame."""
+        if not len(self.areas):
+            return
+        ids = np.asarray(ids, dtype=np.int64)
+        hit_area = np.zeros(0, dtype=np.int64)
+        if len(ids):
+            best, best_area = self.bestArea(tlwhs)
+            inside = best > 0
+            ids = ids[inside]
+            hit_area = best_area[inside]
+        if not len(ids):
+            self.logFrame(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool), np.zeros(0, dtype=bool))
+            return
+        if ids.max() >= len(self.last_hit):
+            self.growIds(max(2 * len(self.last_hit), ids.max() + 1))
+
+        # an insect in any area less than `max` seconds ago goes on with its latest stay in this area
+        recent = self.clock - self.last_hit[ids] < self.same_target_threshold
+        # and is still in the area if it was there on the previous counted frame
+        is_open = (self.last_hit[ids] == self.frame_clock) & (self.last_area[ids] == hit_area)
+        self.last_hit[ids] = self.clock
+        self.last_area[ids] = hit_area
+        keys = ids * len(self.areas) + hit_area
+        # the slot of the area among the stays of the insect, -1 if it had none there yet
+        match = self.stay_area[ids] == hit_area[:, None]
+        slot = np.where(match.any(axis=1), match.argmax(axis=1), -1)
+        latest = self.stay_latest[ids, slot]
+        stays = np.where(recent & (slot >= 0), latest, -1)
+        go_on = stays >= 0
+        self.stay_len[stays[go_on]] += step
+
+        new = np.flatnonzero(~go_on)
+        if len(new):
+            if self.num_stays + len(new) > len(self.stay_len):
+                self.growStays(max(2 * len(self.stay_len), self.num_stays + len(new)))
+            rows = np.arange(self.num_stays, self.num_stays + len(new))
+            known = slot[new] >= 0
+            self.stay_len[rows] = step
+            self.stay_first[rows] = np.where(known, self.stay_first[latest[new]], rows)
+            # a first stay in an area takes the first free slot of the insect
+            first_stays = new[~known]
+            if len(first_stays):
+                free = self.stay_area[ids[first_stays]] < 0
+                if not free.any(axis=1).all():
+                    self.growSlots()
+                    free = self.stay_area[ids[first_stays]] < 0
+                slot[first_stays] = free.argmax(axis=1)
+                self.stay_area[ids[first_stays], slot[first_stays]] = hit_area[first_stays]
+            self.stay_latest[ids[new], slot[new]] = rows
+            self.num_stays += len(new)
+            stays[new] = rows
+        self.logFrame(keys, go_on, is_open)
+
+        # a stay is counted from the frame it reaches `min` seconds, with all its frames so far
+        length = self.stay_len[stays]
+        counted = length >= self.frame_threshold
+        entries = counted & (~go_on | (length - step < self.frame_threshold))
+        first = self.stay_first[stays]
+        new_ids = entries & ~self.stay_counted[first]
+        self.stay_counted[first[new_ids]] = True
+        unique = counted & (self.stay_bin[first] != self.bins.bin + 1)
+        self.stay_bin[first[unique]] = self.bins.bin + 1
+        self.bins.add(hit_area, entries, new_ids, unique, np.where(entries, length, step) * counted)
+
+    def logFrame(self, keys, go_on, is_open):
+        """Logs the events of a frame from the (id, area) keys of its hits, whether they go on with a stay
+        and whether the insect was in the area on the previous counted frame.
+
+        A hit counts the step to the next counted frame, so a segment lasts from the
+        clock of its first hit to the clock of the first counted frame without one.
+        """
+        areas = len(self.areas)
+        open_ids = self.open_keys // areas
+        left = self.open_keys[(self.last_hit[open_ids] != self.clock) |
+                              (self.last_area[open_ids] != self.open_keys % areas)]
+        # a new stay of an insect still in the area, after a step longer than `max`, ends the segment first
+        split = keys[~go_on & is_open]
+        entered = keys[~go_on]
+        resumed = keys[go_on & ~is_open]
+        if len(left) or len(entered) or len(resumed):
+            changed = np.concatenate([left, split, entered, resumed])
+            kinds = np.repeat([EXIT, EXIT, ENTER, RESUME], [len(left), len(split), len(entered), len(resumed)])
+            self.events.append(self.clock, changed // areas, changed % areas, kinds)
+        self.open_keys = keys
+        self.frame_clock = self.clock
+
+    def growIds(self, size):
+        for name, fill in (("last_hit", -np.inf), ("last_area", 0), ("stay_area", -1), ("stay_latest", 0)):
+            old = getattr(self, name)
+            new = np.full((size, ) + old.shape[1:], fill, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def growSlots(self):
+        # an insect had stays in more areas than there are slots
+        for name, fill in (("stay_area", -1), ("stay_latest", 0)):
+            old = getattr(self, name)
+            new = np.full((len(old), 2 * old.shape[1]), fill, dtype=old.dtype)
+            new[:, :old.shape[1]] = old
+            setattr(self, name, new)
+
+    def growStays(self, size):
+        for name in ("stay_len", "stay_first", "stay_counted", "stay_bin"):
+            old = getattr(self, name)
+            new = np.zeros(size, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
     def count(self, tlwh, id):
-        overlap_area = []
-        for area in self.area_list:
-            overlap_area.append(self.judgeOverlap(tlwh, area))
-        if overlap_area:
-            if max(overlap_area) != 0:
-                area_index = overlap_area.index(max(overlap_area))
-                area_name = list(self.time_dict.keys())[area_index]
-                if id in list(self.time_dict[area_name].keys()):
-                    if id in list(self.last_frame_dict.keys()):
-                        self.time_dict[area_name][id][-1] += 1
-                        # self.last_frame_dict[id] = self.same_target_threshold
-                    else:
-                        self.time_dict[area_name][id].append(1)
-                        # self.last_frame_dict[id] = self.same_target_threshold
-
-                else:
-                    self.time_dict[area_name][id] = [1]
-                    # self.last_frame_dict[id] = self.same_target_threshold
-                self.last_frame_dict[id] = self.same_target_threshold
-
-    def update(self):
-        for id in list(self.last_frame_dict.keys()):
-            self.last_frame_dict[id] -= 1
-            if self.last_frame_dict[id] == 0:
-                self.last_frame_dict.pop(id)
+        # boxes of a frame given one by one are counted together by update, with its step
+        self.pending.append((tlwh, id))
+
+    def update(self, step=1):
+        # step > 1 when a real-time source skipped frames
+        if self.frame_clock != self.clock:
+            self.countFrame([tlwh for tlwh, _ in self.pending], [id for _, id in self.pending], step)
+            self.pending = []
+        self.clock += step
+        self.bins.roll(self.clock)
 
     def save(self, path, fps):
-        for (area_name, id_dict) in list(self.time_dict.items()):
-            for (id, time_list) in list(id_dict.items()):
-                for time_index in range(len(time_list)):
-                    if time_list[time_index] < self.frame_threshold:
-                        self.time_dict[area_name][id].pop(time_index)
-                    else:
-                        self.time_dict[area_name][id][time_index] /= fps
-                if not self.time_dict[area_name][id]:
-                    self.time_dict[area_name].pop(id)
+        # the insects still in an area leave it after the last counted frame
+        self.logFrame(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool), np.zeros(0, dtype=bool))
+        self.bins.close(self.clock)
+        events = self.events.array()
+        np.save(os.path.join(path, "events.npy"), events)
+        self.time_dict, area_count, area_time = summarizeEvents(events, self.area_names, fps, self.frame_threshold)
+        return writeCount(path, self.time_dict, area_count, area_time)
+
+
+ENTER, RESUME, EXIT = 0, 1, 2
+EVENT_DTYPE = np.dtype([("frame", np.int64), ("id", np.int64), ("zone", np.int32), ("kind", np.int8)])
+
+
+class EventLog(object):
+    """Append-only log of EVENT_DTYPE rows kept in fixed-size chunks, a full chunk is never copied again."""
+
+    def __init__(self, chunk_size=1 << 16):
+        self.chunk_size = chunk_size
+        self.chunks = [np.empty(chunk_size, dtype=EVENT_DTYPE)]
+        self.size = 0  # rows used in the last chunk
+
+    def __len__(self):
+        return (len(self.chunks) - 1) * self.chunk_size + self.size
+
+    def append(self, frame, ids, zones, kind):
+        """Appends an event at `frame` for every (id, zone), of `kind` or of the kind of every pair."""
+        start = 0
+        while start < len(ids):
+            if self.size == self.chunk_size:
+                self.chunks.append(np.empty(self.chunk_size, dtype=EVENT_DTYPE))
+                self.size = 0
+            end = min(len(ids), start + self.chunk_size - self.size)
+            rows = self.chunks[-1][self.size:self.size + end - start]
+            rows["frame"] = frame
+            rows["id"] = ids[start:end]
+            rows["zone"] = zones[start:end]
+            rows["kind"] = kind if np.isscalar(kind) else kind[start:end]
+            self.size += end - start
+            start = end
+
+    def array(self):
+        return np.concatenate(self.chunks[:-1] + [self.chunks[-1][:self.size]])
+
+    def __getstate__(self):
+        # a checkpoint only keeps the used rows of the last chunk
+        state = self.__dict__.copy()
+        state["chunks"] = self.chunks[:-1] + [self.chunks[-1][:self.size].copy()]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        last = np.empty(self.chunk_size, dtype=EVENT_DTYPE)
+        last[:self.size] = self.chunks[-1]
+        self.chunks[-1] = last
+
+
+def summarizeEvents(events, area_names, fps, frame_threshold):
+    """time_dict, insects and time per area of an event log, keeping the stays of at least `frame_threshold` frames.
+
+    Every ENTER or RESUME of an (id, zone) is followed by its EXIT, so in log order
+    per (id, zone) the n-th start pairs with the n-th exit. A stay is an ENTER with
+    the RESUMEs up to the next ENTER, its length the frames of all its segments.
+    """
+    time_dict = {name: {} for name in area_names}
+    area_count = dict.fromkeys(area_names, 0)
+    area_time = dict.fromkeys(area_names, 0.0)
+    if not len(events):
+        return time_dict, area_count, area_time
+    keys = events["id"] * len(area_names) + events["zone"]
+    order = np.argsort(keys, kind='stable')
+    exits = order[events["kind"][order] == EXIT]
+    starts = order[events["kind"][order] != EXIT]
+    lengths = events["frame"][exits] - events["frame"][starts]
+    new_stay = events["kind"][starts] == ENTER
+    stay_lengths = np.bincount(np.cumsum(new_stay) - 1, weights=lengths)
+    stay_rows = starts[new_stay]  # the ENTER of every stay
+
+    # stays in log order, an (id, zone) comes in its area's dict at its first stay, counted or not
+    order = np.argsort(stay_rows)
+    stay_rows, stay_lengths = stay_rows[order], stay_lengths[order]
+    stay_keys = keys[stay_rows]
+    unique_keys, first_stay, key_index = np.unique(stay_keys, return_index=True, return_inverse=True)
+    counted = stay_lengths >= frame_threshold
+    zones = events["zone"][stay_rows]
+    size = len(area_names)
+    area_count = dict(zip(area_names, np.bincount(unique_keys[np.unique(key_index[counted])] % size,
+                                                  minlength=size).tolist()))
+    area_time = dict(zip(area_names, (np.bincount(zones[counted], weights=stay_lengths[counted], minlength=size) /
+                                      fps).tolist()))
+
+    # the counted stays grouped by (id, zone), groups in order of their first stay
+    rows = np.flatnonzero(counted)
+    rows = rows[np.argsort(first_stay[key_index[rows]], kind='stable')]
+    starts = np.flatnonzero(np.r_[True, stay_keys[rows][1:] != stay_keys[rows][:-1]]) if len(rows) else rows
+    seconds = (stay_lengths[rows] / fps).tolist()
+    for start, end, zone, id in zip(starts.tolist(), np.r_[starts[1:], len(rows)].tolist(),
+                                    zones[rows[starts]].tolist(), events["id"][stay_rows[rows[starts]]].tolist()):
+        time_dict[area_names[zone]][id] = seconds[start:end]
+    return time_dict, area_count, area_time
+
+
+class CountBins(object):
+    """Per-area counts of fixed time bins, written out as soon as a bin is over.
 
+    A bin holds the stays counted from it on (entries), the insects counted in an area
+    for the first time (new ids), the insects counted in the area during the bin
+    (unique ids) and the counted time. A stay counts from the frame it reaches the
+    shortest counted stay, with all its time so far, so the bins add up to what
+    result.csv reports.
+    """
+
+    HEADER = ["bin start(s)", "bin end(s)", "area name", "entries", "new ids", "unique ids", "dwell(s)"]
+
+    def __init__(self, area_names, fps, bin_seconds=60, path=None):
+        self.area_names = area_names
+        self.fps = fps
+        self.bin_frames = max(bin_seconds * fps, 1)
+        self.bin = 0
+        self.entries = np.zeros(len(area_names), dtype=np.int64)
+        self.new_ids = np.zeros(len(area_names), dtype=np.int64)
+        self.unique = np.zeros(len(area_names), dtype=np.int64)
+        self.dwell = np.zeros(len(area_names))  # frames
+        self.writer = BinWriter(path) if path else None
+
+    def add(self, areas, entries, new_ids, unique, dwell):
+        """Adds the hits of a frame, the area of every hit and whether it is an entry, a new id, unique and its frames."""
+        size = len(self.area_names)
+        self.entries += np.bincount(areas[entries], minlength=size)
+        self.new_ids += np.bincount(areas[new_ids], minlength=size)
+        self.unique += np.bincount(areas[unique], minlength=size)
+        self.dwell += np.bincount(areas, weights=dwell, minlength=size)
+
+    def roll(self, clock):
+        """Finishes the bins the clock is past, bins skipped by a long step are written empty."""
+        bin = int(clock // self.bin_frames)
+        while self.bin < bin:
+            self.flush((self.bin + 1) * self.bin_frames)
+            self.bin += 1
+
+    def flush(self, end):
+        if self.writer is not None:
+            start = self.bin * self.bin_frames / self.fps
+            self.writer.write([(start, end / self.fps, name, int(entries), int(new_ids), int(unique), dwell / self.fps)
+                               for name, entries, new_ids, unique, dwell in zip(
+                                   self.area_names, self.entries, self.new_ids, self.unique, self.dwell)])
+        for counts in (self.entries, self.new_ids, self.unique, self.dwell):
+            counts[:] = 0
+
+    def close(self, clock):
+        """Writes the bin in progress up to `clock` and closes the output."""
+        if clock > self.bin * self.bin_frames:
+            self.flush(clock)
+            self.bin += 1
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+class BinWriter(object):
+    """Append-only output of count bins, a csv file or a SQLite database in WAL mode for a .db path."""
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.splitext(path)[1] in (".db", ".sqlite"):
+            # opened by the thread setting up a run, written to by its track stage, one at a time
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS bins (bin_start REAL, bin_end REAL, area TEXT, entries INTEGER, "
+                            "new_ids INTEGER, unique_ids INTEGER, dwell REAL)")
+            self.db.commit()
+            self.file = None
+        else:
+            self.db = None
+            new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+            self.file = open(path, 'a', newline='')
+            self.writer = csv.writer(self.file)
+            if new_file:
+                self.writer.writerow(CountBins.HEADER)
+                self.file.flush()
+
+    def position(self):
+        """Where the output stands, the size of the csv file or the last row of the database."""
+        if self.db is not None:
+            return self.db.execute("SELECT COALESCE(MAX(rowid), 0) FROM bins").fetchone()[0]
+        self.file.flush()
+        return self.file.tell()
+
+    def truncate(self, position):
+        """Drops what was written after `position`."""
+        if self.db is not None:
+            self.db.execute("DELETE FROM bins WHERE rowid > ?", (position, ))
+            self.db.commit()
+        else:
+            self.file.truncate(position)
+
+    def __getstate__(self):
+        # pickled in a checkpoint, loading it reopens the output as it was then
+        return {"path": self.path, "position": self.position()}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+        self.truncate(state["position"])
+
+    def write(self, rows):
+        if self.db is not None:
+            self.db.executemany("INSERT INTO bins VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self.db.commit()
+        else:
+            self.writer.writerows(rows)
+            self.file.flush()
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+        else:
+            self.file.close()
+
+
+def writeCount(path, time_dict, area_count=None, area_time=None):
+    """Writes result.csv and detail.csv of a {area name: {id: [stay(s), ...]}} dict.
+
+    The totals per area are summed from time_dict unless given.
+    """
+    if area_count is None:
         area_count = {}
         area_time = {}
-        for area_name, id_dict in self.time_dict.items():
+        for area_name, id_dict in time_dict.items():
             area_count[area_name] = len(id_dict)
             area_time[area_name] = sum(sum(id_dict.values(), []))
 
-        result_path = os.path.join(path, "result.csv")
-        with open(result_path, 'w', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow(["area name", "num"])
-            for row in area_count.items():
-                writer.writerow(row)
-            writer.writerow(["area name", "time(s)"])
-            for row in area_time.items():
-                writer.writerow(row)
-
-        detail_path = os.path.join(path, "detail.csv")
-        # df = pd.DataFrame(self.time_dict)
-        # df.to_csv(detail_path, index=False)
-        with open(detail_path, 'w', newline='') as f:
-            writer = csv.writer(f)
-            for (key, value) in list(self.time_dict.items()):
-                writer.writerow([key])
-                for (id, time_list) in list(value.items()):
-                    time_list.insert(0, id)
-                    writer.writerow(time_list)
-
-        return area_count, area_time
+    result_path = os.path.join(path, "result.csv")
+    with open(result_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["area name", "num"])
+        for row in area_count.items():
+            writer.writerow(row)
+        writer.writerow(["area name", "time(s)"])
+        for row in area_time.items():
+            writer.writerow(row)
+
+    detail_path = os.path.join(path, "detail.csv")
+    # df = pd.DataFrame(self.time_dict)
+    # df.to_csv(detail_path, index=False)
+    with open(detail_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        for (key, value) in list(time_dict.items()):
+            writer.writerow([key])
+            for (id, time_list) in list(value.items()):
+                writer.writerow([id] + time_list)
+
+    return area_count, area_time
+
+
+def loadTracks(path):
+    """(frame, id, tlwh) arrays of a saved track folder or MOT text file, in file order."""
+    npy_dir = os.path.join(path, "tracks_npy") if os.path.isdir(path) else None
+    if npy_dir and os.path.isdir(npy_dir):
+        from tracker.tracking_utils.io import read_npy_results
+        rows = read_npy_results(npy_dir)
+        tlwh = np.stack([rows['x1'], rows['y1'], rows['w'], rows['h']], axis=1)
+        return rows['frame'], rows['id'], tlwh
+    if os.path.isdir(path):
+        path = os.path.join(path, "tracks.txt")
+    rows = np.loadtxt(path, delimiter=',', usecols=(0, 1, 2, 3, 4, 5), ndmin=2)
+    return rows[:, 0].astype(np.int64), rows[:, 1].astype(np.int64), rows[:, 2:6]
+
+
+def recount(frames, ids, tlwhs, area_dict, width, height, fps, max, min, chunk_size=1 << 16):
+    """Replays saved tracks through the InsectCount logic for new areas and thresholds.
+
+    Gives the time_dict InsectCount.save would have written had the areas been set
+    during tracking, with every frame handled as one step. Per track the count only
+    depends on its own earlier hits, so all rows are handled with array operations:
+    a hit starts a new stay unless the track hit any area less than `max` seconds
+    before and already has a stay in the hit area, which is then extended.
+    """
+    counter = InsectCount(area_dict, width, height, fps, max, min)
+    area_names = counter.area_names
+    time_dict = {name: {} for name in area_names}
+    if not len(ids) or not area_names:
+        return time_dict
+    if np.any(np.diff(frames) < 0):
+        # rows in frame order, the stable sorts below then keep it inside every group
+        order = np.argsort(frames, kind='stable')
+        frames, ids, tlwhs = frames[order], ids[order], tlwhs[order]
+
+    # the row counts for the area it overlaps most, the first one on ties
+    best = np.zeros(len(ids))
+    best_area = np.zeros(len(ids), dtype=np.int64)
+    for start in range(0, len(ids), chunk_size):
+        best[start:start + chunk_size], best_area[start:start + chunk_size] = counter.bestArea(
+            tlwhs[start:start + chunk_size])
+    rows = np.flatnonzero(best > 0)
+    frames, ids, hit_area = frames[rows], ids[rows], best_area[rows]
+
+    # the track was counted less than `max` seconds before, in any area
+    order = np.argsort(ids, kind='stable')
+    same_id = np.r_[False, ids[order][1:] == ids[order][:-1]]
+    recent = np.zeros(len(rows), dtype=bool)
+    recent[order] = same_id & (np.r_[0, np.diff(frames[order])] < counter.same_target_threshold)
+
+    # the track already has a stay in this area
+    order = np.argsort(ids * len(area_names) + hit_area, kind='stable')
+    seen = np.zeros(len(rows), dtype=bool)
+    seen[order] = np.r_[False, (ids[order][1:] == ids[order][:-1]) & (hit_area[order][1:] == hit_area[order][:-1])]
+
+    new_stay = ~(recent & seen)
+    stay = np.cumsum(new_stay[order]) - 1
+    lengths = np.bincount(stay)
+    stay_rows = order[new_stay[order]]  # first hit of every stay, in stay order
+    keep = lengths >= counter.frame_threshold
+
+    # ids go into the area dicts in order of their first hit, like the live count
+    first_hits = np.flatnonzero(new_stay & ~seen)
+    for row in first_hits[np.argsort(rows[first_hits], kind='stable')]:
+        time_dict[area_names[hit_area[row]]][int(ids[row])] = []
+    for stay_row, length in zip(stay_rows[keep], lengths[keep]):
+        time_dict[area_names[hit_area[stay_row]]][int(ids[stay_row])].append(float(length) / fps)
+    for id_dict in time_dict.values():
+        for id in [id for id, time_list in id_dict.items() if not time_list]:
+            id_dict.pop(id)
+    return time_dict
+
+
+def make_parser():
+    parser = argparse.ArgumentParser("Recount saved tracks with new monitoring areas")
+    parser.add_argument("path", help="result folder of a tracked video, or its tracks.txt")
+    parser.add_argument("--areas",
+                        default=None,
+                        help="json file of {area name: [x, y, w, h] or {\"polygon\": [[x, y], ...]} in the GUI view "
+                        "coordinates, or {\"mask\": image path}}, the areas of the tracking run by default")
+    parser.add_argument("--max", default=None, type=float, help="seconds joining two stays of the same insect")
+    parser.add_argument("--min", default=None, type=float, help="shortest stay counted, in seconds")
+    parser.add_argument("--out", default=None, help="folder of result.csv and detail.csv, the input folder by default")
+    return parser
+
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+    folder = args.path if os.path.isdir(args.path) else os.path.dirname(args.path)
+    with open(os.path.join(folder, "meta.json")) as f:
+        meta = json.load(f)
+    area_dict = meta["areas"]
+    if args.areas:
+        with open(args.areas) as f:
+            area_dict = json.load(f)
+    max_seconds = meta["max"] if args.max is None else args.max
+    min_seconds = meta["min"] if args.min is None else args.min
+
+    frames, ids, tlwhs = loadTracks(args.path)
+    time_dict = recount(frames, ids, tlwhs, area_dict, meta["width"], meta["height"], meta["fps"], max_seconds,
+                        min_seconds)
+    out = args.out or folder
+    os.makedirs(out, exist_ok=True)
+    area_count, area_time = writeCount(out, time_dict)
+    print(area_count, area_time)
+    return area_count, area_time
+
+
+if __name__ == "__main__":
+    main()
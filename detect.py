@@ -4,6 +4,10 @@ import cv2
 import matplotlib.pyplot as plt
 import time
 
+MAX_WH = 7680  # class offset for batched NMS, larger than any input side
+STRIDE = 32  # input sides must be a multiple of the largest YOLOv8 stride
+PAD_VALUE = 114  # letterbox border color, as used when training YOLOv8
+
 
 def nms(pred, conf_thres, iou_thres):
     conf = pred[..., 4] > conf_thres
@@ -72,6 +76,95 @@ def getInter(box1, box2):
     return inter
 
 
+def xywh2xyxy(boxes):
+    """Convert an (N, 4) array of center boxes (cx, cy, w, h) to corners (x1, y1, x2, y2)."""
+    xyxy = np.empty_like(boxes)
+    half_wh = boxes[:, 2:4] / 2
+    xyxy[:, :2] = boxes[:, :2] - half_wh
+    xyxy[:, 2:] = boxes[:, :2] + half_wh
+    return xyxy
+
+
+def box_iou(box, boxes, box_area, areas):
+    """IoU of one x1y1x2y2 box against an (N, 4) array of x1y1x2y2 boxes."""
+    inter_w = np.minimum(box[2], boxes[:, 2]) - np.maximum(box[0], boxes[:, 0])
+    inter_h = np.minimum(box[3], boxes[:, 3]) - np.maximum(box[1], boxes[:, 1])
+    inter = np.clip(inter_w, 0, None) * np.clip(inter_h, 0, None)
+    return inter / (box_area + areas - inter + 1e-9)
+
+
+def nms_indices(boxes, scores, iou_thres):
+    """Greedy NMS over x1y1x2y2 boxes, returns the kept indices in descending score order."""
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    order = np.argsort(-scores, kind='stable')
+    keep = []
+    while order.size > 0:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        iou = box_iou(boxes[i], boxes[rest], areas[i], areas[rest])
+        order = rest[iou <= iou_thres]
+    return np.asarray(keep, dtype=np.int64)
+
+
+def fast_nms(pred, conf_thres, iou_thres, top_k=30000, max_det=1000, backend='numpy'):
+    """Vectorized class-aware NMS, a drop-in for `nms`.
+
+    pred: (N, 5 + nc) rows of cx, cy, w, h, conf, class scores...
+    Returns an (M, 6) array of cx, cy, w, h, conf, cls sorted by confidence.
+    Boxes of different classes are shifted apart by `MAX_WH * cls` so a single
+    NMS pass never suppresses across classes.
+    """
+    box = pred[pred[:, 4] > conf_thres]
+    if len(box) == 0:
+        return np.empty((0, 6), dtype=pred.dtype)
+    if len(box) > top_k:
+        box = box[np.argpartition(-box[:, 4], top_k)[:top_k]]
+
+    conf = box[:, 4]
+    cls = np.argmax(box[:, 5:], axis=-1).astype(box.dtype)
+    xyxy = xywh2xyxy(box[:, :4]) + cls[:, None] * MAX_WH
+
+    if backend == 'cv2':
+        tlwh = xyxy.copy()
+        tlwh[:, 2:] -= tlwh[:, :2]
+        keep = cv2.dnn.NMSBoxes(tlwh.tolist(), conf.tolist(), conf_thres, iou_thres)
+        keep = np.asarray(keep, dtype=np.int64).reshape(-1)
+    elif backend == 'numpy':
+        keep = nms_indices(xyxy, conf, iou_thres)
+    else:
+        raise ValueError("Error: Unknown NMS backend:" + backend)
+    keep = keep[:max_det]
+
+    output = np.empty((len(keep), 6), dtype=box.dtype)
+    output[:, :5] = box[keep, :5]
+    output[:, 5] = cls[keep]
+    return output
+
+
+def detection_agreement(reference, outputs, iou_thres=0.5):
+    """F1 of the detections of `outputs` against those of `reference`, both per frame `predict` results.
+
+    Boxes of the same class are paired one to one by IoU, a pair counts above `iou_thres`.
+    Frames without detections on both sides agree, so identical results give 1.
+    """
+    from tracker.matching import linear_assignment
+
+    matched = total = 0
+    for ref, out in zip(reference, outputs):
+        ref = np.empty((0, 6)) if ref is None else ref
+        out = np.empty((0, 6)) if out is None else out
+        total += len(ref) + len(out)
+        if not len(ref) or not len(out):
+            continue
+        areas = (out[:, 2] - out[:, 0]) * (out[:, 3] - out[:, 1])
+        iou = np.stack([box_iou(box, out[:, :4], (box[2] - box[0]) * (box[3] - box[1]), areas) for box in ref])
+        iou[ref[:, 5][:, None] != out[:, 5][None, :]] = 0
+        matches, _, _ = linear_assignment(1 - iou, thresh=1 - iou_thres)
+        matched += len(matches)
+    return 2 * matched / total if total else 1.0
+
+
 def draw(img, xscale, yscale, pred, fps):
     img_ = img.copy()
     if len(pred):
@@ -85,35 +178,125 @@ def draw(img, xscale, yscale, pred, fps):
     return img_
 
 
-def predict(model, image):
-    height, width = 1280, 1280
-    x_scale = image.shape[1] / width
-    y_scale = image.shape[0] / height
-    img = image / 255.
-    img = cv2.resize(img, (width, height))
-    img = np.transpose(img, (2, 0, 1))
-    data = np.expand_dims(img, axis=0)
-    input_name = model.get_inputs()[0].name
-    label_name = model.get_outputs()[0].name
-    pred = model.run([label_name], {input_name: data.astype(np.float32)})[0]
-    pred = np.squeeze(pred)
-    pred = np.transpose(pred, (1, 0))
-    pred_class = pred[..., 4:]
-    pred_conf = np.max(pred_class, axis=-1)
-    pred = np.insert(pred, 4, pred_conf, axis=-1)
-    result = nms(pred, 0.3, 0.45)  # confidence threshold & iou threshold
-
-    new_result = []
-    for detect in result:
-        detect = [
-            int((detect[0] - detect[2] / 2) * x_scale),
-            int((detect[1] - detect[3] / 2) * y_scale),
-            int((detect[0] + detect[2] / 2) * x_scale),
-            int((detect[1] + detect[3] / 2) * y_scale), detect[4], detect[5]
-        ]
-        new_result.append(detect)
-    new_result = np.array(new_result)
-    # print(result)
+def model_input_size(model, default=1280):
+    """(height, width) declared by the session's input, or `default` for dynamic axes."""
+    shape = model.get_inputs()[0].shape
+    if len(shape) == 4 and isinstance(shape[2], int) and isinstance(shape[3], int):
+        return shape[2], shape[3]
+    return default, default
+
+
+class Detector(object):
+    """An onnxruntime session plus the per-session state `predict` needs every frame.
+
+    Input/output names are looked up once, and frames are letterboxed as uint8 and
+    then normalized straight into a float32 NCHW buffer that is reused across frames.
+    The input size follows the model's declared shape; `imgsz` only applies to models
+    exported with dynamic height/width. Likewise `batch_size` frames go through one
+    session run only if the batch axis is dynamic, otherwise the declared batch is used.
+    """
+
+    def __init__(self, model, imgsz=None, conf_thres=0.3, iou_thres=0.45, nms_backend='numpy', batch_size=1):
+        self.model = model
+        self.input_name = model.get_inputs()[0].name
+        self.output_name = model.get_outputs()[0].name
+        self.conf_thres = conf_thres
+        self.iou_thres = iou_thres
+        self.nms_backend = nms_backend
+
+        shape = model.get_inputs()[0].shape
+        if not imgsz:
+            self.height, self.width = model_input_size(model)
+        elif isinstance(shape[2], int) and isinstance(shape[3], int):
+            self.height, self.width = shape[2], shape[3]
+            if imgsz != self.height or imgsz != self.width:
+                print(f'Warning: model input is fixed to {self.width}x{self.height}, ignore input size {imgsz}')
+        else:
+            imgsz = int(np.ceil(imgsz / STRIDE) * STRIDE)
+            self.height, self.width = imgsz, imgsz
+
+        self.dynamic_batch = not isinstance(shape[0], int)
+        if self.dynamic_batch:
+            self.batch_size = max(1, batch_size)
+        else:
+            self.batch_size = shape[0]
+            if batch_size > 1 and batch_size != self.batch_size:
+                print(f'Warning: model batch is fixed to {self.batch_size}, ignore batch size {batch_size}')
+
+        self.padded = np.full((self.height, self.width, 3), PAD_VALUE, dtype=np.uint8)
+        self.planes = [np.empty((self.height, self.width), dtype=np.uint8) for _ in range(3)]
+        self.blob = np.empty((self.batch_size, 3, self.height, self.width), dtype=np.float32)
+        self.frame_shape = None
+
+    def letterbox(self, image):
+        """Resize keeping aspect ratio into the center of the padded canvas."""
+        if image.shape[:2] != self.frame_shape:
+            # the layout only changes with the frame size, so it is computed once per source
+            self.frame_shape = image.shape[:2]
+            self.ratio = min(self.height / image.shape[0], self.width / image.shape[1])
+            new_w = int(round(image.shape[1] * self.ratio))
+            new_h = int(round(image.shape[0] * self.ratio))
+            self.pad = (int(round((self.width - new_w) / 2 - 0.1)), int(round((self.height - new_h) / 2 - 0.1)))
+            self.resized = np.empty((new_h, new_w, 3), dtype=np.uint8)
+            self.padded[:] = PAD_VALUE
+        cv2.resize(image, (self.resized.shape[1], self.resized.shape[0]), dst=self.resized)
+        left, top = self.pad
+        self.padded[top:top + self.resized.shape[0], left:left + self.resized.shape[1]] = self.resized
+        return self.padded
+
+    def preprocess(self, image, index=0):
+        padded = self.letterbox(image)
+        # HWC -> CHW through contiguous uint8 planes, then scale each plane into the blob
+        cv2.split(padded, self.planes)
+        for plane, channel in zip(self.planes, self.blob[index]):
+            np.multiply(plane, np.float32(1 / 255.), out=channel, dtype=np.float32)
+        return self.blob
+
+    def postprocess(self, pred, shape, ratio, pad):
+        """Filter, NMS and map boxes from the letterboxed input back onto the frame."""
+        pred = pred.T  # (anchors, 4 + nc) view
+        pred_conf = np.max(pred[:, 4:], axis=-1)
+        keep = pred_conf > self.conf_thres
+        pred = np.insert(pred[keep], 4, pred_conf[keep], axis=-1)
+        result = fast_nms(pred, self.conf_thres, self.iou_thres, backend=self.nms_backend)
+
+        xyxy = xywh2xyxy(result[:, :4])
+        xyxy -= pad * 2
+        xyxy /= ratio
+        np.clip(xyxy[:, 0::2], 0, shape[1], out=xyxy[:, 0::2])
+        np.clip(xyxy[:, 1::2], 0, shape[0], out=xyxy[:, 1::2])
+
+        new_result = np.empty((len(result), 6))
+        new_result[:, :4] = np.trunc(xyxy)
+        new_result[:, 4:] = result[:, 4:]
+        return new_result
+
+    def predict(self, image):
+        return self.predict_batch([image])[0]
+
+    def predict_batch(self, images):
+        """Detect on a list of frames, `batch_size` frames per session run, in order."""
+        results = []
+        for start in range(0, len(images), self.batch_size):
+            batch = images[start:start + self.batch_size]
+            layouts = []
+            for index, image in enumerate(batch):
+                self.preprocess(image, index)
+                layouts.append((self.ratio, self.pad))
+            # a fixed batch axis always gets the full blob, stale slots are simply ignored
+            data = self.blob[:len(batch)] if self.dynamic_batch else self.blob
+            pred = self.model.run([self.output_name], {self.input_name: data})[0]
+            for image, image_pred, (ratio, pad) in zip(batch, pred, layouts):
+                results.append(self.postprocess(image_pred, image.shape, ratio, pad))
+        return results
+
+
+def predict(model, image, conf_thres=0.3, iou_thres=0.45, nms_backend='numpy', imgsz=None):
+    # a bare session works too, but only a long-lived Detector keeps its buffers between frames
+    if not isinstance(model, Detector):
+        model = Detector(model, imgsz, conf_thres, iou_thres, nms_backend)
+    new_result = model.predict(image)
+    # print(new_result)
 
     # ret_img = draw(img0, x_scale, y_scale, new_result)
     # ret_img = ret_img[:, :, ::-1]
@@ -151,7 +334,7 @@ def detect_and_display(model):
 if __name__ == "__main__":
 
     onnx_model_path = r"models\cockroach\best.onnx"
-    sess = onnxruntime.InferenceSession(onnx_model_path)
+    sess = Detector(onnxruntime.InferenceSession(onnx_model_path))
 
     # image_path = r"cockroach_112.jpg"
     # img0 = cv2.imread(image_path)
@@ -0,0 +1,590 @@
+import os
+import json
+import time
+import cv2
+import argparse
+
+from detect import Detector, predict
+from pipeline import Pipeline
+from cache import DetectionCache, DEFAULT_CACHE_DIR, video_digest, model_digest
+from checkpoint import save_checkpoint, load_checkpoint, remove_checkpoint
+from tracker.basetrack import BaseTrack
+from tracker.bot_sort import BoTSORT
+from tracker.array_bot_sort import ArrayBoTSORT
+from tracker.tracking_utils.io import ResultWriter
+from tracker.visualize import plot_tracking
+
+from count import InsectCount
+from zones import zone_spec
+from sessions import load_session, load_host_profile
+
+TRACKERS = {"object": BoTSORT, "array": ArrayBoTSORT}
+
+
+def make_parser():
+    parser = argparse.ArgumentParser("BoT-SORT Demo!")
+    # parser.add_argument("demo", default="webcam", help="demo type, eg. image, video and webcam")
+    parser.add_argument("-expn", "--experiment-name", type=str, default=None)
+    parser.add_argument("-n", "--name", type=str, default=None, help="model name")
+    parser.add_argument("--path", default="", help="path to images or video")
+    parser.add_argument("--camid", type=int, default=0, help="webcam demo camera id")
+    parser.add_argument("--save_result",
+                        action="store_true",
+                        help="whether to save the inference result of image/video")
+    parser.add_argument("-f", "--exp_file", default=None, type=str, help="pls input your expriment description file")
+    parser.add_argument("-c", "--ckpt", default=None, type=str, help="ckpt for eval")
+    parser.add_argument("--device", default="gpu", type=str, help="device to run our model, can either be cpu or gpu")
+    parser.add_argument("--conf", default=None, type=float, help="test conf")
+    parser.add_argument("--nms", default=None, type=float, help="test nms threshold")
+    parser.add_argument("--nms-backend",
+                        dest="nms_backend",
+                        default="numpy",
+                        type=str,
+                        help="nms implementation: numpy | cv2")
+    parser.add_argument("--tsize",
+                        default=None,
+                        type=int,
+                        help="inference size (e.g. 640/960/1280) for models with dynamic input, "
+                        "default follows the model input shape")
+    parser.add_argument("--fps", default=30, type=int, help="frame rate (fps)")
+    parser.add_argument("--det-cache",
+                        dest="det_cache",
+                        default=DEFAULT_CACHE_DIR,
+                        type=str,
+                        help="folder caching the detections of analysed videos, empty to disable")
+    parser.add_argument("--save-npy",
+                        dest="save_npy",
+                        default=False,
+                        action="store_true",
+                        help="also save the tracking results as .npy chunks for fast reloading")
+    parser.add_argument("--bin-seconds",
+                        dest="bin_seconds",
+                        default=60,
+                        type=float,
+                        help="length of the time bins the counts are written in while tracking")
+    parser.add_argument("--bin-format",
+                        dest="bin_format",
+                        default="csv",
+                        choices=["csv", "sqlite"],
+                        help="bins.csv appended to as bins finish, or bins.db, a SQLite database in WAL mode")
+    parser.add_argument("--checkpoint-every",
+                        dest="checkpoint_every",
+                        default=9000,
+                        type=int,
+                        help="frames between the checkpoints an interrupted video run resumes from, 0 to disable")
+    parser.add_argument("--resume",
+                        default=None,
+                        type=str,
+                        help="save folder of an interrupted video run to go on with from its last checkpoint")
+    parser.add_argument("--save-dir",
+                        dest="save_dir",
+                        default=None,
+                        type=str,
+                        help="result folder of a video run, by default a folder named after the start time next to the video")
+    parser.add_argument("--no-video",
+                        dest="no_video",
+                        default=False,
+                        action="store_true",
+                        help="do not write the annotated video of a video run")
+    parser.add_argument("--session-profile",
+                        dest="session_profile",
+                        default=None,
+                        type=str,
+                        help="onnxruntime session options: default | single-thread | parallel | low-memory | "
+                        "no-optimization, or a json file of them, see sessions.py; "
+                        "by default the profile autotune.py tuned for this machine")
+    parser.add_argument("--segments",
+                        default=1,
+                        type=int,
+                        help="time segments a video is split into and tracked in parallel processes, "
+                        "their tracks are stitched afterwards, 1 tracks it in one go")
+    parser.add_argument("--segment-overlap",
+                        dest="segment_overlap",
+                        default=60,
+                        type=int,
+                        help="frames every segment runs into the next one, the tracks are stitched over them")
+    parser.add_argument("--realtime",
+                        default=False,
+                        action="store_true",
+                        help="camera tracking always takes the newest frame and skips the ones it cannot keep up with")
+    parser.add_argument("--queue-size",
+                        dest="queue_size",
+                        default=4,
+                        type=int,
+                        help="batches buffered between the video processing stages")
+    parser.add_argument("--batch",
+                        default=1,
+                        type=int,
+                        help="frames per inference call for video processing, "
+                        "only used by models with a dynamic batch axis")
+    parser.add_argument("--fp16",
+                        dest="fp16",
+                        default=False,
+                        action="store_true",
+                        help="Adopting mix precision evaluating.")
+    parser.add_argument("--fuse", dest="fuse", default=False, action="store_true", help="Fuse conv and bn for testing.")
+    parser.add_argument("--trt",
+                        dest="trt",
+                        default=False,
+                        action="store_true",
+                        help="Using TensorRT model for testing.")
+
+    # tracking args
+    parser.add_argument("--track_high_thresh", type=float, default=0.1, help="tracking confidence threshold")
+    parser.add_argument("--track_low_thresh", default=0.05, type=float, help="lowest detection threshold")
+    parser.add_argument("--new_track_thresh", default=0.8, type=float, help="new track thresh")
+    parser.add_argument("--track_buffer", type=int, default=360, help="the frames for keep lost tracks")
+    parser.add_argument("--match_thresh", type=float, default=0.99, help="matching threshold for tracking")
+    parser.add_argument(
+        "--aspect_ratio_thresh",
+        type=float,
+        default=10,  # 1.6
+        help="threshold for filtering out boxes of which aspect ratio are above the given value.")
+    parser.add_argument('--min_box_area', type=float, default=10, help='filter out tiny boxes')
+    parser.add_argument("--fuse-score",
+                        dest="fuse_score",
+                        default=False,
+                        action="store_true",
+                        help="fuse score and iou for association")
+
+    # CMC
+    parser.add_argument("--cmc-method",
+                        default="sparseOptFlow",
+                        type=str,
+                        help="cmc method: files (Vidstab GMC) | orb | ecc")
+
+    # tracker backend and removed track history
+    parser.add_argument("--tracker-backend",
+                        dest="tracker_backend",
+                        default="object",
+                        choices=["object", "array"],
+                        help="object keeps one STrack per track, array keeps the live tracks in NumPy arrays")
+    parser.add_argument("--removed-max-count",
+                        dest="removed_max_count",
+                        default=1000,
+                        type=int,
+                        help="removed tracks kept in memory, older ones are dropped")
+    parser.add_argument("--removed-max-age",
+                        dest="removed_max_age",
+                        default=None,
+                        type=int,
+                        help="frames a removed track is kept in memory, unlimited by default")
+    parser.add_argument("--removed-spill",
+                        dest="removed_spill",
+                        default=None,
+                        type=str,
+                        help="csv file the final state of dropped removed tracks is appended to")
+
+    # ReID
+    parser.add_argument("--with-reid", dest="with_reid", default=False, action="store_true", help="test mot20.")
+    parser.add_argument("--fast-reid-config",
+                        dest="fast_reid_config",
+                        default=r"fast_reid/configs/MOT17/sbs_S50.yml",
+                        type=str,
+                        help="reid config file path")
+    parser.add_argument("--fast-reid-weights",
+                        dest="fast_reid_weights",
+                        default=r"pretrained/mot17_sbs_S50.pth",
+                        type=str,
+                        help="reid config file path")
+    parser.add_argument('--proximity_thresh',
+                        type=float,
+                        default=0.5,
+                        help='threshold for rejecting low overlap reid matches')
+    parser.add_argument('--appearance_thresh',
+                        type=float,
+                        default=0.25,
+                        help='threshold for rejecting low appearance similarity reid matches')
+    # what autotune.py found fastest on this machine, the command line and the GUI settings still win
+    parser.set_defaults(**load_host_profile().get("settings", {}))
+    return parser
+
+
+def track_args(settings, argv=None):
+    # the command line, `argv` or the GUI's own, with the GUI settings on top
+    args = make_parser().parse_args(argv)
+    args.ablation = False
+    args.mot20 = not args.fuse_score
+    vars(args).update(settings)
+    return args
+
+
+def online_targets(targets, args):
+    # the tracks kept for the results and the counts, tiny and very elongated boxes are dropped
+    online_tlwhs = []
+    online_ids = []
+    online_scores = []
+    for t in targets:
+        tlwh = t.tlwh
+        tid = t.track_id
+        vertical = tlwh[2] / tlwh[3] > args.aspect_ratio_thresh
+        if tlwh[2] * tlwh[3] > args.min_box_area and not vertical:
+            online_tlwhs.append(tlwh)
+            online_ids.append(tid)
+            online_scores.append(t.score)
+    return online_tlwhs, online_ids, online_scores
+
+
+def open_video_at(video_path, frame):
+    """Capture of a video whose next read is `frame`, a backend that cannot seek reads its way there."""
+    cap = cv2.VideoCapture(video_path)
+    if frame:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, frame)
+        if int(cap.get(cv2.CAP_PROP_POS_FRAMES)) != frame:
+            cap.release()
+            cap = cv2.VideoCapture(video_path)
+            for _ in range(frame):
+                if not cap.grab():
+                    raise ValueError(f"Error: the video ends before frame {frame}")
+    return cap
+
+
+def make_result_writer(save_path, args, resume=None):
+    npy_dir = os.path.join(save_path, "tracks_npy") if args.save_npy else None
+    return ResultWriter(os.path.join(save_path, "tracks.txt"), npy_dir, resume=resume)
+
+
+def make_count(area_dict, save_path, width, height, fps, max, min, args):
+    # counts go to the bins file of the save folder as the run goes, none without one
+    bins_path = None
+    if save_path:
+        bins_path = os.path.join(save_path, "bins.db" if args.bin_format == "sqlite" else "bins.csv")
+    return InsectCount(area_dict, width, height, fps, max, min, bins_path=bins_path, bin_seconds=args.bin_seconds)
+
+
+def write_track_meta(save_path, width, height, fps, area_dict, max, min, video=None):
+    # what count.py needs to recount tracks.txt with other areas later
+    meta = {
+        "video": video,
+        "width": width,
+        "height": height,
+        "fps": fps,
+        "areas": {name: zone_spec(value) for name, value in area_dict.items()},
+        "max": max,
+        "min": min,
+    }
+    with open(os.path.join(save_path, "meta.json"), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+
+class StreamEngine(object):
+    """Detection, tracking and counting of a live source, one frame at a time.
+
+    Results and counts go to `save_path` as the frames come, nothing is saved without one.
+    """
+
+    def __init__(self, model, area_dict, max, min, width, height, fps, settings, save_path=None, argv=None):
+        self.args = track_args(settings, argv)
+        self.fps = fps
+        self.save_path = save_path
+        self.frame_id = -1  # of the last frame seen, the first frame is frame 0
+        self.tracker_step = 0  # frames since the last tracker update
+        self.detector = Detector(model, self.args.tsize, nms_backend=self.args.nms_backend)
+        self.tracker = TRACKERS[self.args.tracker_backend](self.args, frame_rate=fps)
+        self.result_writer = None
+        if save_path:
+            self.result_writer = make_result_writer(save_path, self.args)
+            write_track_meta(save_path, width, height, fps, area_dict, max, min)
+        self.count = make_count(area_dict, save_path, width, height, fps, max, min, self.args)
+
+    def trackImage(self, image, frame_step=1):
+        """Online (tlwhs, ids) of the next frame, None without detections, `frame_step` frames after the last one.
+
+        The tracker and the count start on the first frame whatever its step, `frame_id`
+        is the index of the frame once this returns.
+        """
+        frame_step = frame_step if self.frame_id >= 0 else 1
+        self.frame_id += frame_step
+        self.tracker_step += frame_step
+        if self.frame_id:
+            # the count clock follows the frames, those without detections too
+            self.count.update(frame_step)
+        output = predict(self.detector, image)
+        if output is None:
+            return None
+        online_tlwhs, online_ids, online_scores = online_targets(
+            self.tracker.update(output, image, self.tracker_step), self.args)
+        self.tracker_step = 0
+        self.count.countFrame(online_tlwhs, online_ids, frame_step)
+        if self.result_writer is not None:
+            self.result_writer.add(self.frame_id, online_tlwhs, online_ids, online_scores)
+        return online_tlwhs, online_ids
+
+    def saveCount(self):
+        # the last frame lasts one frame, as the last one of a video
+        self.count.update(1)
+        return self.count.save(self.save_path, self.fps)
+
+    def close(self):
+        self.tracker.close()
+        if self.result_writer is not None:
+            self.result_writer.close()
+            self.result_writer = None
+
+
+class VideoEngine(object):
+    """Detection, tracking and counting of a video file into a result folder.
+
+    `progress(frame, total)` is called as frames are done and `stop` ends the run
+    early, from any thread. A run with --resume goes on from the checkpoint of an
+    interrupted one with its settings, areas and state.
+    """
+
+    def __init__(self, model, video_path, area_dict, max, min, settings, argv=None, progress=None):
+        self.source_path = video_path
+        self.progress = progress
+        self.running = 1
+        self.completed = False
+        self.frame_id = 0
+        self.model = model
+        self.args = track_args(settings, argv)
+        checkpoint = None
+        if self.args.resume:
+            # a resumed run goes on with the settings, areas and state of the interrupted one
+            resume = self.args.resume
+            checkpoint = load_checkpoint(resume)
+            self.args = checkpoint["args"]
+            self.args.resume = resume
+        self.detector = Detector(model, self.args.tsize, nms_backend=self.args.nms_backend, batch_size=self.args.batch)
+
+        self.openVideo()
+        self.digests = None
+        if self.args.checkpoint_every > 0 or checkpoint is not None:
+            self.digests = {"video": video_digest(video_path), "model": model_digest(model)}
+        self.cache = None
+        if self.args.det_cache:
+            self.cache = DetectionCache(self.args.det_cache, video_path, model, self.detector)
+
+        if checkpoint is None:
+            self.start_frame = 0
+            self.tracker = TRACKERS[self.args.tracker_backend](self.args, frame_rate=self.fps)
+
+            self.save_path = self.args.save_dir
+            if not self.save_path:
+                self.save_path = os.path.join(os.path.split(video_path)[0],
+                                              time.strftime("%Y_%m_%d_%H_%M_%S", time.localtime()))
+            os.makedirs(self.save_path, exist_ok=True)
+            write_track_meta(self.save_path, self.width, self.height, self.fps, area_dict, max, min,
+                             video=os.path.basename(video_path))
+            video_name = "video.avi"
+        else:
+            if checkpoint["digests"] != self.digests:
+                print('Warning: the video or the model changed since the checkpoint, the results will not match')
+            self.start_frame = self.frame_id = checkpoint["frame"]
+            self.seekVideo(self.start_frame)
+            self.tracker = checkpoint["tracker"]
+            BaseTrack._count = checkpoint["track_count"]
+            self.save_path = self.args.resume
+            if self.cache is not None and not self.cache.hit:
+                # the detections before the checkpoint are missing, this run cannot fill the cache
+                self.cache.close(complete=False)
+                self.cache = None
+            # an MJPG avi cannot be appended to, the annotated video goes on in a file of its own
+            video_name = f"video_{self.start_frame:06d}.avi"
+        self.vid_writer = None
+        if self.args.segments <= 1 and not self.args.no_video:
+            # segments are tracked without rendering, the stitched ids only exist once all are done
+            self.vid_writer = cv2.VideoWriter(os.path.join(self.save_path, video_name),
+                                              cv2.VideoWriter_fourcc(*"MJPG"), self.fps,
+                                              (int(self.width), int(self.height)))
+        self.result_writer = make_result_writer(self.save_path, self.args,
+                                                checkpoint["results"] if checkpoint else None)
+
+        # count
+        if checkpoint is None:
+            self.video_count = make_count(area_dict, self.save_path, self.width, self.height, self.fps, max, min,
+                                          self.args)
+        else:
+            self.video_count = checkpoint["count"]
+
+    def stop(self):
+        self.running = 0
+
+    def openVideo(self):
+        self.cap = cv2.VideoCapture(self.source_path)
+        self.width = self.cap.get(cv2.CAP_PROP_FRAME_WIDTH)
+        self.height = self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
+        self.fps = self.cap.get(cv2.CAP_PROP_FPS)
+        self.tot_frame = self.cap.get(cv2.CAP_PROP_FRAME_COUNT)
+
+    def seekVideo(self, frame):
+        self.cap.release()
+        self.cap = open_video_at(self.source_path, frame)
+
+    def saveCheckpoint(self, frame):
+        # called by the track stage between batches, so the tracker and the counts are exactly at `frame`
+        save_checkpoint(
+            self.save_path, {
+                "frame": frame,
+                "digests": self.digests,
+                "args": self.args,
+                "track_count": BaseTrack._count,
+                "tracker": self.tracker,
+                "count": self.video_count,
+                "results": self.result_writer.sync(),
+            })
+
+    def decodeFrames(self):
+        # pipeline source: batches of (first frame id, frames) until the end or a stop
+        frame_id = self.start_frame
+        while self.running:
+            images = []
+            while len(images) < self.detector.batch_size:
+                flag, image = self.cap.read()
+                if not flag:
+                    break
+                images.append(image)
+            if not images:
+                # end of stream, even if CAP_PROP_FRAME_COUNT over-estimated the length
+                break
+            yield frame_id, images
+            frame_id += len(images)
+
+    def inferFrames(self, item):
+        frame_id, images = item
+        if self.cache is not None and self.cache.hit:
+            outputs = [self.cache.get(frame_id + i) for i in range(len(images))]
+            if all(output is not None for output in outputs):
+                return frame_id, images, outputs
+        outputs = self.detector.predict_batch(images)
+        if self.cache is not None and not self.cache.hit:
+            self.cache.add(outputs)
+        return frame_id, images, outputs
+
+    def trackFrame(self, frame_id, image, output):
+        online_tlwhs = []
+        online_ids = []
+        if output is not None:
+            online_tlwhs, online_ids, online_scores = online_targets(self.tracker.update(output, image), self.args)
+            self.video_count.countFrame(online_tlwhs, online_ids)
+            self.result_writer.add(frame_id, online_tlwhs, online_ids, online_scores)
+            self.video_count.update()
+        return online_tlwhs, online_ids
+
+    def trackFrames(self, item):
+        # a single tracker thread, so BoTSORT sees the frames in order
+        frame_id, images, outputs = item
+        online = [self.trackFrame(frame_id + i, image, output) for i, (image, output) in enumerate(zip(images, outputs))]
+        every = self.args.checkpoint_every
+        if every > 0 and (frame_id + len(images)) // every > frame_id // every:
+            self.saveCheckpoint(frame_id + len(images))
+        return frame_id, images, online
+
+    def renderFrames(self, item):
+        frame_id, images, online = item
+        for image, (online_tlwhs, online_ids) in zip(images, online):
+            self.frame_id = frame_id + 1
+            if self.vid_writer is not None:
+                fps = (self.frame_id - self.start_frame) / (time.time() - self.start_time)
+                online_im = plot_tracking(image, online_tlwhs, online_ids, frame_id=self.frame_id, fps=fps)
+                self.vid_writer.write(online_im)
+            if self.progress is not None:
+                self.progress(self.frame_id, self.tot_frame)
+            frame_id += 1
+
+    def finishTrack(self):
+        self.running = 0
+        self.model = None
+        self.detector = None
+        self.tracker.close()
+        if self.vid_writer is not None:
+            self.vid_writer.release()
+        self.result_writer.close()
+
+        num, time = self.video_count.save(self.save_path, self.fps)
+        if self.completed:
+            # a stopped run keeps its checkpoint and can be resumed later
+            remove_checkpoint(self.save_path)
+        return num, time
+
+    def runSegments(self):
+        # the video is cut into args.segments pieces tracked side by side in worker processes
+        from parallel import track_parallel, replay
+
+        self.cap.release()
+        self.start_time = time.time()
+        progress = None
+        if self.progress is not None:
+            progress = lambda done: self.progress(done, self.tot_frame)
+        rows, frames, report = track_parallel(self.model,
+                                              self.source_path,
+                                              self.save_path,
+                                              self.args,
+                                              self.tot_frame,
+                                              self.fps,
+                                              progress=progress,
+                                              stopped=lambda: not self.running)
+        replay(rows, frames, self.video_count, self.result_writer)
+        self.frame_id = frames
+        self.completed = bool(self.running)
+        if self.cache is not None:
+            self.cache.close(complete=False)
+        return report + f"\ntotal {time.time() - self.start_time:.2f}s"
+
+    def runPipeline(self):
+        # decode -> inference -> track -> render/encode, each stage in its own thread
+        self.pipeline = Pipeline(self.args.queue_size)
+        self.pipeline.add("decode", self.decodeFrames)
+        self.pipeline.add("inference", self.inferFrames)
+        self.pipeline.add("track", self.trackFrames)
+        self.pipeline.add("render", self.renderFrames)
+        self.start_time = time.time()
+        try:
+            self.pipeline.run()
+        finally:
+            self.completed = bool(self.running) and self.pipeline.error is None
+            if self.cache is not None:
+                # only detections of a video read to the end are kept
+                self.cache.close(complete=self.completed)
+        return self.pipeline.report()
+
+    def run(self):
+        """Tracks the video to its end or to a stop, returns the count and the time of every area."""
+        report = self.runSegments() if self.args.segments > 1 else self.runPipeline()
+        print(report)
+        with open(os.path.join(self.save_path, "timing.txt"), 'w') as f:
+            f.write(report + "\n")
+        return self.finishTrack()
+
+
+def make_cli_parser():
+    parser = make_parser()
+    parser.description = "Tracks the insects of a video and counts them in areas, without the GUI."
+    parser.add_argument("video", help="video file to track")
+    parser.add_argument("--model", required=True, help="onnx detection model")
+    parser.add_argument("--areas",
+                        required=True,
+                        help="json file of the areas, {name: [x, y, w, h] | {\"polygon\": ...} | {\"mask\": ...}}, "
+                        "or the meta.json of an earlier run")
+    parser.add_argument("--max", type=float, default=None, help="max detection interval (s)")
+    parser.add_argument("--min", type=float, default=None, help="min continuous detection time (s)")
+    return parser
+
+
+def main(argv=None):
+    args = make_cli_parser().parse_args(argv)
+    with open(args.areas) as f:
+        areas = json.load(f)
+    if "areas" in areas:
+        # meta.json of an earlier run, its max and min unless given
+        args.max = areas["max"] if args.max is None else args.max
+        args.min = areas["min"] if args.min is None else args.min
+        areas = areas["areas"]
+    if args.max is None or args.min is None:
+        raise ValueError("Error: --max and --min are needed unless --areas is the meta.json of a run")
+    settings = {key: value for key, value in vars(args).items() if key not in ("video", "model", "areas", "max", "min")}
+
+    def progress(frame, total):
+        if frame % 1000 == 0:
+            print(f"{frame}/{int(total)} frames")
+
+    model = load_session(args.model, args.session_profile)
+    engine = VideoEngine(model, args.video, areas, args.max, args.min, settings, argv=[], progress=progress)
+    num, area_time = engine.run()
+    for area_name in num:
+        print(f"{area_name}: {num[area_name]} insects, {area_time[area_name]:.2f}s")
+    print(f"results in {engine.save_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,28 @@
 import sys
 import os
-import onnxruntime
+import multiprocessing
 
 from PyCameraList.camera_device import list_video_devices
 
 from PyQt5 import QtWidgets, QtCore
 from PyQt5.QtCore import Qt, QSize, QUrl, QTime, QSizeF
-from PyQt5.QtGui import QPixmap, QCursor, QMouseEvent, QPen, QColor
-from PyQt5.QtWidgets import QApplication, QFrame, QSlider, QGraphicsScene, QHeaderView, QTableWidgetItem, QTableWidget
+from PyQt5.QtGui import QPixmap, QCursor, QMouseEvent, QPen, QColor, QPolygon, QPolygonF
+from PyQt5.QtWidgets import (QApplication, QFrame, QSlider, QGraphicsScene, QHeaderView, QTableWidgetItem, QTableWidget,
+                             QWidget, QGridLayout, QLabel, QAbstractItemView)
 from PyQt5.QtMultimedia import QMediaPlayer, QMediaContent
 from PyQt5.QtMultimediaWidgets import QGraphicsVideoItem
 
 from qfluentwidgets import (NavigationItemPosition, MessageBox, isDarkTheme, setTheme, Theme, setThemeColor,
-                            StateToolTip, InfoBar, InfoBarPosition, MessageBox)
+                            StateToolTip, InfoBar, InfoBarPosition, MessageBox, ComboBox,
+                            SwitchButton, SpinBox, PushButton, LineEdit, TableWidget)
 from qfluentwidgets import FluentIcon as FIF
 from qframelesswindow import FramelessWindow, StandardTitleBar
 
 from Insect import Ui_MainWindow
-from track import OpenCamera, VideoProcess
+from track import OpenCamera, VideoProcess, BatchProcess
+from batch import make_job, assign_folders
+from sessions import SessionManager, PROFILES
+from checkpoint import find_checkpoint
 
 import frozen_dir
 
@@ -41,6 +46,9 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow, FramelessWindow):
     video_frame_signal = QtCore.pyqtSignal(int, int)
     finish_video_signal = QtCore.pyqtSignal(dict, dict)
     finish_camera_signal = QtCore.pyqtSignal(dict, dict)
+    job_progress_signal = QtCore.pyqtSignal(int, int, int)
+    job_finish_signal = QtCore.pyqtSignal(int, dict)
+    finish_batch_signal = QtCore.pyqtSignal(int, int)
 
     def __init__(self):
         super().__init__()
@@ -48,6 +56,10 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow, FramelessWindow):
         the part of mainwindow
         '''
         self.setupUi(self)
+        # models load once and in the background, tracking switches reuse the sessions
+        self.sessions = SessionManager()
+        self.settingInit()
+        self.queueInit()
         self.setTitleBar(StandardTitleBar(self))
         # use dark theme mode
         # setTheme(Theme.DARK)
@@ -69,6 +81,12 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow, FramelessWindow):
         the part of track
         '''
         self.trackSettingInit()
+        self.modelLineEdit.textChanged.connect(self.preloadModel)
+        self.videoModelLineEdit.textChanged.connect(self.preloadModel)
+
+    def preloadModel(self, model_path):
+        if model_path.endswith(".onnx") and os.path.isfile(model_path):
+            self.sessions.preload(model_path, self.trackSettings().get('session_profile'))
 
     def cameraInit(self):
         # tip
@@ -99,6 +117,223 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow, FramelessWindow):
         self.cameraLabel.setStyleSheet(
             'border-width: 1px;border-style: solid;border-color: rgb(0, 0, 0);background-color: rgb(255, 255, 255);')
 
+    def settingInit(self):
+        # inference settings shared by the camera and video pages
+        self.settingPage = QWidget()
+        self.settingPage.setObjectName("settingPage")
+        self.settingLayout = QGridLayout(self.settingPage)
+        self.settingLayout.setAlignment(Qt.AlignTop)
+
+        self.inputSizeLabel = QLabel("Inference Size:", self.settingPage)
+        self.settingLayout.addWidget(self.inputSizeLabel, 0, 0, 1, 1)
+        self.inputSizeBox = ComboBox(self.settingPage)
+        self.inputSizeBox.addItems(['Auto', '640', '960', '1280'])
+        self.inputSizeBox.setCurrentIndex(0)
+        self.inputSizeBox.setToolTip("Auto follows the autotune profile of this computer or the model input shape; "
+                                     "smaller sizes run faster but less accurate")
+        self.settingLayout.addWidget(self.inputSizeBox, 0, 1, 1, 1)
+
+        self.batchSizeLabel = QLabel("Video Batch Size:", self.settingPage)
+        self.settingLayout.addWidget(self.batchSizeLabel, 1, 0, 1, 1)
+        self.batchSizeBox = ComboBox(self.settingPage)
+        self.batchSizeBox.addItems(['Auto', '1', '2', '4', '8', '16'])
+        self.batchSizeBox.setCurrentIndex(0)
+        self.batchSizeBox.setToolTip("Frames per inference call, needs a model exported with a dynamic batch axis; "
+                                     "Auto follows the autotune profile of this computer or 1")
+        self.settingLayout.addWidget(self.batchSizeBox, 1, 1, 1, 1)
+
+        self.realtimeLabel = QLabel("Real-time Camera:", self.settingPage)
+        self.settingLayout.addWidget(self.realtimeLabel, 2, 0, 1, 1)
+        self.realtimeSwitchButton = SwitchButton(self.settingPage)
+        self.realtimeSwitchButton.setToolTip("Track the newest camera frame and skip the ones that cannot be kept up with")
+        self.settingLayout.addWidget(self.realtimeSwitchButton, 2, 1, 1, 1)
+
+        self.trackerLabel = QLabel("Tracker Backend:", self.settingPage)
+        self.settingLayout.addWidget(self.trackerLabel, 3, 0, 1, 1)
+        self.trackerBox = ComboBox(self.settingPage)
+        self.trackerBox.addItems(['Object', 'Array'])
+        self.trackerBox.setCurrentIndex(0)
+        self.trackerBox.setToolTip("Array keeps the live tracks in NumPy arrays, faster with many insects, no ReID")
+        self.settingLayout.addWidget(self.trackerBox, 3, 1, 1, 1)
+
+        self.npyLabel = QLabel("Save .npy Results:", self.settingPage)
+        self.settingLayout.addWidget(self.npyLabel, 4, 0, 1, 1)
+        self.npySwitchButton = SwitchButton(self.settingPage)
+        self.npySwitchButton.setToolTip("Also save the tracks as NumPy chunks next to tracks.txt for fast reloading")
+        self.settingLayout.addWidget(self.npySwitchButton, 4, 1, 1, 1)
+
+        self.cacheLabel = QLabel("Detection Cache:", self.settingPage)
+        self.settingLayout.addWidget(self.cacheLabel, 5, 0, 1, 1)
+        self.cacheSwitchButton = SwitchButton(self.settingPage)
+        self.cacheSwitchButton.setChecked(True)
+        self.cacheSwitchButton.setToolTip("Reuse the detections of a video analysed before with the same model and input size")
+        self.settingLayout.addWidget(self.cacheSwitchButton, 5, 1, 1, 1)
+
+        self.segmentsLabel = QLabel("Parallel Segments:", self.settingPage)
+        self.settingLayout.addWidget(self.segmentsLabel, 6, 0, 1, 1)
+        self.segmentsBox = ComboBox(self.settingPage)
+        self.segmentsBox.addItems(['Off', '2', '4', '8', '16'])
+        self.segmentsBox.setCurrentIndex(0)
+        self.segmentsBox.setToolTip("Track pieces of a video in parallel processes and stitch the tracks, "
+                                    "no annotated video is written")
+        self.settingLayout.addWidget(self.segmentsBox, 6, 1, 1, 1)
+
+        self.sessionProfileLabel = QLabel("Session Profile:", self.settingPage)
+        self.settingLayout.addWidget(self.sessionProfileLabel, 7, 0, 1, 1)
+        self.sessionProfileBox = ComboBox(self.settingPage)
+        self.sessionProfileBox.addItems(['Auto'] + list(PROFILES))
+        self.sessionProfileBox.setCurrentIndex(0)
+        self.sessionProfileBox.setToolTip("ONNX Runtime threads, graph optimization and memory options of the model; "
+                                          "Auto follows the autotune profile of this computer or default")
+        self.settingLayout.addWidget(self.sessionProfileBox, 7, 1, 1, 1)
+
+        self.stackedWidget.addWidget(self.settingPage)
+
+    def queueInit(self):
+        # batch queue of videos, tracked with the model, areas and settings of the video page
+        self.queuePage = QWidget()
+        self.queuePage.setObjectName("queuePage")
+        self.queueLayout = QGridLayout(self.queuePage)
+
+        self.queueAddButton = PushButton("Add Videos", self.queuePage)
+        self.queueLayout.addWidget(self.queueAddButton, 0, 0, 1, 1)
+        self.queueRemoveButton = PushButton("Remove", self.queuePage)
+        self.queueLayout.addWidget(self.queueRemoveButton, 0, 1, 1, 1)
+        self.queueClearButton = PushButton("Clear", self.queuePage)
+        self.queueLayout.addWidget(self.queueClearButton, 0, 2, 1, 1)
+        self.queueWorkersLabel = QLabel("Parallel Videos:", self.queuePage)
+        self.queueLayout.addWidget(self.queueWorkersLabel, 0, 3, 1, 1)
+        self.queueWorkersBox = SpinBox(self.queuePage)
+        self.queueWorkersBox.setRange(1, max(os.cpu_count() or 1, 1))
+        self.queueWorkersBox.setValue(1)
+        self.queueWorkersBox.setToolTip("Videos tracked at the same time, each in its own process")
+        self.queueLayout.addWidget(self.queueWorkersBox, 0, 4, 1, 1)
+
+        self.queueOutputEdit = LineEdit(self.queuePage)
+        self.queueOutputEdit.setClearButtonEnabled(True)
+        self.queueOutputEdit.setPlaceholderText("Select the folder the results of the queue are saved in")
+        self.queueLayout.addWidget(self.queueOutputEdit, 1, 0, 1, 3)
+        self.queueOutputButton = PushButton("Choose Folder", self.queuePage)
+        self.queueLayout.addWidget(self.queueOutputButton, 1, 3, 1, 1)
+        self.queueStartButton = PushButton("Start Queue", self.queuePage)
+        self.queueLayout.addWidget(self.queueStartButton, 1, 4, 1, 1)
+
+        self.queueTableWidget = TableWidget(self.queuePage)
+        self.queueTableWidget.setColumnCount(4)
+        self.queueTableWidget.setHorizontalHeaderLabels(["Video", "Status", "Progress", "Result"])
+        self.queueTableWidget.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
+        self.queueTableWidget.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.queueTableWidget.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.queueLayout.addWidget(self.queueTableWidget, 2, 0, 1, 5)
+
+        self.queueAddButton.clicked.connect(self.addQueueVideos)
+        self.queueRemoveButton.clicked.connect(self.removeQueueVideos)
+        self.queueClearButton.clicked.connect(self.clearQueueVideos)
+        self.queueOutputButton.clicked.connect(self.setQueueOutputPath)
+        self.queueStartButton.clicked.connect(self.queueSwitch)
+        self.job_progress_signal.connect(self.updateQueueProgress)
+        self.job_finish_signal.connect(self.finishQueueJob)
+        self.finish_batch_signal.connect(self.finishQueue)
+        self.batch_thread = BatchProcess(self.job_progress_signal, self.job_finish_signal, self.finish_batch_signal)
+
+        self.stackedWidget.addWidget(self.queuePage)
+
+    def addQueueVideos(self):
+        video_paths, video_type = QtWidgets.QFileDialog.getOpenFileNames(None, "Choose videos", "./")
+        for video_path in video_paths:
+            row = self.queueTableWidget.rowCount()
+            self.queueTableWidget.insertRow(row)
+            self.queueTableWidget.setItem(row, 0, QTableWidgetItem(video_path))
+            self.queueTableWidget.setItem(row, 1, QTableWidgetItem("waiting"))
+        if not self.queueOutputEdit.text() and video_paths:
+            self.queueOutputEdit.setText(os.path.join(os.path.dirname(video_paths[0]), "batch"))
+
+    def removeQueueVideos(self):
+        if self.batch_thread.track:
+            return
+        for row in sorted({index.row() for index in self.queueTableWidget.selectedIndexes()}, reverse=True):
+            self.queueTableWidget.removeRow(row)
+
+    def clearQueueVideos(self):
+        if not self.batch_thread.track:
+            self.queueTableWidget.setRowCount(0)
+
+    def setQueueOutputPath(self):
+        folder_path = QtWidgets.QFileDialog.getExistingDirectory(None, "Choose the result folder", "./")
+        if folder_path:
+            self.queueOutputEdit.setText(folder_path)
+
+    def queueSwitch(self):
+        if self.batch_thread.track:
+            self.batch_thread.stopBatch()
+            self.queueStartButton.setEnabled(False)
+            self.queueStartButton.setText("Stopping...")
+            return
+        videos = [self.queueTableWidget.item(row, 0).text() for row in range(self.queueTableWidget.rowCount())]
+        if not videos or not os.path.exists(self.videoModelLineEdit.text()) or not self.queueOutputEdit.text():
+            InfoBar.warning(title="WARNING!",
+                            content="Add videos, choose the result folder and the model of the Video page first.",
+                            orient=Qt.Horizontal,
+                            isClosable=True,
+                            position=InfoBarPosition.TOP_RIGHT,
+                            duration=2000,
+                            parent=self)
+            return
+        settings = self.trackSettings()
+        jobs = [
+            make_job(video, self.videoModelLineEdit.text(), self.video_area_dict, self.maxSpinBox.value(),
+                     self.minSpinBox.value(), settings) for video in videos
+        ]
+        assign_folders(jobs, self.queueOutputEdit.text())
+        for row in range(len(videos)):
+            self.queueTableWidget.setItem(row, 1, QTableWidgetItem("waiting"))
+            self.queueTableWidget.setItem(row, 2, QTableWidgetItem(""))
+        self.queueStartButton.setText("Stop Queue")
+        self.batch_thread.startBatch(jobs, self.queueOutputEdit.text(), self.queueWorkersBox.value())
+
+    def updateQueueProgress(self, index, frame, tot_frame):
+        self.queueTableWidget.setItem(index, 1, QTableWidgetItem("tracking"))
+        self.queueTableWidget.setItem(index, 2, QTableWidgetItem('%.2f%%' % (100 * (frame / max(tot_frame, 1)))))
+
+    def finishQueueJob(self, index, record):
+        self.queueTableWidget.setItem(index, 1, QTableWidgetItem(record["status"]))
+        if record["status"] == "done":
+            self.queueTableWidget.setItem(index, 2, QTableWidgetItem("100.00%"))
+        result = record.get("error") or ", ".join(f"{area}: {num}" for area, num in record.get("num", {}).items())
+        self.queueTableWidget.setItem(index, 3, QTableWidgetItem(result))
+
+    def finishQueue(self, done, total):
+        self.queueStartButton.setEnabled(True)
+        self.queueStartButton.setText("Start Queue")
+        InfoBar.success(title="Queue finished!",
+                        content=f"{done}/{total} videos tracked, the summary is in summary.csv.",
+                        orient=Qt.Horizontal,
+                        isClosable=True,
+                        position=InfoBarPosition.TOP_RIGHT,
+                        duration=2000,
+                        parent=self)
+
+    def trackSettings(self):
+        # only overrides what is set in the GUI, the rest keeps the command line values
+        settings = {}
+        if self.inputSizeBox.currentIndex() > 0:
+            settings['tsize'] = int(self.inputSizeBox.currentText())
+        if self.batchSizeBox.currentIndex() > 0:
+            settings['batch'] = int(self.batchSizeBox.currentText())
+        if self.realtimeSwitchButton.isChecked():
+            settings['realtime'] = True
+        if self.trackerBox.currentIndex() > 0:
+            settings['tracker_backend'] = self.trackerBox.currentText().lower()
+        if self.npySwitchButton.isChecked():
+            settings['save_npy'] = True
+        if not self.cacheSwitchButton.isChecked():
+            settings['det_cache'] = ''
+        if self.segmentsBox.currentIndex() > 0:
+            settings['segments'] = int(self.segmentsBox.currentText())
+        if self.sessionProfileBox.currentIndex() > 0:
+            settings['session_profile'] = self.sessionProfileBox.currentText()
+        return settings
+
     def trackSettingInit(self):
         # track switch setting
         self.trackSwitchButton.checkedChanged.connect(self.trackSwitchChanged)
@@ -133,9 +368,11 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow, FramelessWindow):
         self.add_camera_event = False
         self.show_camera_rect = True
         self.camera_temp_rect = None
+        self.camera_polygon = []
         self.camera_area_dict = {}
 
         self.cameraLabel.installEventFilter(self)
+        self.cameraLabel.setMouseTracking(True)
 
         self.addAreaButton.clicked.connect(self.addCameraArea)
         self.deleteAreaButton.clicked.connect(self.deleteCameraArea)
@@ -226,6 +463,7 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow, FramelessWindow):
         self.maxSpinBox.setSingleStep(0.5)
 
         self.temp_rect = None
+        self.polygon = []
         self.add_event = False
         self.show_rect = True
         self.video_area_dict = {}
@@ -260,7 +498,32 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow, FramelessWindow):
             self.show_camera_rect = True
             self.showAreaButton.setText("Hide")
             for values in self.camera_area_dict.values():
-                self.cameraLabel.addRect(values[-1][0], values[-1][1], values[-1][2], values[-1][3], values[-1][4])
+                if isinstance(values[-1][0], QPolygon):
+                    self.cameraLabel.addPolygon(values[-1][0], values[-1][1])
+                else:
+                    self.cameraLabel.addRect(values[-1][0], values[-1][1], values[-1][2], values[-1][3],
+                                             values[-1][4])
+
+    def finishCameraArea(self, value):
+        # value is [x, y, w, h, item] for a rectangle, [{"polygon": points}, item] for a polygon
+        self.camera_area_dict['Area_' + str(len(self.camera_area_dict) + 1)] = value
+        self.areaTableWidget.setRowCount(self.areaTableWidget.rowCount() + 1)
+        self.areaTableWidget.setItem(
+            len(self.camera_area_dict) - 1, 0, QTableWidgetItem(list(self.camera_area_dict.keys())[-1]))
+        # for i in range(2):
+        #     self.areaTableWidget.setItem(
+        #         len(self.camera_area_dict) - 1, i + 1,
+        #         QTableWidgetItem(str(list(self.camera_area_dict.values())[-1][i])))
+
+        self.camera_area.clear()
+        self.camera_polygon = []
+        self.camera_temp_rect = None
+        self.add_camera_event = False
+        self.graphicsView.setCursor(QCursor(Qt.ArrowCursor))
+
+        self.deleteAreaButton.setEnabled(True)
+        self.showAreaButton.setEnabled(True)
+        self.areaTableWidget.selectRow(-1)
 
     def addVideoArea(self):
         self.graphicsView.setCursor(QCursor(Qt.CrossCursor))
@@ -289,50 +552,76 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow, FramelessWindow):
             for values in self.video_area_dict.values():
                 self.scene.addItem(values[-1])
 
+    def finishVideoArea(self, value):
+        # value is [x, y, w, h, item] for a rectangle, [{"polygon": points}, item] for a polygon
+        self.video_area_dict['Area_' + str(len(self.video_area_dict) + 1)] = value
+        self.areaVideoTableWidget.setRowCount(self.areaVideoTableWidget.rowCount() + 1)
+        self.areaVideoTableWidget.setItem(
+            len(self.video_area_dict) - 1, 0, QTableWidgetItem(list(self.video_area_dict.keys())[-1]))
+        # for i in range(2):
+        #     self.areaVideoTableWidget.setItem(
+        #         len(self.video_area_dict) - 1, i + 1,
+        #         QTableWidgetItem(str(list(self.video_area_dict.values())[-1][i])))
+
+        self.area.clear()
+        self.polygon = []
+        self.temp_rect = None
+        self.add_event = False
+        self.graphicsView.setCursor(QCursor(Qt.ArrowCursor))
+
+        self.deleteVideoAreaButton.setEnabled(True)
+        self.showVideoAreaButton.setEnabled(True)
+        self.areaVideoTableWidget.selectRow(-1)
+
     def eventFilter(self, obj, event):
         '''
         camera
         '''
+        # a drag draws a rectangle, a click starts a polygon, every next click adds a vertex
+        # and a right click or a click on the first vertex closes it
         # click event
         if obj == self.cameraLabel and event.type() == QMouseEvent.MouseButtonPress and self.add_camera_event:
             mouse_event = event
-            if mouse_event.button() == Qt.LeftButton:
+            if mouse_event.button() == Qt.LeftButton and not self.camera_polygon:
                 label_pos = self.cameraLabel.mapFromGlobal(mouse_event.globalPos())
                 self.camera_area.append(label_pos)
         # click release
         if obj == self.cameraLabel and event.type() == QMouseEvent.MouseButtonRelease and self.add_camera_event:
             mouse_event = event
-            if mouse_event.button() == Qt.LeftButton:
-                label_pos = self.cameraLabel.mapFromGlobal(mouse_event.globalPos())
+            label_pos = self.cameraLabel.mapFromGlobal(mouse_event.globalPos())
+            if self.camera_polygon:
+                closing = mouse_event.button() == Qt.RightButton or (label_pos -
+                                                                     self.camera_polygon[0]).manhattanLength() < 8
+                if closing and len(self.camera_polygon) >= 3:
+                    if self.camera_temp_rect != None:
+                        self.cameraLabel.removeItem(self.camera_temp_rect)
+                    polygon_item = self.cameraLabel.addPolygon(self.camera_polygon,
+                                                               QPen(QCOLOR_LIST[(len(self.camera_area_dict)) % 6]))
+                    self.finishCameraArea([{
+                        "polygon": [[point.x(), point.y()] for point in self.camera_polygon]
+                    }, polygon_item])
+                elif mouse_event.button() == Qt.LeftButton and not closing:
+                    self.camera_polygon.append(label_pos)
+            elif mouse_event.button() == Qt.LeftButton and len(self.camera_area) == 1:
                 self.camera_area.append(label_pos)
-                self.cameraLabel.removeItem(self.camera_temp_rect)
-                rect_item = self.cameraLabel.addRect(min(self.camera_area[0].x(), self.camera_area[1].x()),
-                                                     min(self.camera_area[0].y(), self.camera_area[1].y()),
-                                                     abs(self.camera_area[0].x() - self.camera_area[1].x()),
-                                                     abs(self.camera_area[0].y() - self.camera_area[1].y()),
-                                                     QPen(QCOLOR_LIST[(len(self.camera_area_dict)) % 6]))
-                self.camera_area_dict['Area_' + str(len(self.camera_area_dict) + 1)] = [
-                    min(self.camera_area[0].x(), self.camera_area[1].x()),
-                    min(self.camera_area[0].y(), self.camera_area[1].y()),
-                    abs(self.camera_area[0].x() - self.camera_area[1].x()),
-                    abs(self.camera_area[0].y() - self.camera_area[1].y()), rect_item
-                ]
-                self.areaTableWidget.setRowCount(self.areaTableWidget.rowCount() + 1)
-                self.areaTableWidget.setItem(
-                    len(self.camera_area_dict) - 1, 0, QTableWidgetItem(list(self.camera_area_dict.keys())[-1]))
-                # for i in range(2):
-                #     self.areaTableWidget.setItem(
-                #         len(self.camera_area_dict) - 1, i + 1,
-                #         QTableWidgetItem(str(list(self.camera_area_dict.values())[-1][i])))
-
-                self.camera_area.clear()
-                self.camera_temp_rect = None
-                self.add_camera_event = False
-                self.graphicsView.setCursor(QCursor(Qt.ArrowCursor))
-
-                self.deleteAreaButton.setEnabled(True)
-                self.showAreaButton.setEnabled(True)
-                self.areaTableWidget.selectRow(-1)
+                if self.camera_temp_rect != None:
+                    self.cameraLabel.removeItem(self.camera_temp_rect)
+                    self.camera_temp_rect = None
+                if (self.camera_area[0] - self.camera_area[1]).manhattanLength() < 3:
+                    self.camera_polygon = [self.camera_area[0]]
+                    self.camera_area.clear()
+                else:
+                    rect_item = self.cameraLabel.addRect(min(self.camera_area[0].x(), self.camera_area[1].x()),
+                                                         min(self.camera_area[0].y(), self.camera_area[1].y()),
+                                                         abs(self.camera_area[0].x() - self.camera_area[1].x()),
+                                                         abs(self.camera_area[0].y() - self.camera_area[1].y()),
+                                                         QPen(QCOLOR_LIST[(len(self.camera_area_dict)) % 6]))
+                    self.finishCameraArea([
+                        min(self.camera_area[0].x(), self.camera_area[1].x()),
+                        min(self.camera_area[0].y(), self.camera_area[1].y()),
+                        abs(self.camera_area[0].x() - self.camera_area[1].x()),
+                        abs(self.camera_area[0].y() - self.camera_area[1].y()), rect_item
+                    ])
 
         # move event
         if obj == self.cameraLabel and event.type() == QMouseEvent.MouseMove and self.add_camera_event and len(
@@ -346,49 +635,58 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow, FramelessWindow):
                                                              abs(self.camera_area[0].x() - label_pos.x()),
                                                              abs(self.camera_area[0].y() - label_pos.y()),
                                                              QPen(QCOLOR_LIST[(len(self.camera_area_dict)) % 6]))
+        if obj == self.cameraLabel and event.type() == QMouseEvent.MouseMove and self.add_camera_event and len(
+                self.camera_polygon) > 0:
+            if self.camera_temp_rect != None:
+                self.cameraLabel.removeItem(self.camera_temp_rect)
+            label_pos = self.cameraLabel.mapFromGlobal(event.globalPos())
+            self.camera_temp_rect = self.cameraLabel.addPolygon(self.camera_polygon + [label_pos],
+                                                                QPen(QCOLOR_LIST[(len(self.camera_area_dict)) % 6]))
         '''
         video
         '''
         # click event
         if obj == self.scene and event.type() == QMouseEvent.GraphicsSceneMousePress and self.add_event:
             mouse_event = event
-            if mouse_event.button() == Qt.LeftButton:
+            if mouse_event.button() == Qt.LeftButton and not self.polygon:
                 scene_pos = mouse_event.scenePos()
                 self.area.append(scene_pos)
         # click release
         if obj == self.scene and event.type() == QMouseEvent.GraphicsSceneMouseRelease and self.add_event:
             mouse_event = event
-            if mouse_event.button() == Qt.LeftButton:
-                scene_pos = mouse_event.scenePos()
+            scene_pos = mouse_event.scenePos()
+            if self.polygon:
+                closing = mouse_event.button() == Qt.RightButton or (scene_pos - self.polygon[0]).manhattanLength() < 8
+                if closing and len(self.polygon) >= 3:
+                    if self.temp_rect != None:
+                        self.scene.removeItem(self.temp_rect)
+                    polygon_item = self.scene.addPolygon(QPolygonF(self.polygon),
+                                                         QPen(QCOLOR_LIST[(len(self.video_area_dict)) % 6]))
+                    self.finishVideoArea([{
+                        "polygon": [[point.x(), point.y()] for point in self.polygon]
+                    }, polygon_item])
+                elif mouse_event.button() == Qt.LeftButton and not closing:
+                    self.polygon.append(scene_pos)
+            elif mouse_event.button() == Qt.LeftButton and len(self.area) == 1:
                 self.area.append(scene_pos)
-                self.scene.removeItem(self.temp_rect)
-                rect_item = self.scene.addRect(min(self.area[0].x(), self.area[1].x()),
-                                               min(self.area[0].y(), self.area[1].y()),
-                                               abs(self.area[0].x() - self.area[1].x()),
-                                               abs(self.area[0].y() - self.area[1].y()),
-                                               QPen(QCOLOR_LIST[(len(self.video_area_dict)) % 6]))
-                self.video_area_dict['Area_' + str(len(self.video_area_dict) + 1)] = [
-                    min(self.area[0].x(), self.area[1].x()),
-                    min(self.area[0].y(), self.area[1].y()),
-                    abs(self.area[0].x() - self.area[1].x()),
-                    abs(self.area[0].y() - self.area[1].y()), rect_item
-                ]
-                self.areaVideoTableWidget.setRowCount(self.areaVideoTableWidget.rowCount() + 1)
-                self.areaVideoTableWidget.setItem(
-                    len(self.video_area_dict) - 1, 0, QTableWidgetItem(list(self.video_area_dict.keys())[-1]))
-                # for i in range(2):
-                #     self.areaVideoTableWidget.setItem(
-                #         len(self.video_area_dict) - 1, i + 1,
-                #         QTableWidgetItem(str(list(self.video_area_dict.values())[-1][i])))
-
-                self.area.clear()
-                self.temp_rect = None
-                self.add_event = False
-                self.graphicsView.setCursor(QCursor(Qt.ArrowCursor))
-
-                self.deleteVideoAreaButton.setEnabled(True)
-                self.showVideoAreaButton.setEnabled(True)
-                self.areaVideoTableWidget.selectRow(-1)
+                if self.temp_rect != None:
+                    self.scene.removeItem(self.temp_rect)
+                    self.temp_rect = None
+                if (self.area[0] - self.area[1]).manhattanLength() < 3:
+                    self.polygon = [self.area[0]]
+                    self.area.clear()
+                else:
+                    rect_item = self.scene.addRect(min(self.area[0].x(), self.area[1].x()),
+                                                   min(self.area[0].y(), self.area[1].y()),
+                                                   abs(self.area[0].x() - self.area[1].x()),
+                                                   abs(self.area[0].y() - self.area[1].y()),
+                                                   QPen(QCOLOR_LIST[(len(self.video_area_dict)) % 6]))
+                    self.finishVideoArea([
+                        min(self.area[0].x(), self.area[1].x()),
+                        min(self.area[0].y(), self.area[1].y()),
+                        abs(self.area[0].x() - self.area[1].x()),
+                        abs(self.area[0].y() - self.area[1].y()), rect_item
+                    ])
         # move event
         if obj == self.scene and event.type() == QMouseEvent.GraphicsSceneMouseMove and self.add_event and len(
                 self.area) == 1:
@@ -401,6 +699,12 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow, FramelessWindow):
                                                 abs(self.area[0].x() - scene_pos.x()),
                                                 abs(self.area[0].y() - scene_pos.y()),
                                                 QPen(QCOLOR_LIST[(len(self.video_area_dict)) % 6]))
+        if obj == self.scene and event.type() == QMouseEvent.GraphicsSceneMouseMove and self.add_event and len(
+                self.polygon) > 0:
+            if self.temp_rect != None:
+                self.scene.removeItem(self.temp_rect)
+            self.temp_rect = self.scene.addPolygon(QPolygonF(self.polygon + [event.scenePos()]),
+                                                   QPen(QCOLOR_LIST[(len(self.video_area_dict)) % 6]))
 
         return super().eventFilter(obj, event)
 
@@ -532,9 +836,18 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow, FramelessWindow):
     def videoTrack(self, ischecked: bool):
         if os.path.exists(self.videoModelLineEdit.text()) and os.path.exists(self.videoChoosePathEdit.text()):
             if ischecked:
-                model = onnxruntime.InferenceSession(self.videoModelLineEdit.text())
+                settings = self.trackSettings()
+                resume = find_checkpoint(self.videoChoosePathEdit.text())
+                if resume is not None:
+                    title = "Resume"
+                    content = ("An unfinished analysis of this video was found in " + resume +
+                               ", resume it from its last checkpoint?")
+                    w = MessageBox(title, content, self)
+                    if w.exec():
+                        settings['resume'] = resume
+                model = self.sessions.get(self.videoModelLineEdit.text(), settings.get('session_profile'))
                 self.video_thread.track_signal.emit(model, self.videoChoosePathEdit.text(), self.video_area_dict,
-                                                    self.maxSpinBox.value(), self.minSpinBox.value())
+                                                    self.maxSpinBox.value(), self.minSpinBox.value(), settings)
                 self.video_thread.start()
             else:
                 title = "Warning"
@@ -593,10 +906,12 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow, FramelessWindow):
 
     def trackSwitchChanged(self, ischecked: bool):
         if os.path.exists(self.modelLineEdit.text()):
-            model = onnxruntime.InferenceSession(self.modelLineEdit.text())
+            settings = self.trackSettings()
+            model = self.sessions.get(self.modelLineEdit.text(), settings.get('session_profile'))
             self.camera_thread.track_signal.emit(ischecked, model, self.videoSaveLineEdit.text(),
                                                  self.saveSwitchButton.isChecked(), self.camera_area_dict,
-                                                 self.maxCameraSpinBox.value(), self.minCameraSpinBox.value())
+                                                 self.maxCameraSpinBox.value(), self.minCameraSpinBox.value(),
+                                                 settings)
             if ischecked:
                 self.cameraOpenButton.setEnabled(False)
                 self.saveSwitchButton.setEnabled(False)
@@ -653,6 +968,8 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow, FramelessWindow):
     def initNavigation(self):
         self.addSubInterface(self.page_1, FIF.CAMERA, 'Camera')
         self.addSubInterface(self.page_3, FIF.VIDEO, 'Video')
+        self.addSubInterface(self.queuePage, FIF.LIBRARY, 'Queue')
+        self.addSubInterface(self.settingPage, FIF.SETTING, 'Setting', NavigationItemPosition.BOTTOM)
 
         #!IMPORTANT: don't forget to set the default route key if you enable the return button
         # qrouter.setDefaultRouteKey(self.stackWidget, self.videoInterface.objectName())
@@ -704,6 +1021,8 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow, FramelessWindow):
 
 
 if __name__ == "__main__":
+    # parallel segments run in spawned processes, which a frozen executable has to hand over
+    multiprocessing.freeze_support()
     QApplication.setHighDpiScaleFactorRoundingPolicy(Qt.HighDpiScaleFactorRoundingPolicy.PassThrough)
     QApplication.setAttribute(Qt.AA_EnableHighDpiScaling)
     QApplication.setAttribute(Qt.AA_UseHighDpiPixmaps)
@@ -0,0 +1,340 @@
+import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_EXCEPTION
+
+import cv2
+import numpy as np
+import onnxruntime
+
+from detect import Detector
+from cache import DetectionCache
+from sessions import load_session, resolve_profile, session_options
+from tracker.kalman_filter import KalmanFilter, chi2inv95
+from tracker.matching import linear_assignment
+from tracker.tracking_utils.io import RESULT_DTYPE
+from engine import TRACKERS, online_targets, open_video_at
+
+STITCH_IOU = 0.5  # mean IoU over the overlap joining two tracks
+STITCH_MIN_FRAMES = 3  # overlap frames both tracks need
+STITCH_HISTORY = 30  # last rows of a track the Kalman filter is fitted on
+
+_progress = None  # frames tracked by all workers, shared with the parent
+_stop = None
+
+
+def split_segments(num_frames, segments, overlap):
+    """(start, end) of `segments` even pieces of a video, every piece but the last runs `overlap` frames into the next.
+
+    The last piece has no end, it reads up to the end of the video whatever its frame count says.
+    """
+    bounds = np.linspace(0, num_frames, segments + 1).round().astype(int)
+    pieces = [(int(bounds[i]), int(bounds[i + 1]) + overlap) for i in range(segments - 1)]
+    return pieces + [(int(bounds[-2]), None)]
+
+
+def init_worker(progress, stop):
+    global _progress, _stop
+    _progress, _stop = progress, stop
+
+
+def track_segment(index, model_source, video_path, start, end, save_path, args, threads):
+    """Tracks frames [start, end) of a video in a worker process with its own session and tracker.
+
+    The rows go to segment_<index>.npy in the save folder with the segment's own track
+    ids, returns that path, the frame after the last one read and the seconds it took.
+    """
+    t0 = time.time()
+    if isinstance(model_source, bytes):
+        model = onnxruntime.InferenceSession(model_source, session_options(resolve_profile(args.session_profile), threads))
+    else:
+        model = load_session(model_source, args.session_profile, threads)
+    detector = Detector(model, args.tsize, nms_backend=args.nms_backend, batch_size=args.batch)
+    cache = None
+    if args.det_cache:
+        cache = DetectionCache(args.det_cache, video_path, model, detector)
+        if not cache.hit:
+            # a segment cannot fill the cache, only a whole sequential run does
+            cache.close(complete=False)
+            cache = None
+
+    cap = open_video_at(video_path, start)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    # removed tracks of all segments would be spilled to the same file at once
+    args.removed_spill = None
+    tracker = TRACKERS[args.tracker_backend](args, frame_rate=fps)
+    rows = []
+    frame_id = start
+    while (end is None or frame_id < end) and not _stop.value:
+        images = []
+        while len(images) < detector.batch_size and (end is None or frame_id + len(images) < end):
+            flag, image = cap.read()
+            if not flag:
+                break
+            images.append(image)
+        if not images:
+            break
+        outputs = [cache.get(frame_id + i) for i in range(len(images))] if cache is not None else [None]
+        if any(output is None for output in outputs):
+            outputs = detector.predict_batch(images)
+        for i, (image, output) in enumerate(zip(images, outputs)):
+            if output is None:
+                continue
+            tlwhs, ids, scores = online_targets(tracker.update(output, image), args)
+            if ids:
+                frame_rows = np.empty(len(ids), dtype=RESULT_DTYPE)
+                frame_rows['frame'] = frame_id + i
+                frame_rows['id'] = ids
+                frame_rows['x1'], frame_rows['y1'], frame_rows['w'], frame_rows['h'] = np.asarray(tlwhs).T
+                frame_rows['score'] = scores
+                rows.append(frame_rows)
+        frame_id += len(images)
+        with _progress.get_lock():
+            _progress.value += len(images)
+    cap.release()
+    tracker.close()
+
+    path = os.path.join(save_path, f"segment_{index:03d}.npy")
+    np.save(path, np.concatenate(rows) if rows else np.empty(0, dtype=RESULT_DTYPE))
+    return path, frame_id, time.time() - t0
+
+
+def box_ious(a, b):
+    """IoU of every tlwh box of `a` with every one of `b`."""
+    x0 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y0 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x1 = np.minimum(a[:, None, 0] + a[:, None, 2], b[None, :, 0] + b[None, :, 2])
+    y1 = np.minimum(a[:, None, 1] + a[:, None, 3], b[None, :, 1] + b[None, :, 3])
+    inter = np.clip(x1 - x0, 0, None) * np.clip(y1 - y0, 0, None)
+    union = a[:, None, 2] * a[:, None, 3] + b[None, :, 2] * b[None, :, 3] - inter
+    return np.where(union > 0, inter / np.maximum(union, 1e-9), 0)
+
+
+def tlwhs_of(rows):
+    return np.stack([rows['x1'], rows['y1'], rows['w'], rows['h']], axis=1)
+
+
+def match_overlap(a, b, start, end):
+    """Pairs (id in a, id in b) of the tracks both segments followed over the overlap frames [start, end)."""
+    a = a[(a['frame'] >= start) & (a['frame'] < end)]
+    b = b[(b['frame'] >= start) & (b['frame'] < end)]
+    a_ids, a_index = np.unique(a['id'], return_inverse=True)
+    b_ids, b_index = np.unique(b['id'], return_inverse=True)
+    iou_sum = np.zeros((len(a_ids), len(b_ids)))
+    common = np.zeros((len(a_ids), len(b_ids)), dtype=np.int64)
+    frames = np.intersect1d(a['frame'], b['frame'])
+    a_starts = np.searchsorted(a['frame'], frames)
+    a_ends = np.searchsorted(a['frame'], frames, side='right')
+    b_starts = np.searchsorted(b['frame'], frames)
+    b_ends = np.searchsorted(b['frame'], frames, side='right')
+    for a0, a1, b0, b1 in zip(a_starts, a_ends, b_starts, b_ends):
+        pairs = np.ix_(a_index[a0:a1], b_index[b0:b1])
+        iou_sum[pairs] += box_ious(tlwhs_of(a[a0:a1]), tlwhs_of(b[b0:b1]))
+        common[pairs] += 1
+    cost = np.where(common >= STITCH_MIN_FRAMES, 1 - iou_sum / np.maximum(common, 1), 1.)
+    matches, _, _ = linear_assignment(cost, 1 - STITCH_IOU)
+    return [(int(a_ids[i]), int(b_ids[j])) for i, j in matches]
+
+
+def track_states(kf, rows, ids):
+    """Kalman means and covariances of tracks `ids` at their last rows and the frames of those rows.
+
+    The filter is fitted on the last STITCH_HISTORY rows of every track, all tracks
+    are run together frame by frame.
+    """
+    rows = rows[np.isin(rows['id'], ids)]
+    rows = rows[np.lexsort((rows['frame'], np.searchsorted(ids, rows['id'])))]
+    index = np.searchsorted(ids, rows['id'])
+    counts = np.bincount(index, minlength=len(ids))
+    rank = np.arange(len(rows)) - (np.cumsum(counts) - counts)[index]
+    keep = rank >= counts[index] - STITCH_HISTORY
+    rows, index = rows[keep], index[keep]
+    xywhs = tlwhs_of(rows)
+    xywhs[:, :2] += xywhs[:, 2:] / 2
+    first = np.full(len(ids), np.iinfo(np.int64).max)
+    np.minimum.at(first, index, rows['frame'])
+    last = np.full(len(ids), -1)
+    np.maximum.at(last, index, rows['frame'])
+
+    means = np.zeros((len(ids), 8))
+    covariances = np.zeros((len(ids), 8, 8))
+    order = np.argsort(rows['frame'], kind='stable')
+    frames, index, xywhs = rows['frame'][order], index[order], xywhs[order]
+    starts = np.searchsorted(frames, np.arange(first.min(), last.max() + 2))
+    for step, frame in enumerate(range(first.min(), last.max() + 1)):
+        running = (first < frame) & (last >= frame)
+        if running.any():
+            means[running], covariances[running] = kf.multi_predict(means[running], covariances[running])
+        tracks, measurements = index[starts[step]:starts[step + 1]], xywhs[starts[step]:starts[step + 1]]
+        started = first[tracks] == frame
+        if started.any():
+            means[tracks[started]], covariances[tracks[started]] = kf.multi_initiate(measurements[started])
+        if (~started).any():
+            updated = tracks[~started]
+            means[updated], covariances[updated] = kf.multi_update(means[updated], covariances[updated],
+                                                                   measurements[~started])
+    return means, covariances, last
+
+
+def match_gap(a, b, a_ids, b_ids, max_gap, match_thresh):
+    """Pairs (id in a, id in b) of tracks of `a` lost before the overlap that come back as new tracks of `b`.
+
+    The Kalman filter of every lost track is run on to the first frame of every later
+    track, a pair needs to pass the Mahalanobis gate and overlap the prediction.
+    """
+    if not len(a_ids) or not len(b_ids):
+        return []
+    a_ids = np.unique(np.asarray(a_ids, dtype=np.int64))
+    kf = KalmanFilter()
+    means, covariances, last = track_states(kf, a, a_ids)
+    b_ids_all, first_rows = np.unique(b['id'], return_index=True)
+    first = b[first_rows[np.searchsorted(b_ids_all, b_ids)]]
+    tlwhs = tlwhs_of(first)
+    xywhs = tlwhs.copy()
+    xywhs[:, :2] += xywhs[:, 2:] / 2
+
+    steps = first['frame'][None, :] - last[:, None]
+    valid = (steps > 0) & (steps <= max_gap)
+    cost = np.ones((len(a_ids), len(b_ids)))
+    for step in range(1, steps[valid].max() + 1 if valid.any() else 0):
+        means, covariances = kf.multi_predict(means, covariances)
+        rows, cols = np.nonzero(valid & (steps == step))
+        if not len(rows):
+            continue
+        mean, covariance = kf.multi_project(means[rows], covariances[rows])
+        d = xywhs[cols] - mean
+        maha = np.einsum('ni,ni->n', d, np.linalg.solve(covariance, d[..., None])[..., 0])
+        predicted = mean.copy()
+        predicted[:, :2] -= predicted[:, 2:] / 2
+        ious = box_ious(predicted, tlwhs[cols])[np.arange(len(rows)), np.arange(len(rows))]
+        cost[rows, cols] = np.where(maha <= chi2inv95[4], 1 - ious, 1.)
+    matches, _, _ = linear_assignment(cost, match_thresh)
+    return [(int(a_ids[i]), int(b_ids[j])) for i, j in matches]
+
+
+def stitch(segments, rows, max_gap, match_thresh):
+    """Joins the tracks of consecutive segments into one set of ids.
+
+    `rows` holds the RESULT_DTYPE rows of every (start, end) segment with the ids of
+    its own tracker. Tracks followed by both segments over their overlap are joined by
+    their mean IoU there, then tracks lost shortly before a boundary by Kalman gating
+    with the tracks starting after it. The first segment keeps its ids, unmatched
+    tracks get new ones in order of appearance. The overlap frames go to the earlier
+    segment up to their middle and to the later one after it.
+
+    Returns the stitched rows in frame order and the (IoU, Kalman) joins of every boundary.
+    """
+    pieces = []
+    joins = []
+    previous = None
+    next_id = 1
+    for (start, end), segment in zip(segments, rows):
+        local_ids, first_rows = np.unique(segment['id'], return_index=True)
+        mapping = {}
+        if previous is None:
+            mapping = {int(i): int(i) for i in local_ids}
+        else:
+            previous_rows, previous_end = previous
+            overlap = match_overlap(previous_rows, segment, start, previous_end)
+            matched_a = {a for a, _ in overlap}
+            matched_b = {b for _, b in overlap}
+            # a track lost before the overlap and found again after it is a new track in both segments,
+            # tracks of one row were never confirmed, the tracker drops them instead of keeping them lost
+            a_last = {int(i): int(f) for i, f in zip(previous_rows['id'], previous_rows['frame'])}
+            a_ids, a_rows = np.unique(previous_rows['id'], return_counts=True)
+            a_rows = dict(zip(a_ids.tolist(), a_rows.tolist()))
+            lost = [i for i, f in sorted(a_last.items())
+                    if i not in matched_a and start - max_gap <= f < start and a_rows[i] > 1]
+            b_rows = np.bincount(np.searchsorted(local_ids, segment['id']), minlength=len(local_ids))
+            new = [int(i) for i, f, n in zip(local_ids, segment['frame'][first_rows], b_rows)
+                   if int(i) not in matched_b and f > previous_end - STITCH_MIN_FRAMES and n > 1]
+            gap = match_gap(previous_rows, segment, lost, new, max_gap, match_thresh)
+            mapping = {b: a for a, b in overlap + gap}
+            joins.append((len(overlap), len(gap)))
+
+            cut = (start + previous_end) // 2
+            pieces[-1] = pieces[-1][pieces[-1]['frame'] < cut]
+        for i in local_ids[np.argsort(first_rows, kind='stable')]:
+            if int(i) not in mapping:
+                mapping[int(i)] = next_id
+                next_id += 1
+        next_id = max([next_id] + [i + 1 for i in mapping.values()])
+
+        segment = segment.copy()
+        if len(segment):
+            keys = np.asarray(sorted(mapping), dtype=np.int64)
+            values = np.asarray([mapping[k] for k in keys], dtype=np.int64)
+            segment['id'] = values[np.searchsorted(keys, segment['id'])]
+        owned = segment if previous is None else segment[segment['frame'] >= cut]
+        pieces.append(owned)
+        previous = (segment, end)
+    return np.concatenate(pieces) if pieces else np.empty(0, dtype=RESULT_DTYPE), joins
+
+
+def replay(rows, num_frames, count, result_writer):
+    """Feeds stitched rows frame by frame to the count and the result writer, like a sequential run."""
+    starts = np.searchsorted(rows['frame'], np.arange(num_frames + 1))
+    for frame_id in range(num_frames):
+        frame_rows = rows[starts[frame_id]:starts[frame_id + 1]]
+        tlwhs = tlwhs_of(frame_rows)
+        count.countFrame(tlwhs, frame_rows['id'])
+        result_writer.add(frame_id, tlwhs, frame_rows['id'], frame_rows['score'])
+        count.update()
+
+
+def track_parallel(model, video_path, save_path, args, num_frames, fps, progress=None, stopped=None):
+    """Tracks a video in `args.segments` worker processes and stitches their tracks.
+
+    `progress(frames)` is called with the frames tracked so far while the workers run,
+    and the workers stop once `stopped()` returns True. Returns the stitched rows, the
+    frames they cover, from the first frame on with no gap, and a report.
+    """
+    model_source = model._model_bytes
+    if model_source is None:
+        # the model file, not the optimized graph a session may have been loaded from
+        model_source = getattr(model, "source_path", None) or model._model_path
+    segments = split_segments(int(num_frames), args.segments, args.segment_overlap)
+    threads = max(1, (os.cpu_count() or 1) // args.segments)
+    context = multiprocessing.get_context("spawn")
+    shared_progress = context.Value('q', 0)
+    shared_stop = context.Value('b', 0)
+    with ProcessPoolExecutor(args.segments, mp_context=context, initializer=init_worker,
+                             initargs=(shared_progress, shared_stop)) as pool:
+        futures = [
+            pool.submit(track_segment, index, model_source, video_path, start, end, save_path, args, threads)
+            for index, (start, end) in enumerate(segments)
+        ]
+        while True:
+            done, running = wait(futures, timeout=0.5, return_when=FIRST_EXCEPTION)
+            if progress is not None:
+                progress(shared_progress.value)
+            if stopped is not None and stopped():
+                shared_stop.value = 1
+            if not running or any(future.exception() for future in done):
+                break
+        results = [future.result() for future in futures]
+
+    # only the segments joining up from the first frame on are kept, the ones after a stop are not whole
+    rows = []
+    covered = 0
+    for (start, end), (path, read_end, _) in zip(segments, results):
+        rows.append(np.load(path))
+        covered = read_end
+        if end is None or read_end < end:
+            break
+    for path, _, _ in results:
+        os.remove(path)
+
+    t0 = time.time()
+    buffer = int(fps / 30.0 * args.track_buffer)
+    stitched, joins = stitch(segments[:len(rows)], rows, buffer, args.match_thresh)
+    stitched = stitched[stitched['frame'] < covered]
+    stitch_time = time.time() - t0
+
+    lines = [f"{'segment':<10}{'start':>10}{'end':>10}{'tracks':>10}{'time(s)':>10}{'IoU joins':>11}{'gap joins':>11}"]
+    for index, ((start, _), (_, read_end, seconds), segment) in enumerate(zip(segments, results, rows)):
+        iou_joins, gap_joins = joins[index - 1] if index else (0, 0)
+        lines.append(f"{index:<10}{start:>10}{read_end:>10}{len(np.unique(segment['id'])):>10}{seconds:>10.2f}"
+                     f"{iou_joins:>11}{gap_joins:>11}")
+    lines.append(f"stitched {len(np.unique(stitched['id']))} tracks over {covered} frames in {stitch_time:.2f}s")
+    return stitched, covered, "\n".join(lines)
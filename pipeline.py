@@ -0,0 +1,152 @@
+import time
+import queue
+import threading
+
+from tracker.tracking_utils.timer import Timer
+
+STOP = object()  # end-of-stream marker passed down the queues
+
+
+class Pipeline(object):
+    """A chain of worker threads connected by bounded queues.
+
+    The first stage is a generator function producing items, every following stage maps
+    one item to the next stage's item, and the last stage only consumes. Each stage runs
+    in its own thread and sees items in production order. The bounded queues give
+    backpressure: a fast stage blocks once it is `maxsize` items ahead of the next one.
+
+    `busy` timers measure the work of each stage and `idle` timers the time it waited
+    for input, so the stage with the highest busy time is the bottleneck.
+    """
+
+    def __init__(self, maxsize=4):
+        self.maxsize = maxsize
+        self.stages = []
+        self.busy = {}
+        self.idle = {}
+        self.stop_event = threading.Event()
+        self.error = None
+        self.lock = threading.Lock()
+
+    def add(self, name, func):
+        self.stages.append((name, func))
+        self.busy[name] = Timer()
+        self.idle[name] = Timer()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+
+    def fail(self, error):
+        with self.lock:
+            if self.error is None:
+                self.error = error
+        self.stop_event.set()
+
+    def source(self, name, func, outbox):
+        timer = self.busy[name]
+        try:
+            items = iter(func())
+            while not self.stop_event.is_set():
+                timer.tic()
+                item = next(items, STOP)
+                timer.toc()
+                if item is STOP:
+                    break
+                outbox.put(item)
+        except Exception as e:
+            self.fail(e)
+        finally:
+            outbox.put(STOP)
+
+    def worker(self, name, func, inbox, outbox):
+        busy, idle = self.busy[name], self.idle[name]
+        while True:
+            idle.tic()
+            item = inbox.get()
+            idle.toc()
+            if item is STOP:
+                break
+            if self.error is not None:
+                # keep draining so the upstream stages never block on a full queue
+                continue
+            try:
+                busy.tic()
+                result = func(item)
+                busy.toc()
+            except Exception as e:
+                self.fail(e)
+                continue
+            if outbox is not None:
+                outbox.put(result)
+        if outbox is not None:
+            outbox.put(STOP)
+
+    def run(self):
+        queues = [queue.Queue(self.maxsize) for _ in range(len(self.stages) - 1)]
+        (name, func) = self.stages[0]
+        threads = [threading.Thread(target=self.source, args=(name, func, queues[0]), name=name, daemon=True)]
+        for index, (name, func) in enumerate(self.stages[1:]):
+            outbox = queues[index + 1] if index + 1 < len(queues) else None
+            threads.append(
+                threading.Thread(target=self.worker, args=(name, func, queues[index], outbox), name=name, daemon=True))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def report(self):
+        lines = [f"{'stage':<12}{'calls':>8}{'busy(s)':>10}{'avg(ms)':>10}{'idle(s)':>10}"]
+        for name, _ in self.stages:
+            busy, idle = self.busy[name], self.idle[name]
+            lines.append(f"{name:<12}{busy.calls:>8}{busy.total_time:>10.2f}{busy.average_time * 1e3:>10.2f}"
+                         f"{idle.total_time:>10.2f}")
+        return "\n".join(lines)
+
+
+class LatestFrameReader(object):
+    """Reads a capture on its own thread and keeps only the newest frame.
+
+    `read` returns the freshest frame together with the number of frames the capture
+    delivered since the previous `read`, so a consumer that falls behind skips frames
+    instead of letting them queue up in the capture buffer.
+    """
+
+    def __init__(self, cap):
+        self.cap = cap
+        self.condition = threading.Condition()
+        self.frame = None
+        self.index = 0  # frames delivered by the capture so far
+        self.last_index = 0  # index of the frame returned by the previous read
+        self.timestamp = 0.
+        self.running = True
+        self.thread = threading.Thread(target=self.update, name="capture", daemon=True)
+        self.thread.start()
+
+    def update(self):
+        while self.running:
+            flag, frame = self.cap.read()
+            with self.condition:
+                if flag:
+                    self.frame = frame
+                    self.index += 1
+                    self.timestamp = time.time()
+                else:
+                    self.running = False
+                self.condition.notify_all()
+
+    def read(self, timeout=1.):
+        """Returns (flag, frame, frame_step, timestamp) like a non-blocking `cap.read`."""
+        with self.condition:
+            self.condition.wait_for(lambda: self.index > self.last_index or not self.running, timeout)
+            if self.index == self.last_index:
+                return False, None, 0, self.timestamp
+            frame_step = self.index - self.last_index
+            self.last_index = self.index
+            return True, self.frame, frame_step, self.timestamp
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
@@ -0,0 +1,194 @@
+import os
+import json
+import argparse
+import tempfile
+
+import onnx
+from onnxruntime.quantization import (CalibrationDataReader, CalibrationMethod, QuantFormat, QuantType,
+                                      quant_pre_process, quantize_dynamic, quantize_static)
+
+from autotune import sample_frames, time_detector
+from detect import Detector, detection_agreement
+from sessions import load_session
+
+CALIBRATION_METHODS = {
+    "minmax": CalibrationMethod.MinMax,
+    "entropy": CalibrationMethod.Entropy,
+    "percentile": CalibrationMethod.Percentile,
+}
+COMPUTE_OPS = ("Conv", "ConvTranspose", "MatMul", "Gemm")
+
+
+class FrameReader(CalibrationDataReader):
+    """Model inputs of video frames, letterboxed and normalized as the Detector does for inference."""
+
+    def __init__(self, model, frames, imgsz=None):
+        self.detector = Detector(model, imgsz)
+        self.frames = frames
+        self.start = 0
+
+    def get_next(self):
+        if self.start >= len(self.frames):
+            return None
+        batch = self.frames[self.start:self.start + self.detector.batch_size]
+        self.start += len(batch)
+        for index, image in enumerate(batch):
+            self.detector.preprocess(image, index)
+        # a fixed batch axis gets the full blob, like in predict_batch
+        data = self.detector.blob if not self.detector.dynamic_batch else self.detector.blob[:len(batch)]
+        return {self.detector.input_name: data.copy()}
+
+    def rewind(self):
+        self.start = 0
+
+
+def video_frames(videos, count):
+    """`count` frames spread over all the videos."""
+    frames = []
+    for index, video in enumerate(videos):
+        frames += sample_frames(video, (count - len(frames)) // (len(videos) - index))
+    return frames
+
+
+def head_nodes(model):
+    """Names of the nodes between the last convolutions and the outputs.
+
+    The YOLOv8 head decodes boxes in pixels and concatenates them with class scores
+    in 0..1, one 8-bit scale cannot hold both, so these nodes stay in float.
+    """
+    producers = {output: node for node in model.graph.node for output in node.output}
+    names = []
+    stack = [output.name for output in model.graph.output]
+    while stack:
+        node = producers.get(stack.pop())
+        if node is None or node.op_type in COMPUTE_OPS or node.name in names:
+            continue
+        names.append(node.name)
+        stack += list(node.input)
+    return names
+
+
+def prepare(model_path, work_dir):
+    """Copy of a model in `work_dir` ready to quantize: shape inferred and optimized when possible, every node named."""
+    path = os.path.join(work_dir, "prepared.onnx")
+    try:
+        quant_pre_process(model_path, path)
+    except Exception as e:
+        print(f'Warning: cannot pre-process {model_path} before quantization, quantizing it as it is: {e}')
+        path = model_path
+    model = onnx.load(path)
+    for index, node in enumerate(model.graph.node):
+        # nodes are excluded from quantization by name
+        node.name = node.name or f"{node.op_type}_{index}"
+    path = os.path.join(work_dir, "named.onnx")
+    onnx.save(model, path)
+    return path, model
+
+
+def quantize_model(model_path, output, mode="static", frames=None, imgsz=None, calibrate="minmax", per_channel=True,
+                   quantize_head=False):
+    """Writes the INT8 model of an FP32 model to `output`, static quantization calibrates on `frames`.
+
+    Static quantization writes QDQ nodes, onnxruntime fuses them into integer kernels
+    at load time. Dynamic quantization only quantizes the weights ahead, with uint8
+    weights as the integer convolution of the CPU provider needs. Either way the model
+    keeps its float input and output, so it replaces the FP32 model as it is.
+    """
+    if mode not in ("static", "dynamic"):
+        raise ValueError(f"Error: unknown quantization mode {mode}, expected static or dynamic")
+    if mode == "static" and not frames:
+        raise ValueError("Error: static quantization needs calibration frames")
+    with tempfile.TemporaryDirectory() as work_dir:
+        prepared, model = prepare(model_path, work_dir)
+        exclude = [] if quantize_head else head_nodes(model)
+        if mode == "dynamic":
+            quantize_dynamic(prepared, output, weight_type=QuantType.QUInt8, nodes_to_exclude=exclude)
+        else:
+            reader = FrameReader(load_session(prepared, "no-optimization"), frames, imgsz)
+            quantize_static(prepared,
+                            output,
+                            reader,
+                            quant_format=QuantFormat.QDQ,
+                            activation_type=QuantType.QUInt8,
+                            weight_type=QuantType.QInt8,
+                            per_channel=per_channel,
+                            calibrate_method=CALIBRATION_METHODS[calibrate],
+                            nodes_to_exclude=exclude)
+    copy_metadata(model_path, output)
+    return output
+
+
+def copy_metadata(source, target):
+    """Metadata of the exported model (names, stride, imgsz) the quantized one may have lost."""
+    metadata = onnx.load(source, load_external_data=False).metadata_props
+    model = onnx.load(target)
+    if metadata and not model.metadata_props:
+        model.metadata_props.extend(metadata)
+        onnx.save(model, target)
+
+
+def compare(fp32_path, int8_path, frames, imgsz=None, repeat=3):
+    """Detection agreement and latency per frame of the INT8 model against the FP32 one, on the same frames."""
+    report = {"frames": len(frames)}
+    outputs = {}
+    for name, path in (("fp32", fp32_path), ("int8", int8_path)):
+        detector = Detector(load_session(path), imgsz)
+        seconds, outputs[name] = time_detector(detector, frames, repeat)
+        report[name] = {
+            "model": os.path.abspath(path),
+            "size_mb": round(os.path.getsize(path) / 2**20, 2),
+            "latency_ms": round(seconds * 1e3, 3),
+        }
+    report["agreement"] = round(detection_agreement(outputs["fp32"], outputs["int8"]), 4)
+    report["speedup"] = round(report["fp32"]["latency_ms"] / report["int8"]["latency_ms"], 2)
+    return report
+
+
+def make_parser():
+    parser = argparse.ArgumentParser("InsectTrack quantize")
+    parser.add_argument("videos", nargs="+", help="videos the calibration and comparison frames are sampled from")
+    parser.add_argument("--model", required=True, help="fp32 onnx detection model")
+    parser.add_argument("--output", default=None, help="int8 model, <model>_int8.onnx by default")
+    parser.add_argument("--mode", default="static", choices=["static", "dynamic"], help="quantization of the activations")
+    parser.add_argument("--frames", type=int, default=64, help="calibration frames")
+    parser.add_argument("--eval-frames", dest="eval_frames", type=int, default=32, help="frames the models are compared on")
+    parser.add_argument("--calibrate", default="minmax", choices=list(CALIBRATION_METHODS), help="calibration method")
+    parser.add_argument("--per-tensor",
+                        dest="per_channel",
+                        default=True,
+                        action="store_false",
+                        help="one scale per weight tensor instead of one per output channel")
+    parser.add_argument("--quantize-head",
+                        dest="quantize_head",
+                        default=False,
+                        action="store_true",
+                        help="also quantize the box decoding after the last convolutions, faster but less accurate")
+    parser.add_argument("--tsize", type=int, default=None, help="inference size, by default the model's")
+    parser.add_argument("--repeat", type=int, default=3, help="passes over the frames timed, the best is kept")
+    return parser
+
+
+if __name__ == "__main__":
+    args = make_parser().parse_args()
+    output = args.output or os.path.splitext(args.model)[0] + "_int8.onnx"
+    frames = video_frames(args.videos, args.frames + args.eval_frames)
+    # calibration and comparison frames interleave, so both cover every video
+    step = len(frames) / max(1, args.eval_frames)
+    eval_ids = {int(i * step) for i in range(min(args.eval_frames, len(frames)))}
+    eval_frames = [frame for i, frame in enumerate(frames) if i in eval_ids]
+    calibration = [frame for i, frame in enumerate(frames) if i not in eval_ids] or eval_frames
+    quantize_model(args.model, output, args.mode, calibration, args.tsize, args.calibrate, args.per_channel,
+                   args.quantize_head)
+    report = compare(args.model, output, eval_frames, args.tsize, args.repeat)
+    report.update(mode=args.mode, calibration_frames=len(calibration), videos=[os.path.abspath(v) for v in args.videos])
+    print(f"{'model':>6}{'size(MB)':>10}{'latency(ms)':>13}{'fps':>8}")
+    for name in ("fp32", "int8"):
+        print(f"{name:>6}{report[name]['size_mb']:>10.2f}{report[name]['latency_ms']:>13.2f}"
+              f"{1e3 / report[name]['latency_ms']:>8.1f}")
+    print(f"speedup {report['speedup']:.2f}x, detection agreement {report['agreement']:.3f} on {report['frames']} frames")
+    if report["agreement"] < 0.9:
+        print('Warning: the int8 model detects quite differently, try more calibration frames or --calibrate entropy')
+    report_path = os.path.splitext(output)[0] + ".report.json"
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"int8 model written to {output}, report to {report_path}")
@@ -0,0 +1,240 @@
+import os
+import glob
+import json
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import onnxruntime
+
+from cache import file_digest
+from detect import Detector
+
+OPTIMIZATION_LEVELS = {
+    "disable": onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+EXECUTION_MODES = {"sequential": onnxruntime.ExecutionMode.ORT_SEQUENTIAL, "parallel": onnxruntime.ExecutionMode.ORT_PARALLEL}
+
+# onnxruntime's own defaults, 0 threads lets it pick one per physical core
+PROFILE_DEFAULTS = {
+    "intra_threads": 0,
+    "inter_threads": 0,
+    "execution": "sequential",
+    "optimization": "all",
+    "arena": True,
+    "mem_pattern": True,
+    "save_optimized": True,
+}
+HOST_PROFILE_DIR = os.path.join(os.path.expanduser("~"), ".insect_track", "hosts")
+PROFILES = {
+    "default": {},
+    "single-thread": {"intra_threads": 1, "inter_threads": 1},
+    "parallel": {"execution": "parallel", "inter_threads": 2},
+    "low-memory": {"arena": False, "mem_pattern": False},
+    "no-optimization": {"optimization": "disable", "save_optimized": False},
+}
+
+
+def host_profile_path():
+    return os.path.join(HOST_PROFILE_DIR, f"{socket.gethostname()}.json")
+
+
+def load_host_profile():
+    """The profile autotune.py wrote for this machine, {} if it was not tuned."""
+    path = host_profile_path()
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f'Warning: cannot read the host profile {path}: {e}')
+        return {}
+
+
+def save_host_profile(profile, path=None):
+    path = path or host_profile_path()
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(profile, f, indent=2)
+    return path
+
+
+def resolve_profile(profile=None):
+    """Session options of a profile, the name of a built-in one, a json file or a dict, over PROFILE_DEFAULTS.
+
+    No profile is the one tuned for this machine by autotune.py, or "default".
+    """
+    if profile is None:
+        profile = load_host_profile().get("session_profile") or "default"
+    if isinstance(profile, str):
+        if profile in PROFILES:
+            profile = PROFILES[profile]
+        elif profile.endswith(".json") and os.path.isfile(profile):
+            with open(profile) as f:
+                profile = json.load(f)
+        else:
+            raise ValueError(f"Error: unknown session profile {profile}, expected one of {', '.join(PROFILES)} "
+                             "or a json file")
+    unknown = set(profile) - set(PROFILE_DEFAULTS)
+    if unknown:
+        raise ValueError(f"Error: unknown session options {', '.join(sorted(unknown))}")
+    resolved = dict(PROFILE_DEFAULTS, **profile)
+    if resolved["optimization"] not in OPTIMIZATION_LEVELS or resolved["execution"] not in EXECUTION_MODES:
+        raise ValueError(f"Error: bad optimization or execution in session profile {profile}")
+    return resolved
+
+
+def optimized_path(model_path, level):
+    """Where the graph of a model optimized at `level` is kept, next to the model.
+
+    The name holds the onnxruntime version and a hash of the model, a replaced model
+    never finds the graph of the previous one whatever the times of the files.
+    """
+    stem = os.path.splitext(model_path)[0]
+    return f"{stem}.ort{onnxruntime.__version__}.{level}.{file_digest(model_path)[:16]}.onnx"
+
+
+def session_options(profile, threads=None):
+    """SessionOptions of a resolved profile, `threads` caps its intra-op threads, e.g. the share of one worker."""
+    options = onnxruntime.SessionOptions()
+    intra_threads = min([count for count in (profile["intra_threads"], threads) if count], default=0)
+    options.intra_op_num_threads = intra_threads
+    options.inter_op_num_threads = profile["inter_threads"]
+    options.execution_mode = EXECUTION_MODES[profile["execution"]]
+    options.graph_optimization_level = OPTIMIZATION_LEVELS[profile["optimization"]]
+    options.enable_cpu_mem_arena = profile["arena"]
+    options.enable_mem_pattern = profile["mem_pattern"]
+    return options
+
+
+def save_optimized(model_path, cached, profile, level, threads=None):
+    """Writes the graph of a model optimized at `level` to `cached`, returns the session that wrote it.
+
+    onnxruntime writes the graph as it goes, so it is written under a name of this
+    process and thread and renamed once complete: batch workers loading the same
+    model at once never read a partial file. Returns None if it cannot be written.
+    """
+    stem, ext = os.path.splitext(cached)
+    temp = f"{stem}.{os.getpid()}.{threading.get_ident()}.tmp{ext}"
+    options = session_options(dict(profile, optimization=level), threads)
+    options.optimized_model_filepath = temp
+    try:
+        session = onnxruntime.InferenceSession(model_path, options)
+        os.replace(temp, cached)
+    except Exception as e:
+        print(f'Warning: cannot save the optimized model to {cached}: {e}')
+        if os.path.exists(temp):
+            os.remove(temp)
+        return None
+    # graphs of earlier versions of the model at this level are of no use anymore
+    prefix = cached[:-len(ext)].rsplit(".", 1)[0] + "."
+    for path in glob.glob(glob.escape(prefix) + "*" + ext):
+        name = path[len(prefix):-len(ext)]
+        if path != cached and "." not in name:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    return session
+
+
+def load_session(model_path, profile=None, threads=None):
+    """InferenceSession of a model file with the options of a session profile.
+
+    With "save_optimized" the first load writes the optimized graph next to the
+    model and later loads start from it, skipping most of the graph optimization.
+    It is saved at most at the "extended" level, the layout changes of "all" are
+    specific to the CPU and are redone at every load. A saved graph that cannot be
+    loaded is removed and the model file loaded instead. `source_path` of the
+    session is the model file whatever was loaded, so the detection cache and the
+    checkpoints see the same model.
+    """
+    profile = resolve_profile(profile)
+    level = profile["optimization"]
+    saved_level = "extended" if level == "all" else level
+    session = None
+    if profile["save_optimized"] and level != "disable":
+        cached = optimized_path(model_path, saved_level)
+        if not os.path.exists(cached):
+            session = save_optimized(model_path, cached, profile, saved_level, threads)
+            if saved_level != level:
+                # that session only wrote the graph, the one used starts from it below
+                session = None
+        if session is None and os.path.exists(cached):
+            try:
+                session = onnxruntime.InferenceSession(cached, session_options(profile, threads))
+            except Exception as e:
+                print(f'Warning: cannot load the optimized model {cached}, loading {model_path}: {e}')
+                # a broken graph is saved again by the next load
+                try:
+                    os.remove(cached)
+                except OSError:
+                    pass
+    if session is None:
+        session = onnxruntime.InferenceSession(model_path, session_options(profile, threads))
+    session.source_path = model_path
+    return session
+
+
+def profile_key(profile, threads=None):
+    return json.dumps(resolve_profile(profile), sort_keys=True), threads
+
+
+def warmup(session, imgsz=None):
+    """Runs the model once on a blank frame, so the first real frame does not pay for the allocations."""
+    detector = Detector(session, imgsz)
+    detector.predict_batch([np.zeros((detector.height, detector.width, 3), dtype=np.uint8)] * detector.batch_size)
+
+
+class SessionManager(object):
+    """InferenceSessions loaded once per model file, file version and session profile.
+
+    Sessions load and warm up on a background thread, `preload` starts that as soon
+    as a model path is known and `get` waits for it. A changed model file loads
+    again and the session of its previous version is dropped. onnxruntime allows
+    concurrent `run` calls on one session, so the camera and the video threads
+    share the session of a model, each with its own Detector.
+    """
+
+    def __init__(self, max_sessions=2):
+        self.max_sessions = max_sessions
+        self.sessions = {}  # (path, mtime, profile) -> future of the warmed up session, oldest first
+        self.lock = threading.Lock()
+        self.loader = ThreadPoolExecutor(1)
+
+    def key(self, path, profile=None, threads=None):
+        path = os.path.abspath(path)
+        return path, os.path.getmtime(path), profile_key(profile, threads)
+
+    def load(self, path, profile, threads):
+        session = load_session(path, profile, threads)
+        warmup(session)
+        return session
+
+    def preload(self, path, profile=None, threads=None):
+        """Future of the session of a model, loading starts in the background unless it is cached."""
+        key = self.key(path, profile, threads)
+        with self.lock:
+            future = self.sessions.pop(key, None)
+            if future is None or (future.done() and future.exception() is not None):
+                for old in [old for old in self.sessions if old[0] == key[0] and old[1] != key[1]]:
+                    # the model file changed since this session was loaded
+                    del self.sessions[old]
+                future = self.loader.submit(self.load, path, profile, threads)
+            self.sessions[key] = future
+            while len(self.sessions) > self.max_sessions:
+                del self.sessions[next(iter(self.sessions))]
+        return future
+
+    def get(self, path, profile=None, threads=None):
+        return self.preload(path, profile, threads).result()
+
+    def close(self):
+        self.loader.shutdown(wait=False)
+        with self.lock:
+            self.sessions.clear()
@@ -0,0 +1,171 @@
+"""Synthetic models, frames, detections and count references shared by the tests and benchmark.py."""
+import numpy as np
+
+from count import InsectCount
+
+
+def write_blob_model(path, size=320):
+    """A YOLOv8-like model of one class finding bright squares: a score per 8x8 cell, a 24x24 box at its centre."""
+    import onnx
+    from onnx import TensorProto, helper, numpy_helper
+
+    cells = size // 8
+    ys, xs = np.meshgrid(np.arange(cells), np.arange(cells), indexing='ij')
+    grid = np.stack([xs * 8 + 4, ys * 8 + 4, np.full_like(xs, 24), np.full_like(xs, 24)])[None].astype(np.float32)
+    nodes = [
+        helper.make_node('Conv', ['images', 'W', 'B'], ['c'], kernel_shape=[8, 8], strides=[8, 8]),
+        helper.make_node('Sigmoid', ['c'], ['conf']),
+        helper.make_node('Mul', ['conf', 'zero'], ['z']),
+        helper.make_node('Add', ['z', 'grid'], ['boxes']),
+        helper.make_node('Concat', ['boxes', 'conf'], ['cat'], axis=1),
+        helper.make_node('Reshape', ['cat', 'shape'], ['output0']),
+    ]
+    initializers = [
+        numpy_helper.from_array(np.full((1, 3, 8, 8), 20.0 / 192, np.float32), 'W'),
+        numpy_helper.from_array(np.array([-10.0], np.float32), 'B'),
+        numpy_helper.from_array(np.zeros(1, np.float32), 'zero'),
+        numpy_helper.from_array(grid, 'grid'),
+        numpy_helper.from_array(np.array([0, 5, -1], np.int64), 'shape'),
+    ]
+    graph = helper.make_graph(nodes, 'blob', [helper.make_tensor_value_info('images', TensorProto.FLOAT,
+                                                                           ['batch', 3, size, size])],
+                              [helper.make_tensor_value_info('output0', TensorProto.FLOAT, None)], initializers)
+    onnx.save(helper.make_model(graph, opset_imports=[helper.make_opsetid('', 13)], ir_version=8), path)
+    return path
+
+
+def square_frame(x, y, width=640, height=480, side=20):
+    """A black frame with a white square at (x, y)."""
+    image = np.zeros((height, width, 3), dtype=np.uint8)
+    image[int(y):int(y) + side, int(x):int(x) + side] = 255
+    return image
+
+
+def write_square_video(path, num_frames, num_squares=8, width=640, height=480, seed=1):
+    """An MJPG video of white squares bouncing on a black background."""
+    import cv2
+
+    rng = np.random.default_rng(seed)
+    position = rng.uniform([20, 20], [width - 40, height - 40], (num_squares, 2))
+    velocity = rng.uniform(-3, 3, (num_squares, 2))
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), 30, (width, height))
+    for _ in range(num_frames):
+        position += velocity
+        bounce = (position < 5) | (position > (width - 30, height - 30))
+        velocity[bounce] *= -1
+        image = np.zeros((height, width, 3), dtype=np.uint8)
+        for x, y in position.astype(int):
+            image[y:y + 20, x:x + 20] = 255
+        writer.write(image)
+    writer.release()
+    return path
+
+
+def stream_detections(num_targets, num_frames, size=1280, respawn_rate=0.005, seed=0):
+    """Per-frame detector output (x1, y1, x2, y2, conf, cls) of random walking targets.
+
+    Targets are missed or come with a low score now and then, and some leave the
+    scene and are replaced by new ones, so tracks get lost, refound and removed.
+    """
+    rng = np.random.default_rng(seed)
+    xy = rng.uniform(0, size, (num_targets, 2))
+    wh = rng.uniform(10, 30, (num_targets, 2))
+    for _ in range(num_frames):
+        xy += rng.normal(0, 2, xy.shape)
+        respawn = rng.random(num_targets) < respawn_rate
+        xy[respawn] = rng.uniform(0, size, (respawn.sum(), 2))
+        conf = np.where(rng.random(num_targets) < 0.1, rng.uniform(0.06, 0.1, num_targets),
+                        rng.uniform(0.8, 1.0, num_targets))
+        seen = rng.random(num_targets) > 0.05
+        boxes = np.c_[xy, xy + wh, conf, np.zeros(num_targets)][seen]
+        yield boxes.astype(np.float32)
+
+
+def make_detections(num_targets, num_frames, seed=0):
+    return list(stream_detections(num_targets, num_frames, seed=seed))
+
+
+def make_track_args(**kwargs):
+    from engine import track_args
+
+    return track_args(dict({"cmc_method": "none"}, **kwargs), argv=[])
+
+
+def well_plate(rows=6, cols=8, width=796, height=597, round=False):
+    """Areas of a well plate layout in the GUI view coordinates, square or round wells."""
+    w, h = width / cols, height / rows
+    areas = {f"Well_{r * cols + c + 1}": [c * w + 2, r * h + 2, w - 4, h - 4] for r in range(rows) for c in range(cols)}
+    if round:
+        angles = np.linspace(0, 2 * np.pi, 32, endpoint=False)
+        circle = np.stack([np.cos(angles), np.sin(angles)], axis=1) * (min(w, h) / 2 - 2)
+        areas = {name: {"polygon": (circle + (x + w / 2 - 2, y + h / 2 - 2)).tolist()}
+                 for name, (x, y, w, h) in areas.items()}
+    return areas
+
+
+class LegacyCount(InsectCount):
+    """InsectCount with the per-track counting of before countFrame, rectangle areas only."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.last_frame_dict = {}
+        self.legacy_dict = {area_name: {} for area_name in self.area_names}
+
+    def count(self, tlwh, id, step=1):
+        overlap_area = []
+        for area in self.area_list:
+            overlap_area.append(self.judgeOverlap(tlwh, area))
+        if overlap_area:
+            if max(overlap_area) != 0:
+                area_index = overlap_area.index(max(overlap_area))
+                area_name = list(self.legacy_dict.keys())[area_index]
+                if id in list(self.legacy_dict[area_name].keys()):
+                    if id in list(self.last_frame_dict.keys()):
+                        self.legacy_dict[area_name][id][-1] += step
+                    else:
+                        self.legacy_dict[area_name][id].append(step)
+                else:
+                    self.legacy_dict[area_name][id] = [step]
+                self.last_frame_dict[id] = self.same_target_threshold
+
+    def update(self, step=1):
+        for id in list(self.last_frame_dict.keys()):
+            self.last_frame_dict[id] -= step
+            if self.last_frame_dict[id] <= 0:
+                self.last_frame_dict.pop(id)
+
+
+def tracker_rows(tracker, frames, image, start=0):
+    """RESULT_DTYPE rows of the online targets of a tracker fed frames start, start + 1, ..."""
+    from parallel import RESULT_DTYPE
+    from engine import online_targets
+
+    rows = []
+    for frame_id, output in enumerate(frames, start):
+        tlwhs, ids, scores = online_targets(tracker.update(output, image), tracker.args)
+        frame_rows = np.empty(len(ids), dtype=RESULT_DTYPE)
+        frame_rows['frame'] = frame_id
+        frame_rows['id'] = ids
+        frame_rows['x1'], frame_rows['y1'], frame_rows['w'], frame_rows['h'] = np.asarray(tlwhs).reshape(-1, 4).T
+        frame_rows['score'] = scores
+        rows.append(frame_rows)
+    return np.concatenate(rows)
+
+
+def id_switches(reference, rows):
+    """Ids of `rows` taken over by every track of `reference` beyond its first, boxes are paired by IoU per frame."""
+    from parallel import box_ious, tlwhs_of
+    from tracker.matching import linear_assignment
+
+    seen = {}
+    ref_starts = np.searchsorted(reference['frame'], np.arange(reference['frame'].max() + 2))
+    starts = np.searchsorted(rows['frame'], np.arange(reference['frame'].max() + 2))
+    for frame in range(len(ref_starts) - 1):
+        a = reference[ref_starts[frame]:ref_starts[frame + 1]]
+        b = rows[starts[frame]:starts[frame + 1]]
+        if not len(a) or not len(b):
+            continue
+        matches, _, _ = linear_assignment(1 - box_ious(tlwhs_of(a), tlwhs_of(b)), thresh=0.5)
+        for i, j in matches:
+            seen.setdefault(int(a['id'][i]), set()).add(int(b['id'][j]))
+    return sum(len(ids) - 1 for ids in seen.values())
@@ -0,0 +1,155 @@
+import csv
+import os
+import pickle
+import sqlite3
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from count import ENTER, EXIT, RESUME, EventLog, InsectCount, recount, summarizeEvents
+from engine import write_track_meta
+from helpers import LegacyCount, well_plate
+from tracker.tracking_utils.io import ResultWriter
+
+
+def walk(num_insects, num_frames, seed=0):
+    rng = np.random.default_rng(seed)
+    xy = rng.uniform(0, 800, (num_insects, 2))
+    frames = []
+    for _ in range(num_frames):
+        xy += rng.normal(0, 8, xy.shape)
+        # some insects are missed on a frame and come back
+        seen = rng.random(num_insects) > 0.1
+        frames.append([(np.array([x, y, 20., 20.]), id) for id, (x, y) in enumerate(xy, 1) if seen[id - 1]])
+    return frames
+
+
+def run(counter, frames):
+    for boxes in frames:
+        for tlwh, id in boxes:
+            counter.count(tlwh, id)
+        counter.update()
+    return counter
+
+
+def test_stays_match_the_per_track_count(tmp_path):
+    area_dict, fps = well_plate(), 30
+    frames = walk(60, 400)
+    legacy = run(LegacyCount(area_dict, 800, 600, fps, 0.5, 0.2), frames)
+    counter = run(InsectCount(area_dict, 800, 600, fps, 0.5, 0.2), frames)
+    counter.save(str(tmp_path), fps)
+    expected = {
+        area_name: {id: [length / fps for length in stays if length >= counter.frame_threshold]
+                    for id, stays in ids.items()}
+        for area_name, ids in legacy.legacy_dict.items()
+    }
+    expected = {area_name: {id: stays for id, stays in ids.items() if stays} for area_name, ids in expected.items()}
+    assert counter.time_dict == expected
+
+
+def test_insect_in_more_areas_than_slots(tmp_path):
+    area_dict, fps = well_plate(1, 8), 10
+    counter = InsectCount(area_dict, 800, 600, fps, 5, 0.2)
+    names = counter.area_names
+    # one insect through all 8 areas and back to the first, within `max` of its stay there
+    frames = [[(np.array([x + w / 2 - 5, y + h / 2 - 5, 10., 10.]), 1)]
+              for x, y, w, h in counter.areas[list(range(8)) + [0]] for _ in range(3)]
+    run(counter, frames)
+    counter.save(str(tmp_path), fps)
+    assert counter.stay_area.shape[1] >= 8
+    assert counter.time_dict[names[0]] == {1: [6 / fps]}
+    assert all(counter.time_dict[name] == {1: [3 / fps]} for name in names[1:])
+
+
+def test_recount_matches_the_live_count(tmp_path):
+    area_dict, fps = well_plate(round=True), 30
+    frames = walk(60, 400, seed=1)
+    counter = run(InsectCount(area_dict, 800, 600, fps, 0.5, 0.2), frames)
+    counter.save(str(tmp_path), fps)
+    rows = [(frame, id, tlwh) for frame, boxes in enumerate(frames) for tlwh, id in boxes]
+    frame_ids = np.array([frame for frame, _, _ in rows])
+    ids = np.array([id for _, id, _ in rows])
+    tlwhs = np.array([tlwh for _, _, tlwh in rows])
+    # rows of a saved file need not be in frame order
+    order = np.random.default_rng(0).permutation(len(rows))
+    time_dict = recount(frame_ids[order], ids[order], tlwhs[order], area_dict, 800, 600, fps, 0.5, 0.2)
+    assert time_dict == counter.time_dict
+
+
+@pytest.mark.parametrize("suffix", [".csv", ".db"])
+def test_bins_add_up_to_the_result(tmp_path, suffix):
+    area_dict, fps = well_plate(2, 2), 30
+    bins_path = str(tmp_path / f"bins{suffix}")
+    counter = run(InsectCount(area_dict, 800, 600, fps, 0.5, 0.2, bins_path, bin_seconds=2), walk(60, 400, seed=2))
+    area_count, area_time = counter.save(str(tmp_path), fps)
+    if suffix == ".csv":
+        with open(bins_path, newline='') as f:
+            rows = list(csv.reader(f))[1:]
+    else:
+        rows = sqlite3.connect(bins_path).execute("SELECT * FROM bins ORDER BY rowid").fetchall()
+    rows = [(float(start), float(end), name, int(entries), int(new_ids), float(dwell))
+            for start, end, name, entries, new_ids, _, dwell in rows]
+    # bins of 2 s back to back up to the last counted frame, one row per area each
+    assert sorted({(start, end) for start, end, *_ in rows}) == [(i * 2, min(i * 2 + 2, 400 / fps)) for i in range(7)]
+    assert len(rows) == 7 * len(area_dict)
+    for name in counter.area_names:
+        assert sum(row[3] for row in rows if row[2] == name) == sum(map(len, counter.time_dict[name].values()))
+        assert sum(row[4] for row in rows if row[2] == name) == area_count[name]
+        assert sum(row[5] for row in rows if row[2] == name) == pytest.approx(area_time[name])
+
+
+def test_event_log_across_chunks():
+    log = EventLog(chunk_size=4)
+    expected = []
+    for frame, size in enumerate([3, 0, 6, 1, 4]):
+        ids = np.arange(size) + 10 * frame
+        log.append(frame, ids, ids % 3, ENTER)
+        expected += [(frame, id, id % 3, ENTER) for id in ids]
+    assert len(log) == len(expected)
+    assert log.array().tolist() == expected
+    # a checkpoint of the log goes on appending where it stood
+    log = pickle.loads(pickle.dumps(log))
+    log.append(5, np.array([1, 2]), np.array([0, 1]), np.array([EXIT, RESUME]))
+    assert log.array().tolist() == expected + [(5, 1, 0, EXIT), (5, 2, 1, RESUME)]
+
+
+def test_events_of_a_visit(tmp_path):
+    area_dict, fps = well_plate(1, 2), 10
+    counter = InsectCount(area_dict, 800, 600, fps, 0.5, 0.2)
+    x, y, w, h = counter.areas[0]
+    inside = [(np.array([x + w / 2, y + h / 2, 10., 10.]), 1)]
+    # in the area, out for 2 frames (less than `max`), back in, then gone for good
+    run(counter, [inside] * 3 + [[]] * 2 + [inside] * 2 + [[]])
+    counter.save(str(tmp_path), fps)
+    events = np.load(tmp_path / "events.npy")
+    assert events.tolist() == [(0, 1, 0, ENTER), (3, 1, 0, EXIT), (5, 1, 0, RESUME), (7, 1, 0, EXIT)]
+    assert counter.time_dict == summarizeEvents(events, counter.area_names, fps, counter.frame_threshold)[0]
+    assert counter.time_dict[counter.area_names[0]] == {1: [5 / fps]}
+
+
+def test_recount_cli_on_a_run_folder(tmp_path):
+    area_dict, fps = well_plate(2, 2), 30
+    frames = walk(30, 200, seed=3)
+    live = tmp_path / "live"
+    live.mkdir()
+    run(InsectCount(area_dict, 800, 600, fps, 0.5, 0.2), frames).save(str(live), fps)
+
+    # a run folder as the engine leaves it, recounted by the command line tool
+    folder = tmp_path / "run"
+    folder.mkdir()
+    writer = ResultWriter(str(folder / "tracks.txt"))
+    for frame_id, boxes in enumerate(frames, 1):
+        writer.add(frame_id, [tlwh for tlwh, _ in boxes], [id for _, id in boxes], [0.9] * len(boxes))
+    writer.close()
+    write_track_meta(str(folder), 800, 600, fps, area_dict, 0.5, 0.2)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.run([sys.executable, os.path.join(root, "count.py"), str(folder)], check=True, cwd=root)
+    assert (folder / "detail.csv").read_bytes() == (live / "detail.csv").read_bytes()
+    # the time per area is summed in another order than the live count does
+    expected, result = [list(csv.reader((path / "result.csv").read_text().splitlines())) for path in (live, folder)]
+    assert [row[0] for row in result] == [row[0] for row in expected]
+    for row, expected_row in zip(result, expected):
+        if len(row) > 1 and row[1] != expected_row[1]:
+            assert float(row[1]) == pytest.approx(float(expected_row[1]))
@@ -0,0 +1,134 @@
+import csv
+import os
+import sys
+import threading
+
+import numpy as np
+import pytest
+
+from helpers import square_frame, write_blob_model, write_square_video
+
+onnxruntime = pytest.importorskip("onnxruntime")
+pytest.importorskip("onnx")
+pytest.importorskip("PyQt5")
+
+
+class SteppedCapture(object):
+    """A camera delivering its frames only when the test lets it, so the frames a reader skips are known."""
+
+    def __init__(self, frames):
+        self.frames = frames
+        self.index = 0
+        self.allowed = threading.Semaphore(0)
+        self.closed = False
+
+    def deliver(self, count):
+        for _ in range(count):
+            self.allowed.release()
+
+    def read(self):
+        while not self.allowed.acquire(timeout=0.05):
+            if self.closed:
+                return False, None
+        frame = self.frames[self.index]
+        self.index += 1
+        return True, frame
+
+    def release(self):
+        self.closed = True
+
+
+@pytest.fixture
+def gui_app(monkeypatch):
+    monkeypatch.setenv("QT_QPA_PLATFORM", "offscreen")
+    from PyQt5.QtGui import QGuiApplication
+
+    return QGuiApplication.instance() or QGuiApplication([])
+
+
+class Signal(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def emit(self, *args):
+        self.calls.append(args)
+
+
+def test_realtime_frames_keep_their_index(tmp_path, gui_app, monkeypatch):
+    import track
+
+    # the engine parses the command line, not the one of pytest
+    monkeypatch.setattr(sys, "argv", ["track"])
+    model = onnxruntime.InferenceSession(write_blob_model(str(tmp_path / "blob.onnx")))
+    steps = [1, 2, 3, 1, 3, 2, 2, 1, 3]
+    # a square moving 4 pixels a frame, gone on one frame
+    frames = [square_frame(100 + 4 * i, 200) for i in range(sum(steps))]
+    real = list(np.cumsum(steps) - 1)
+    empty = real[5]
+    frames[empty] = square_frame(0, 0, side=0)
+
+    camera = track.OpenCamera(Signal(), Signal(), Signal())
+    camera.cap = SteppedCapture(frames)
+    camera.width, camera.height = 640, 480
+    camera.trackSwitch(True, model, str(tmp_path), True, {"Area_1": [0, 0, 400, 600]}, 0.5, 0.2, {
+        "realtime": True,
+        "det_cache": "",
+        "cmc_method": "none",
+    })
+    camera.applySwitches()
+    engine = camera.engine
+    delivered = 0
+    for step in steps:
+        camera.cap.deliver(step)
+        delivered += step
+        # the reader hands over the newest frame once it got all of them
+        while camera.reader.index < delivered:
+            threading.Event().wait(0.01)
+        camera.showImage()
+    # the tracker and the count went through every frame, those skipped and the empty one too
+    assert engine.frame_id == real[-1]
+    assert engine.tracker.frame_id == real[-1] + 1
+    assert engine.count.clock == real[-1]
+    camera.cap.closed = True
+    camera.trackSwitch(False, model, str(tmp_path), True, {}, 0.5, 0.2, {})
+    camera.applySwitches()
+
+    save_path = camera.video_save_path
+    rows = np.loadtxt(os.path.join(save_path, "tracks.txt"), delimiter=',', ndmin=2)
+    # the track is confirmed on its second frame
+    assert rows[:, 0].astype(int).tolist() == [frame for frame in real[1:] if frame != empty]
+    with open(os.path.join(save_path, "camera_timestamps.csv"), newline='') as f:
+        timestamps = list(csv.reader(f))[1:]
+    assert [int(row[0]) for row in timestamps] == list(range(len(steps)))
+    assert [int(row[1]) for row in timestamps] == real
+
+
+def track_video(model, video_path, save_dir, stop_at=None, **settings):
+    """Runs a VideoEngine on the video, stopped once `stop_at` frames are rendered."""
+    from engine import VideoEngine
+
+    engines = []
+
+    def progress(frame, total):
+        if stop_at is not None and frame >= stop_at:
+            engines[0].stop()
+
+    areas = {"Area_1": [50, 50, 300, 250], "Area_2": {"polygon": [[400, 50], [700, 80], [650, 450], [420, 400]]}}
+    settings = dict({"save_dir": save_dir, "det_cache": "", "no_video": True, "bin_seconds": 2}, **settings)
+    engines.append(VideoEngine(model, video_path, areas, 0.5, 0.2, settings, argv=[], progress=progress))
+    return engines[0].run()
+
+
+@pytest.mark.parametrize("backend", ["object", "array"])
+def test_resumed_run_matches_an_uninterrupted_one(tmp_path, backend):
+    model = onnxruntime.InferenceSession(write_blob_model(str(tmp_path / "blob.onnx")))
+    video = write_square_video(str(tmp_path / "squares.avi"), 240)
+    settings = {"tracker_backend": backend, "checkpoint_every": 50}
+    track_video(model, video, str(tmp_path / "full"), **settings)
+    track_video(model, video, str(tmp_path / "resumed"), stop_at=170, **settings)
+    assert os.path.exists(tmp_path / "resumed" / "checkpoint.pkl")
+    # the resumed run takes its settings and state from the checkpoint
+    track_video(model, video, str(tmp_path / "other"), resume=str(tmp_path / "resumed"))
+    for name in ("tracks.txt", "result.csv", "detail.csv", "bins.csv", "events.npy"):
+        assert (tmp_path / "resumed" / name).read_bytes() == (tmp_path / "full" / name).read_bytes(), name
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+from helpers import id_switches, make_detections, make_track_args, tracker_rows
+from parallel import RESULT_DTYPE, split_segments, stitch
+from tracker.array_bot_sort import ArrayBoTSORT
+
+IMAGE = np.zeros((1280, 1280, 3), dtype=np.uint8)
+
+
+def box_rows(frames, id, x0=100, speed=5):
+    """Rows of one box moving right at `speed` pixels a frame, seen on `frames`."""
+    rows = np.zeros(len(frames), dtype=RESULT_DTYPE)
+    rows['frame'] = frames
+    rows['id'] = id
+    rows['x1'] = x0 + speed * np.asarray(frames)
+    rows['y1'] = 100
+    rows['w'] = rows['h'] = 40
+    rows['score'] = 0.9
+    return rows
+
+
+def test_split_segments():
+    assert split_segments(100, 3, 10) == [(0, 43), (33, 77), (67, None)]
+    assert split_segments(100, 1, 10) == [(0, None)]
+
+
+def test_stitch_joins_over_the_overlap():
+    segments = split_segments(40, 2, 10)  # (0, 30), (20, None)
+    rows = [box_rows(range(0, 30), 4), box_rows(range(20, 40), 1)]
+    stitched, joins = stitch(segments, rows, 30, 0.8)
+    assert joins == [(1, 0)]
+    # the earlier segment keeps its id, every frame comes once
+    assert stitched['id'].tolist() == [4] * 40
+    assert stitched['frame'].tolist() == list(range(40))
+
+
+def test_stitch_joins_a_track_lost_across_the_boundary():
+    segments = split_segments(40, 2, 10)
+    # seen up to frame 15, found again after the overlap on frame 32
+    rows = [box_rows(range(0, 16), 1), box_rows(range(32, 40), 1)]
+    stitched, joins = stitch(segments, rows, 30, 0.8)
+    assert joins == [(0, 1)]
+    assert np.unique(stitched['id']).tolist() == [1]
+
+
+@pytest.mark.parametrize("num_segments", [2, 3])
+def test_stitched_segments_match_a_sequential_run(num_segments):
+    args = make_track_args()
+    frames = make_detections(10, 300)
+    sequential = tracker_rows(ArrayBoTSORT(args), frames, IMAGE)
+    segments = split_segments(len(frames), num_segments, 20)
+    rows = [tracker_rows(ArrayBoTSORT(args), frames[start:end], IMAGE, start) for start, end in segments]
+    stitched, _ = stitch(segments, rows, args.track_buffer, args.match_thresh)
+    assert len(stitched) == len(sequential)
+    assert len(np.unique(stitched['id'])) == len(np.unique(sequential['id']))
+    assert id_switches(sequential, stitched) == 0
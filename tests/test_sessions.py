@@ -0,0 +1,53 @@
+import os
+
+import numpy as np
+import pytest
+
+from sessions import load_session, optimized_path
+
+onnx = pytest.importorskip("onnx")
+
+
+def write_model(path, offset):
+    """A model adding `offset` to its input."""
+    from onnx import TensorProto, helper
+
+    graph = helper.make_graph(
+        [helper.make_node("Add", ["x", "offset"], ["y"])], "add",
+        [helper.make_tensor_value_info("x", TensorProto.FLOAT, [1, 4])],
+        [helper.make_tensor_value_info("y", TensorProto.FLOAT, [1, 4])],
+        [helper.make_tensor("offset", TensorProto.FLOAT, [1], [offset])])
+    onnx.save(helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)], ir_version=8), path)
+
+
+def run(session):
+    return session.run(None, {"x": np.zeros((1, 4), dtype=np.float32)})[0][0, 0]
+
+
+def test_saved_graph_follows_model_contents(tmp_path):
+    path = str(tmp_path / "model.onnx")
+    write_model(path, 1.0)
+    assert run(load_session(path)) == 1.0
+    assert os.path.exists(optimized_path(path, "extended"))
+    old_graph = optimized_path(path, "extended")
+
+    # a different model with an older time, as left by cp -p or an unzipped file
+    write_model(path, 2.0)
+    os.utime(path, (1, 1))
+    session = load_session(path)
+    assert run(session) == 2.0
+    assert session.source_path == path
+    assert not os.path.exists(old_graph)
+
+
+def test_broken_saved_graph_falls_back_to_model(tmp_path):
+    path = str(tmp_path / "model.onnx")
+    write_model(path, 3.0)
+    load_session(path)
+    with open(optimized_path(path, "extended"), 'wb') as f:
+        f.write(b"half written")
+    assert run(load_session(path)) == 3.0
+    # removed, so the next load saves it again
+    assert run(load_session(path)) == 3.0
+    assert os.path.getsize(optimized_path(path, "extended")) > len(b"half written")
+    assert not [name for name in os.listdir(tmp_path) if ".tmp" in name]
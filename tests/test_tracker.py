@@ -0,0 +1,69 @@
+import tracemalloc
+
+import numpy as np
+import pytest
+
+from helpers import make_detections, make_track_args, stream_detections
+from engine import TRACKERS, online_targets
+
+IMAGE = np.zeros((480, 640, 3), dtype=np.uint8)
+
+
+def track_ids(backend, frames, **settings):
+    """Online track ids of every frame of a tracker of `backend` fed `frames`."""
+    args = make_track_args(**settings)
+    tracker = TRACKERS[backend](args, frame_rate=30)
+    ids = [list(online_targets(tracker.update(output, IMAGE), args)[1]) for output in frames]
+    tracker.close()
+    return ids
+
+
+def gap_frames(gap, before=10, after=10):
+    """One box moving right that disappears for `gap` frames."""
+    frames = []
+    for frame in range(before + gap + after):
+        if before <= frame < before + gap:
+            frames.append(np.empty((0, 6), dtype=np.float32))
+        else:
+            frames.append(np.array([[100 + frame, 100, 140 + frame, 140, 0.9, 0]], dtype=np.float32))
+    return frames
+
+
+@pytest.mark.parametrize("gap", [1, 2, 3, 4, 5])
+def test_backends_agree_on_lost_track_expiry(gap):
+    # with track_buffer 2 a track expires after 3 lost frames and can still be re-activated on the next one
+    frames = gap_frames(gap)
+    object_ids = track_ids("object", frames, track_buffer=2)
+    array_ids = track_ids("array", frames, track_buffer=2)
+    for frame, (a, b) in enumerate(zip(object_ids, array_ids)):
+        assert a == b, f"frame {frame}"
+
+
+def test_backends_agree_on_churn():
+    frames = make_detections(50, 300)
+    assert track_ids("object", frames, track_buffer=5) == track_ids("array", frames, track_buffer=5)
+
+
+# pytest keeps every warning it catches, that alone would grow the memory
+@pytest.mark.filterwarnings("ignore")
+@pytest.mark.parametrize("backend", ["object", "array"])
+def test_removed_history_is_bounded(backend):
+    # bench_soak in short: tracks are removed every few frames, the history and the memory must stay flat
+    args = make_track_args(track_buffer=5, removed_max_count=50)
+    tracker = TRACKERS[backend](args, frame_rate=30)
+    samples = []
+    tracemalloc.start()
+    try:
+        for frame, output in enumerate(stream_detections(10, 2000, respawn_rate=0.05), 1):
+            tracker.update(output, IMAGE)
+            # tracks removed on this frame are kept on top of the cap
+            current = sum(removed_frame == tracker.frame_id for removed_frame, _ in tracker.removed_stracks.tracks)
+            assert len(tracker.removed_stracks) <= 50 + current
+            if frame % 250 == 0:
+                samples.append(tracemalloc.get_traced_memory()[0])
+    finally:
+        tracemalloc.stop()
+        tracker.close()
+    assert len(tracker.removed_stracks) >= 50
+    # after the history filled up in the first 500 frames
+    assert samples[-1] - samples[1] < 256 * 1024
@@ -0,0 +1,367 @@
+import numpy as np
+
+from tracker import matching
+from tracker.gmc import GMC
+from tracker.basetrack import BaseTrack, TrackState
+from tracker.kalman_filter import KalmanFilter
+from tracker.retention import RemovedTrack, RemovedTracks
+
+
+class TrackStore(object):
+    """Contiguous arrays holding the state of the live (tracked and lost) tracks.
+
+    Every track owns one slot, a row in each array. Slots of removed tracks are
+    released and reused by new tracks, so the arrays only grow with the number of
+    tracks alive at the same time, removed tracks only live on as RemovedTrack
+    snapshots in the tracker's bounded `removed_stracks`.
+    """
+
+    FIELDS = ("mean", "covariance", "track_id", "state", "score", "frame_id", "start_frame", "tracklet_len",
+              "is_activated", "alive")
+
+    def __init__(self, capacity=64):
+        self.mean = np.zeros((capacity, 8))
+        self.covariance = np.zeros((capacity, 8, 8))
+        self.track_id = np.zeros(capacity, dtype=np.int64)
+        self.state = np.zeros(capacity, dtype=np.int8)
+        self.score = np.zeros(capacity)
+        self.frame_id = np.zeros(capacity, dtype=np.int64)
+        self.start_frame = np.zeros(capacity, dtype=np.int64)
+        self.tracklet_len = np.zeros(capacity, dtype=np.int64)
+        self.is_activated = np.zeros(capacity, dtype=bool)
+        self.alive = np.zeros(capacity, dtype=bool)
+
+    @property
+    def capacity(self):
+        return len(self.alive)
+
+    def grow(self, capacity):
+        for name in self.FIELDS:
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def allocate(self, num):
+        slots = np.flatnonzero(~self.alive)[:num]
+        if len(slots) < num:
+            capacity = self.capacity
+            self.grow(max(2 * capacity, capacity + num - len(slots)))
+            slots = np.r_[slots, np.arange(capacity, capacity + num - len(slots))]
+        self.alive[slots] = True
+        return slots
+
+    def tlwh(self, slots):
+        ret = self.mean[slots, :4].copy()
+        ret[:, :2] -= ret[:, 2:] / 2
+        return ret
+
+    def tlbr(self, slots):
+        ret = self.tlwh(slots)
+        ret[:, 2:] += ret[:, :2]
+        return ret
+
+
+class STrackView(object):
+    """Read-only view of one slot of a TrackStore with the STrack attributes used by the callers.
+
+    A view is only valid until the next `ArrayBoTSORT.update`, the slot may hold
+    another track afterwards.
+    """
+
+    __slots__ = ("store", "slot")
+
+    def __init__(self, store, slot):
+        self.store = store
+        self.slot = slot
+
+    @property
+    def track_id(self):
+        return int(self.store.track_id[self.slot])
+
+    @property
+    def score(self):
+        return self.store.score[self.slot]
+
+    @property
+    def state(self):
+        return int(self.store.state[self.slot])
+
+    @property
+    def is_activated(self):
+        return bool(self.store.is_activated[self.slot])
+
+    @property
+    def frame_id(self):
+        return int(self.store.frame_id[self.slot])
+
+    @property
+    def end_frame(self):
+        return self.frame_id
+
+    @property
+    def start_frame(self):
+        return int(self.store.start_frame[self.slot])
+
+    @property
+    def tracklet_len(self):
+        return int(self.store.tracklet_len[self.slot])
+
+    @property
+    def mean(self):
+        return self.store.mean[self.slot].copy()
+
+    @property
+    def covariance(self):
+        return self.store.covariance[self.slot].copy()
+
+    @property
+    def tlwh(self):
+        ret = self.store.mean[self.slot, :4].copy()
+        ret[:2] -= ret[2:] / 2
+        return ret
+
+    @property
+    def tlbr(self):
+        ret = self.tlwh
+        ret[2:] += ret[:2]
+        return ret
+
+    @property
+    def xywh(self):
+        return self.store.mean[self.slot, :4].copy()
+
+    def __repr__(self):
+        return 'OT_{}_({}-{})'.format(self.track_id, self.start_frame, self.end_frame)
+
+
+class ArrayBoTSORT(object):
+    """BoTSORT with the track state kept in a TrackStore.
+
+    The association logic is the one of `tracker.bot_sort.BoTSORT`, the track lists
+    are integer arrays of store slots and every state transition is an array
+    operation over them, so the per-frame cost follows the number of live tracks.
+    ReID features are not supported.
+    """
+
+    def __init__(self, args, frame_rate=30):
+        if args.with_reid:
+            raise ValueError("Error: the array tracker backend does not support ReID")
+
+        self.store = TrackStore()
+        self.tracked = np.empty(0, dtype=np.int64)  # slots of tracked (and unconfirmed) tracks
+        self.lost = np.empty(0, dtype=np.int64)  # slots of lost tracks
+        self.removed_stracks = RemovedTracks(args.removed_max_count, args.removed_max_age, args.removed_spill)
+        BaseTrack.clear_count()
+
+        self.frame_id = 0
+        self.args = args
+
+        self.track_high_thresh = args.track_high_thresh
+        self.track_low_thresh = args.track_low_thresh
+        self.new_track_thresh = args.new_track_thresh
+
+        self.buffer_size = int(frame_rate / 30.0 * args.track_buffer)
+        self.max_time_lost = self.buffer_size
+        self.kalman_filter = KalmanFilter()
+
+        self.proximity_thresh = args.proximity_thresh
+        self.appearance_thresh = args.appearance_thresh
+
+        self.gmc = GMC(method=args.cmc_method, verbose=[args.name, args.ablation])
+
+    @property
+    def tracked_stracks(self):
+        return [STrackView(self.store, slot) for slot in self.tracked]
+
+    @property
+    def lost_stracks(self):
+        return [STrackView(self.store, slot) for slot in self.lost]
+
+    def predict(self, slots, frame_step):
+        store = self.store
+        mean = store.mean[slots]
+        covariance = store.covariance[slots]
+        mean[store.state[slots] != TrackState.Tracked, 6:] = 0
+        for _ in range(frame_step):
+            mean, covariance = self.kalman_filter.multi_predict(mean, covariance)
+        store.mean[slots] = mean
+        store.covariance[slots] = covariance
+
+    def apply_gmc(self, slots, H):
+        R8x8 = np.kron(np.eye(4, dtype=float), H[:2, :2])
+        mean = np.dot(self.store.mean[slots], R8x8.T)
+        mean[:, :2] += H[:2, 2]
+        self.store.mean[slots] = mean
+        self.store.covariance[slots] = np.matmul(np.matmul(R8x8, self.store.covariance[slots]), R8x8.T)
+
+    def correct(self, slots, det_tlwh, det_scores):
+        """Kalman update of the matched tracks, `update` for tracked ones and `re_activate` for the others.
+
+        Returns the slots of the updated and of the re-activated tracks, in match order.
+        """
+        store = self.store
+        measurement = det_tlwh.copy()
+        measurement[:, :2] += measurement[:, 2:] / 2
+        if len(slots):
+            store.mean[slots], store.covariance[slots] = self.kalman_filter.multi_update(
+                store.mean[slots], store.covariance[slots], measurement)
+        tracked = store.state[slots] == TrackState.Tracked
+        store.tracklet_len[slots] = np.where(tracked, store.tracklet_len[slots] + 1, 0)
+        store.frame_id[slots] = self.frame_id
+        store.state[slots] = TrackState.Tracked
+        store.is_activated[slots] = True
+        store.score[slots] = det_scores
+        return slots[tracked], slots[~tracked]
+
+    def associate(self, slots, det_tlwh, det_scores, thresh, fuse_score):
+        """IoU association of track slots with detections, returns (matches, u_track, u_detection)."""
+        det_tlbr = det_tlwh.copy()
+        det_tlbr[:, 2:] += det_tlbr[:, :2]
+        dists = 1 - matching.ious(self.store.tlbr(slots), det_tlbr)
+        if fuse_score and dists.size:
+            dists = 1 - (1 - dists) * det_scores[None, :]
+        matches, u_track, u_detection = matching.linear_assignment(dists, thresh=thresh)
+        return np.asarray(matches, dtype=np.int64).reshape(-1, 2), u_track, u_detection
+
+    def activate(self, det_tlwh, det_scores):
+        store = self.store
+        slots = store.allocate(len(det_tlwh))
+        measurement = det_tlwh.copy()
+        measurement[:, :2] += measurement[:, 2:] / 2
+        store.mean[slots], store.covariance[slots] = self.kalman_filter.multi_initiate(measurement)
+        store.track_id[slots] = [BaseTrack.next_id() for _ in slots]
+        store.state[slots] = TrackState.Tracked
+        store.score[slots] = det_scores
+        store.tracklet_len[slots] = 0
+        store.is_activated[slots] = self.frame_id == 1
+        store.frame_id[slots] = self.frame_id
+        store.start_frame[slots] = self.frame_id
+        return slots
+
+    def update(self, output_results, img, frame_step=1):
+        self.frame_id += frame_step
+        store = self.store
+
+        if len(output_results):
+            scores = output_results[:, 4]
+            bboxes = output_results[:, :4]  # x1y1x2y2
+
+            # Remove bad detections
+            lowest_inds = scores > self.track_low_thresh
+            bboxes = bboxes[lowest_inds]
+            scores = scores[lowest_inds]
+
+            # Find high threshold detections
+            remain_inds = scores > self.args.track_high_thresh
+            dets = bboxes[remain_inds]
+            scores_keep = scores[remain_inds]
+        else:
+            bboxes = dets = np.empty((0, 4))
+            scores = scores_keep = np.empty(0)
+
+        # tlbr -> tlwh in the detector precision, like STrack.tlbr_to_tlwh
+        det_tlwh = dets.copy()
+        det_tlwh[:, 2:] -= det_tlwh[:, :2]
+        det_tlwh = det_tlwh.astype(np.float64)
+        ''' Add newly detected tracklets to tracked_stracks'''
+        activated = store.is_activated[self.tracked]
+        unconfirmed = self.tracked[~activated]
+        ''' Step 2: First association, with high score detection boxes'''
+        strack_pool = joint_slots(self.tracked[activated], self.lost)
+
+        # Predict the current location with KF
+        if len(strack_pool):
+            self.predict(strack_pool, frame_step)
+
+        # Fix camera motion
+        warp = self.gmc.apply(img, dets)
+        if len(strack_pool) or len(unconfirmed):
+            self.apply_gmc(np.r_[strack_pool, unconfirmed], warp)
+
+        matches, u_track, u_detection = self.associate(strack_pool, det_tlwh, scores_keep, self.args.match_thresh,
+                                                       not self.args.mot20)
+        activated_slots, refind_slots = self.correct(strack_pool[matches[:, 0]], det_tlwh[matches[:, 1]],
+                                                     scores_keep[matches[:, 1]])
+        ''' Step 3: Second association, with low score detection boxes'''
+        inds_second = np.logical_and(scores > self.args.track_low_thresh, scores < self.args.track_high_thresh)
+        tlwh_second = bboxes[inds_second].copy()
+        tlwh_second[:, 2:] -= tlwh_second[:, :2]
+        tlwh_second = tlwh_second.astype(np.float64)
+        scores_second = scores[inds_second]
+
+        r_tracked = strack_pool[np.asarray(u_track, dtype=np.int64)]
+        r_tracked = r_tracked[store.state[r_tracked] == TrackState.Tracked]
+        matches, u_track, _ = self.associate(r_tracked, tlwh_second, scores_second, 0.5, False)
+        updated, refound = self.correct(r_tracked[matches[:, 0]], tlwh_second[matches[:, 1]],
+                                        scores_second[matches[:, 1]])
+        activated_slots = np.r_[activated_slots, updated]
+        refind_slots = np.r_[refind_slots, refound]
+
+        lost_slots = r_tracked[np.asarray(u_track, dtype=np.int64)]
+        lost_slots = lost_slots[store.state[lost_slots] != TrackState.Lost]
+        store.state[lost_slots] = TrackState.Lost
+        '''Deal with unconfirmed tracks, usually tracks with only one beginning frame'''
+        u_detection = np.asarray(u_detection, dtype=np.int64)
+        det_tlwh, scores_keep = det_tlwh[u_detection], scores_keep[u_detection]
+        matches, u_unconfirmed, u_detection = self.associate(unconfirmed, det_tlwh, scores_keep, 0.7,
+                                                             not self.args.mot20)
+        updated, _ = self.correct(unconfirmed[matches[:, 0]], det_tlwh[matches[:, 1]], scores_keep[matches[:, 1]])
+        activated_slots = np.r_[activated_slots, updated]
+        removed_slots = unconfirmed[np.asarray(u_unconfirmed, dtype=np.int64)]
+        store.state[removed_slots] = TrackState.Removed
+        """ Step 4: Init new stracks"""
+        u_detection = np.asarray(u_detection, dtype=np.int64)
+        u_detection = u_detection[scores_keep[u_detection] >= self.new_track_thresh]
+        activated_slots = np.r_[activated_slots, self.activate(det_tlwh[u_detection], scores_keep[u_detection])]
+        """ Step 5: Update state"""
+        # a track removed on the previous frame is still in the lost list for one frame, like in BoTSORT,
+        # it leaves it now unless it was re-activated
+        stale = self.lost[store.state[self.lost] == TrackState.Removed]
+        expired = self.lost[(self.frame_id - store.frame_id[self.lost] > self.max_time_lost) &
+                            (store.state[self.lost] != TrackState.Removed)]
+        store.state[expired] = TrackState.Removed
+        removed_slots = np.r_[removed_slots, expired]
+        """ Merge """
+        tracked = self.tracked[store.state[self.tracked] == TrackState.Tracked]
+        tracked = joint_slots(tracked, activated_slots)
+        tracked = joint_slots(tracked, refind_slots)
+        lost = sub_slots(self.lost, tracked)
+        lost = np.r_[lost, lost_slots]
+        lost = sub_slots(lost, stale)
+        self.tracked, self.lost = self.remove_duplicates(tracked, lost)
+        self.removed_stracks.extend([
+            RemovedTrack(int(store.track_id[slot]), int(store.start_frame[slot]), int(store.frame_id[slot]),
+                         store.score[slot], store.mean[slot].copy()) for slot in removed_slots
+        ], self.frame_id)
+
+        # release the slots of every track that is neither tracked nor lost anymore
+        store.alive[:] = False
+        store.alive[self.tracked] = True
+        store.alive[self.lost] = True
+
+        return self.tracked_stracks
+
+    def close(self):
+        self.removed_stracks.close()
+
+    def remove_duplicates(self, slots_a, slots_b):
+        store = self.store
+        pdist = 1 - matching.ious(store.tlbr(slots_a), store.tlbr(slots_b))
+        p, q = np.where(pdist < 0.15)
+        time_p = store.frame_id[slots_a[p]] - store.start_frame[slots_a[p]]
+        time_q = store.frame_id[slots_b[q]] - store.start_frame[slots_b[q]]
+        older = time_p > time_q
+        keep_a = np.ones(len(slots_a), dtype=bool)
+        keep_b = np.ones(len(slots_b), dtype=bool)
+        keep_a[p[~older]] = False
+        keep_b[q[older]] = False
+        return slots_a[keep_a], slots_b[keep_b]
+
+
+def joint_slots(slots_a, slots_b):
+    return np.r_[slots_a, slots_b[~np.isin(slots_b, slots_a)]].astype(np.int64)
+
+
+def sub_slots(slots_a, slots_b):
+    return slots_a[~np.isin(slots_a, slots_b)]
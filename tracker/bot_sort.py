@@ -7,6 +7,7 @@ from tracker import matching
 from tracker.gmc import GMC
 from tracker.basetrack import BaseTrack, TrackState
 from tracker.kalman_filter import KalmanFilter
+from tracker.retention import RemovedTracks
 
 # from fast_reid.fast_reid_interfece import FastReIDInterface
 
@@ -53,32 +54,49 @@ class STrack(BaseTrack):
     @staticmethod
     def multi_predict(stracks):
         if len(stracks) > 0:
-            multi_mean = np.asarray([st.mean.copy() for st in stracks])
+            multi_mean = np.asarray([st.mean for st in stracks])
             multi_covariance = np.asarray([st.covariance for st in stracks])
-            for i, st in enumerate(stracks):
-                if st.state != TrackState.Tracked:
-                    multi_mean[i][6] = 0
-                    multi_mean[i][7] = 0
+            lost = np.asarray([st.state != TrackState.Tracked for st in stracks])
+            multi_mean[lost, 6:] = 0
             multi_mean, multi_covariance = STrack.shared_kalman.multi_predict(multi_mean, multi_covariance)
             for i, (mean, cov) in enumerate(zip(multi_mean, multi_covariance)):
                 stracks[i].mean = mean
                 stracks[i].covariance = cov
 
+    @staticmethod
+    def multi_update(stracks, new_tracks, frame_id):
+        """Batched `update` of matched tracks, one Kalman correction for all of them."""
+        if len(stracks) > 0:
+            multi_mean = np.asarray([st.mean for st in stracks])
+            multi_covariance = np.asarray([st.covariance for st in stracks])
+            measurement = np.asarray([STrack.tlwh_to_xywh(t.tlwh) for t in new_tracks])
+            multi_mean, multi_covariance = STrack.shared_kalman.multi_update(multi_mean, multi_covariance,
+                                                                             measurement)
+            for st, new_track, mean, cov in zip(stracks, new_tracks, multi_mean, multi_covariance):
+                st.frame_id = frame_id
+                st.tracklet_len += 1
+                st.mean, st.covariance = mean, cov
+                if new_track.curr_feat is not None:
+                    st.update_features(new_track.curr_feat)
+                st.state = TrackState.Tracked
+                st.is_activated = True
+                st.score = new_track.score
+
     @staticmethod
     def multi_gmc(stracks, H=np.eye(2, 3)):
         if len(stracks) > 0:
-            multi_mean = np.asarray([st.mean.copy() for st in stracks])
+            multi_mean = np.asarray([st.mean for st in stracks])
             multi_covariance = np.asarray([st.covariance for st in stracks])
 
             R = H[:2, :2]
             R8x8 = np.kron(np.eye(4, dtype=float), R)
             t = H[:2, 2]
 
-            for i, (mean, cov) in enumerate(zip(multi_mean, multi_covariance)):
-                mean = R8x8.dot(mean)
-                mean[:2] += t
-                cov = R8x8.dot(cov).dot(R8x8.transpose())
+            multi_mean = np.dot(multi_mean, R8x8.T)
+            multi_mean[:, :2] += t
+            multi_covariance = np.matmul(np.matmul(R8x8, multi_covariance), R8x8.T)
 
+            for i, (mean, cov) in enumerate(zip(multi_mean, multi_covariance)):
                 stracks[i].mean = mean
                 stracks[i].covariance = cov
 
@@ -206,7 +224,8 @@ class BoTSORT(object):
 
         self.tracked_stracks = []  # type: list[STrack]
         self.lost_stracks = []  # type: list[STrack]
-        self.removed_stracks = []  # type: list[STrack]
+        self.removed_stracks = RemovedTracks(args.removed_max_count, args.removed_max_age,
+                                             args.removed_spill)  # type: RemovedTracks[STrack]
         BaseTrack.clear_count()
 
         self.frame_id = 0
@@ -229,8 +248,11 @@ class BoTSORT(object):
 
         self.gmc = GMC(method=args.cmc_method, verbose=[args.name, args.ablation])
 
-    def update(self, output_results, img):
-        self.frame_id += 1
+    def update(self, output_results, img, frame_step=1):
+        """`frame_step` is the number of frames elapsed since the previous call, more than
+        one when a real-time source dropped frames, so the Kalman prediction and the lost
+        track ages follow the real time."""
+        self.frame_id += frame_step
         activated_starcks = []
         refind_stracks = []
         lost_stracks = []
@@ -295,7 +317,8 @@ class BoTSORT(object):
         strack_pool = joint_stracks(tracked_stracks, self.lost_stracks)
 
         # Predict the current location with KF
-        STrack.multi_predict(strack_pool)
+        for _ in range(frame_step):
+            STrack.multi_predict(strack_pool)
 
         # Fix camera motion
         warp = self.gmc.apply(img, dets)
@@ -329,15 +352,18 @@ class BoTSORT(object):
 
         matches, u_track, u_detection = matching.linear_assignment(dists, thresh=self.args.match_thresh)
 
+        matched_tracks, matched_dets = [], []
         for itracked, idet in matches:
             track = strack_pool[itracked]
             det = detections[idet]
             if track.state == TrackState.Tracked:
-                track.update(detections[idet], self.frame_id)
-                activated_starcks.append(track)
+                matched_tracks.append(track)
+                matched_dets.append(det)
             else:
                 track.re_activate(det, self.frame_id, new_id=False)
                 refind_stracks.append(track)
+        STrack.multi_update(matched_tracks, matched_dets, self.frame_id)
+        activated_starcks.extend(matched_tracks)
         ''' Step 3: Second association, with low score detection boxes'''
         if len(scores):
             inds_high = scores < self.args.track_high_thresh
@@ -361,15 +387,18 @@ class BoTSORT(object):
         r_tracked_stracks = [strack_pool[i] for i in u_track if strack_pool[i].state == TrackState.Tracked]
         dists = matching.iou_distance(r_tracked_stracks, detections_second)
         matches, u_track, u_detection_second = matching.linear_assignment(dists, thresh=0.5)
+        matched_tracks, matched_dets = [], []
         for itracked, idet in matches:
             track = r_tracked_stracks[itracked]
             det = detections_second[idet]
             if track.state == TrackState.Tracked:
-                track.update(det, self.frame_id)
-                activated_starcks.append(track)
+                matched_tracks.append(track)
+                matched_dets.append(det)
             else:
                 track.re_activate(det, self.frame_id, new_id=False)
                 refind_stracks.append(track)
+        STrack.multi_update(matched_tracks, matched_dets, self.frame_id)
+        activated_starcks.extend(matched_tracks)
 
         for it in u_track:
             track = r_tracked_stracks[it]
@@ -393,9 +422,9 @@ class BoTSORT(object):
             dists = ious_dists
 
         matches, u_unconfirmed, u_detection = matching.linear_assignment(dists, thresh=0.7)
-        for itracked, idet in matches:
-            unconfirmed[itracked].update(detections[idet], self.frame_id)
-            activated_starcks.append(unconfirmed[itracked])
+        matched_tracks = [unconfirmed[itracked] for itracked, _ in matches]
+        STrack.multi_update(matched_tracks, [detections[idet] for _, idet in matches], self.frame_id)
+        activated_starcks.extend(matched_tracks)
         for it in u_unconfirmed:
             track = unconfirmed[it]
             track.mark_removed()
@@ -410,7 +439,8 @@ class BoTSORT(object):
             activated_starcks.append(track)
         """ Step 5: Update state"""
         for track in self.lost_stracks:
-            if self.frame_id - track.end_frame > self.max_time_lost:
+            # a track removed on the previous frame is still in the lost list for one frame
+            if self.frame_id - track.end_frame > self.max_time_lost and track.state != TrackState.Removed:
                 track.mark_removed()
                 removed_stracks.append(track)
         """ Merge """
@@ -420,7 +450,7 @@ class BoTSORT(object):
         self.lost_stracks = sub_stracks(self.lost_stracks, self.tracked_stracks)
         self.lost_stracks.extend(lost_stracks)
         self.lost_stracks = sub_stracks(self.lost_stracks, self.removed_stracks)
-        self.removed_stracks.extend(removed_stracks)
+        self.removed_stracks.extend(removed_stracks, self.frame_id)
         self.tracked_stracks, self.lost_stracks = remove_duplicate_stracks(self.tracked_stracks, self.lost_stracks)
 
         # output_stracks = [track for track in self.tracked_stracks if track.is_activated]
@@ -428,6 +458,9 @@ class BoTSORT(object):
 
         return output_stracks
 
+    def close(self):
+        self.removed_stracks.close()
+
 
 def joint_stracks(tlista, tlistb):
     exists = {}
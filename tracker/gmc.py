@@ -12,15 +12,8 @@ class GMC:
         self.method = method
         self.downscale = max(1, int(downscale))
 
-        if self.method == 'orb':
-            self.detector = cv2.FastFeatureDetector_create(20)
-            self.extractor = cv2.ORB_create()
-            self.matcher = cv2.BFMatcher(cv2.NORM_HAMMING)
-
-        elif self.method == 'sift':
-            self.detector = cv2.SIFT_create(nOctaveLayers=3, contrastThreshold=0.02, edgeThreshold=20)
-            self.extractor = cv2.SIFT_create(nOctaveLayers=3, contrastThreshold=0.02, edgeThreshold=20)
-            self.matcher = cv2.BFMatcher(cv2.NORM_L2)
+        if self.method == 'orb' or self.method == 'sift':
+            self.createDetectors()
 
         elif self.method == 'ecc':
             number_of_iterations = 5000
@@ -63,6 +56,39 @@ class GMC:
 
         self.initializedFirstFrame = False
 
+    def createDetectors(self):
+        if self.method == 'orb':
+            self.detector = cv2.FastFeatureDetector_create(20)
+            self.extractor = cv2.ORB_create()
+            self.matcher = cv2.BFMatcher(cv2.NORM_HAMMING)
+        else:
+            self.detector = cv2.SIFT_create(nOctaveLayers=3, contrastThreshold=0.02, edgeThreshold=20)
+            self.extractor = cv2.SIFT_create(nOctaveLayers=3, contrastThreshold=0.02, edgeThreshold=20)
+            self.matcher = cv2.BFMatcher(cv2.NORM_L2)
+
+    def __getstate__(self):
+        # OpenCV detectors and key points do not pickle, they are created again on load
+        state = self.__dict__.copy()
+        for name in ('detector', 'extractor', 'matcher'):
+            state.pop(name, None)
+        if 'gmcFile' in state:
+            state['gmcFile'] = (self.gmcFile.name, self.gmcFile.tell())
+        if self.method in ('orb', 'sift') and self.prevKeyPoints is not None:
+            state['prevKeyPoints'] = [(kp.pt[0], kp.pt[1], kp.size, kp.angle, kp.response, kp.octave, kp.class_id)
+                                      for kp in self.prevKeyPoints]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.method in ('orb', 'sift'):
+            self.createDetectors()
+            if self.prevKeyPoints is not None:
+                self.prevKeyPoints = [cv2.KeyPoint(*kp) for kp in self.prevKeyPoints]
+        if 'gmcFile' in state:
+            name, position = state['gmcFile']
+            self.gmcFile = open(name, 'r')
+            self.gmcFile.seek(position)
+
     def apply(self, raw_frame, detections=None):
         if self.method == 'orb' or self.method == 'sift':
             return self.applyFeaures(raw_frame, detections)
@@ -85,6 +85,25 @@ class KalmanFilter(object):
         covariance = np.diag(np.square(std))
         return mean, covariance
 
+    def multi_initiate(self, measurement):
+        """Create tracks from unassociated measurements (Vectorized version).
+        Parameters
+        ----------
+        measurement : ndarray
+            The Nx4 dimensional matrix of bounding box coordinates (x, y, w, h).
+        Returns
+        -------
+        (ndarray, ndarray)
+            Returns the Nx8 mean matrix and Nx8x8 covariance matrices of the new
+            tracks. Unobserved velocities are initialized to 0 mean.
+        """
+        mean = np.c_[measurement, np.zeros_like(measurement)]
+        std = np.c_[2 * self._std_weight_position * measurement[:, [2, 3, 2, 3]],
+                    10 * self._std_weight_velocity * measurement[:, [2, 3, 2, 3]]]
+        covariance = np.zeros((len(measurement), 8, 8))
+        covariance[:, np.arange(8), np.arange(8)] = np.square(std)
+        return mean, covariance
+
     def predict(self, mean, covariance):
         """Run Kalman filter prediction step.
 
@@ -179,17 +198,34 @@ class KalmanFilter(object):
             self._std_weight_velocity * mean[:, 3]]
         sqr = np.square(np.r_[std_pos, std_vel]).T
 
-        motion_cov = []
-        for i in range(len(mean)):
-            motion_cov.append(np.diag(sqr[i]))
-        motion_cov = np.asarray(motion_cov)
+        motion_cov = np.zeros((len(mean), 8, 8))
+        motion_cov[:, np.arange(8), np.arange(8)] = sqr
 
         mean = np.dot(mean, self._motion_mat.T)
-        left = np.dot(self._motion_mat, covariance).transpose((1, 0, 2))
-        covariance = np.dot(left, self._motion_mat.T) + motion_cov
+        covariance = np.matmul(np.matmul(self._motion_mat, covariance), self._motion_mat.T) + motion_cov
 
         return mean, covariance
 
+    def multi_project(self, mean, covariance):
+        """Project state distributions to measurement space (Vectorized version).
+        Parameters
+        ----------
+        mean : ndarray
+            The Nx8 dimensional mean matrix of the object states.
+        covariance : ndarray
+            The Nx8x8 dimensional covariance matrices of the object states.
+        Returns
+        -------
+        (ndarray, ndarray)
+            Returns the Nx4 projected means and Nx4x4 projected covariance
+            matrices of the given state estimates.
+        """
+        std = self._std_weight_position * mean[:, [2, 3, 2, 3]]
+        # the observation matrix only selects the first four state components
+        projected_cov = covariance[:, :4, :4].copy()
+        projected_cov[:, np.arange(4), np.arange(4)] += np.square(std)
+        return mean[:, :4], projected_cov
+
     def update(self, mean, covariance, measurement):
         """Run Kalman filter correction step.
 
@@ -224,6 +260,34 @@ class KalmanFilter(object):
             kalman_gain, projected_cov, kalman_gain.T))
         return new_mean, new_covariance
 
+    def multi_update(self, mean, covariance, measurement):
+        """Run Kalman filter correction step (Vectorized version).
+        Parameters
+        ----------
+        mean : ndarray
+            The Nx8 dimensional mean matrix of the predicted states.
+        covariance : ndarray
+            The Nx8x8 dimensional covariance matrices of the predicted states.
+        measurement : ndarray
+            The Nx4 dimensional measurement matrix, one (x, y, w, h) row per
+            state.
+        Returns
+        -------
+        (ndarray, ndarray)
+            Returns the measurement-corrected state distributions.
+        """
+        projected_mean, projected_cov = self.multi_project(mean, covariance)
+
+        # K = P H^T S^-1, all N 4x4 systems are solved in one call (S is symmetric)
+        cov_ht = covariance[:, :, :4]
+        kalman_gain = np.linalg.solve(projected_cov, cov_ht.transpose((0, 2, 1))).transpose((0, 2, 1))
+        innovation = measurement - projected_mean
+
+        new_mean = mean + np.einsum('nij,nj->ni', kalman_gain, innovation)
+        new_covariance = covariance - np.matmul(np.matmul(kalman_gain, projected_cov),
+                                                kalman_gain.transpose((0, 2, 1)))
+        return new_mean, new_covariance
+
     def gating_distance(self, mean, covariance, measurements,
                         only_position=False, metric='maha'):
         """Compute gating distance between state distribution and measurements.
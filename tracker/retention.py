@@ -0,0 +1,96 @@
+import csv
+import os
+from collections import deque
+
+
+class RemovedTrack(object):
+    """Final state of a removed track, detached from the tracker that produced it."""
+
+    __slots__ = ("track_id", "start_frame", "end_frame", "score", "mean")
+
+    def __init__(self, track_id, start_frame, end_frame, score, mean):
+        self.track_id = track_id
+        self.start_frame = start_frame
+        self.end_frame = end_frame
+        self.score = score
+        self.mean = mean
+
+    def __repr__(self):
+        return 'OT_{}_({}-{})'.format(self.track_id, self.start_frame, self.end_frame)
+
+
+class RemovedTracks(object):
+    """Bounded history of removed tracks.
+
+    Tracks are kept in removal order and dropped once there are more than
+    `max_count` of them or once they were removed more than `max_age` frames ago
+    (None disables a limit). Tracks removed in the current frame are always kept,
+    the tracker still needs them on the next frame. Dropped tracks are appended to
+    the `spill_path` csv file when one is given, so nothing is lost for an audit.
+    """
+
+    SPILL_HEADER = ["track id", "start frame", "end frame", "removed frame", "score", "x", "y", "w", "h", "vx", "vy",
+                    "vw", "vh"]
+
+    def __init__(self, max_count=None, max_age=None, spill_path=None):
+        self.max_count = max_count
+        self.max_age = max_age
+        self.tracks = deque()  # (removed frame, track)
+        self.spill_path = spill_path
+        self.spill_file = None
+        self.spill_writer = None
+        if spill_path:
+            new_file = not os.path.exists(spill_path) or os.path.getsize(spill_path) == 0
+            self.spill_file = open(spill_path, 'a', newline='')
+            self.spill_writer = csv.writer(self.spill_file)
+            if new_file:
+                self.spill_writer.writerow(self.SPILL_HEADER)
+
+    def __getstate__(self):
+        # a checkpoint keeps how far the spill file was written, loading it cuts off what came later
+        state = self.__dict__.copy()
+        state['spill_file'] = state['spill_writer'] = None
+        if self.spill_file is not None:
+            self.spill_file.flush()
+            state['spill_file'] = self.spill_file.tell()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if state['spill_file'] is not None:
+            self.spill_file = open(self.spill_path, 'a', newline='')
+            self.spill_file.truncate(state['spill_file'])
+            self.spill_writer = csv.writer(self.spill_file)
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def __iter__(self):
+        return (track for _, track in self.tracks)
+
+    def extend(self, tracks, frame_id):
+        self.tracks.extend((frame_id, track) for track in tracks)
+        self.prune(frame_id)
+
+    def prune(self, frame_id):
+        tracks = self.tracks
+        while tracks and tracks[0][0] < frame_id:
+            too_many = self.max_count is not None and len(tracks) > self.max_count
+            too_old = self.max_age is not None and frame_id - tracks[0][0] > self.max_age
+            if not (too_many or too_old):
+                break
+            self.spill(*tracks.popleft())
+
+    def spill(self, removed_frame, track):
+        if self.spill_writer is None:
+            return
+        self.spill_writer.writerow([track.track_id, track.start_frame, track.end_frame, removed_frame,
+                                    f"{track.score:.2f}"] + [f"{value:.2f}" for value in track.mean])
+
+    def close(self):
+        """Spills the tracks still kept and closes the spill file."""
+        if self.spill_file is not None:
+            while self.tracks:
+                self.spill(*self.tracks.popleft())
+            self.spill_file.close()
+            self.spill_file = self.spill_writer = None
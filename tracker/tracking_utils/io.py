@@ -1,7 +1,14 @@
 import os
+import glob
+import queue
+import threading
 from typing import Dict
 import numpy as np
 
+# one row per track and frame, the columns of the MOT text format
+RESULT_DTYPE = np.dtype([('frame', np.int64), ('id', np.int64), ('x1', np.float64), ('y1', np.float64),
+                         ('w', np.float64), ('h', np.float64), ('score', np.float64)])
+
 
 def write_results(filename, results_dict: Dict, data_type: str):
     if not filename:
@@ -30,6 +37,130 @@ def write_results(filename, results_dict: Dict, data_type: str):
                 f.write(line)
 
 
+class ResultWriter(object):
+    """Streams tracking results to a MOT text file from a background thread.
+
+    `add` collects the rows of one frame and hands them to the writer thread in
+    batches of `batch_size` rows through a bounded queue, so memory does not grow
+    with the length of the run and a slow disk blocks the caller instead of piling
+    up rows. Rows use the MOT layout of `write_results`, with the track score.
+
+    With `npy_dir` the rows are also saved as `RESULT_DTYPE` chunks of `chunk_size`
+    rows (results_00000.npy, ...) that `read_npy_results` loads back in one go.
+
+    `sync` waits until everything added is written and returns where the output
+    stands, a writer created with that as `resume` truncates the output back to it
+    and goes on from there.
+    """
+
+    def __init__(self, filename, npy_dir=None, batch_size=1024, chunk_size=65536, maxsize=16, resume=None):
+        path = os.path.dirname(filename)
+        if path:
+            os.makedirs(path, exist_ok=True)
+        if npy_dir:
+            os.makedirs(npy_dir, exist_ok=True)
+        self.npy_dir = npy_dir
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.pending = []
+        self.pending_rows = 0
+        self.error = None
+        self.chunk = []
+        self.chunk_rows = 0
+        self.chunk_index = 0
+        if resume is None:
+            self.file = open(filename, 'w')
+        else:
+            self.file = open(filename, 'a')
+            self.file.truncate(resume["offset"])
+            self.chunk_index = resume["chunk_index"]
+            if len(resume["chunk"]):
+                self.chunk, self.chunk_rows = [resume["chunk"]], len(resume["chunk"])
+            if npy_dir:
+                for name in glob.glob(os.path.join(npy_dir, "results_*.npy")):
+                    if int(os.path.basename(name)[8:-4]) >= self.chunk_index:
+                        os.remove(name)
+        self.queue = queue.Queue(maxsize)
+        self.thread = threading.Thread(target=self.worker, name="result writer", daemon=True)
+        self.thread.start()
+
+    def add(self, frame_id, tlwhs, ids, scores):
+        if self.error is not None:
+            raise self.error
+        if not len(ids):
+            return
+        rows = np.empty(len(ids), dtype=RESULT_DTYPE)
+        rows['frame'] = frame_id
+        rows['id'] = ids
+        tlwhs = np.asarray(tlwhs, dtype=np.float64).reshape(-1, 4)
+        rows['x1'], rows['y1'], rows['w'], rows['h'] = tlwhs.T
+        rows['score'] = scores
+        self.pending.append(rows)
+        self.pending_rows += len(rows)
+        if self.pending_rows >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.queue.put(np.concatenate(self.pending))
+            self.pending = []
+            self.pending_rows = 0
+
+    def sync(self):
+        """Writes out every row added so far, returns the state a writer resumes from."""
+        self.flush()
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        chunk = np.concatenate(self.chunk) if self.chunk else np.empty(0, dtype=RESULT_DTYPE)
+        return {"offset": self.file.tell(), "chunk_index": self.chunk_index, "chunk": chunk}
+
+    def worker(self):
+        while True:
+            rows = self.queue.get()
+            if rows is None:
+                self.queue.task_done()
+                break
+            if self.error is not None:
+                self.queue.task_done()
+                continue  # keep draining so that add and close never block
+            try:
+                self.file.write("".join(f"{frame},{tid},{x1:.2f},{y1:.2f},{w:.2f},{h:.2f},{score:.2f},-1,-1,-1\n"
+                                        for frame, tid, x1, y1, w, h, score in rows.tolist()))
+                if self.npy_dir:
+                    self.chunk.append(rows)
+                    self.chunk_rows += len(rows)
+                    if self.chunk_rows >= self.chunk_size:
+                        self.save_chunk(self.chunk, self.chunk_index)
+                        self.chunk, self.chunk_rows, self.chunk_index = [], 0, self.chunk_index + 1
+            except Exception as e:
+                self.error = e
+            self.queue.task_done()
+        if self.npy_dir and self.chunk and self.error is None:
+            self.save_chunk(self.chunk, self.chunk_index)
+
+    def save_chunk(self, chunk, index):
+        np.save(os.path.join(self.npy_dir, f"results_{index:05d}.npy"), np.concatenate(chunk))
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+        if self.error is not None:
+            raise self.error
+
+
+def read_npy_results(npy_dir):
+    """All rows saved by a ResultWriter as one RESULT_DTYPE array."""
+    chunks = [np.load(name) for name in sorted(glob.glob(os.path.join(npy_dir, "results_*.npy")))]
+    if not chunks:
+        return np.empty(0, dtype=RESULT_DTYPE)
+    return np.concatenate(chunks)
+
+
 def read_results(filename, data_type: str, is_gt=False, is_ignore=False):
     if data_type in ('mot', 'lab'):
         read_fun = read_mot_results
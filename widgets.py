@@ -0,0 +1,45 @@
+from PyQt5.QtWidgets import QLabel
+from PyQt5.QtCore import QRect
+from PyQt5.QtGui import QPainter, QPolygon
+
+
+class MyLabel(QLabel):
+
+    def __init__(self, parent=None):
+        super(MyLabel, self).__init__(parent)
+        self.add_camera_event = False
+        self.rect_list = []
+        self.pen_list = []
+        self.new_rect = None
+
+    def addRect(self, x0, y0, w, h, pen):
+        self.pen_list.append(pen)
+        self.new_rect = QRect(x0, y0, w, h)
+        self.rect_list.append(self.new_rect)
+        self.update()
+
+        return [x0, y0, w, h, pen]
+
+    def addPolygon(self, points, pen):
+        self.pen_list.append(pen)
+        self.new_rect = QPolygon(points)
+        self.rect_list.append(self.new_rect)
+        self.update()
+
+        return [self.new_rect, pen]
+
+    def removeItem(self, item):
+        self.rect_list.pop()
+        self.pen_list.pop()
+        self.update()
+
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        if self.add_camera_event and len(self.rect_list) > 0:
+            painter = QPainter(self)
+            for index in range(len(self.rect_list)):
+                painter.setPen(self.pen_list[index])
+                if isinstance(self.rect_list[index], QPolygon):
+                    painter.drawPolygon(self.rect_list[index])
+                else:
+                    painter.drawRect(self.rect_list[index])
@@ -0,0 +1,167 @@
+import cv2
+import numpy as np
+
+VIEW_WIDTH = 796  # size of the GUI view the areas are drawn in
+VIEW_HEIGHT = 597
+
+
+def zone_spec(value):
+    """Json friendly shape of an area dict value.
+
+    A value is either [x, y, w, h, ...] for a rectangle, {"polygon": [[x, y], ...]} or
+    {"mask": image path} for a shaped zone, or [shape, ...] for a shaped zone drawn in the
+    GUI, which keeps its graphics item after the shape. Rectangles and polygons are in the
+    GUI view coordinates, a mask is an image of the video, nonzero inside the zone.
+    """
+    if isinstance(value, dict):
+        spec = value
+    elif len(value) and isinstance(value[0], dict):
+        spec = value[0]
+    else:
+        return [float(v) for v in value[:4]]
+    if "polygon" in spec:
+        return {"polygon": [[float(x), float(y)] for x, y in spec["polygon"]]}
+    if "mask" in spec:
+        return {"mask": spec["mask"]}
+    raise ValueError(f"Error: unknown zone {spec}, expected a rectangle, a polygon or a mask")
+
+
+def view_to_video(points, width, height):
+    """Maps (x, y) points of the GUI view to video pixels, the view shows the video letterboxed at 4:3."""
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if width / height > VIEW_WIDTH / VIEW_HEIGHT:
+        view_width, view_height = width, width * 3 / 4
+    else:
+        view_width, view_height = height * 4 / 3, height
+    scale = np.array([view_width / VIEW_WIDTH, view_height / VIEW_HEIGHT])
+    offset = np.array([(view_width - width) / 2, (view_height - height) / 2])
+    return points * scale - offset
+
+
+class ZoneRaster(object):
+    """Shaped zones rasterized once at video resolution.
+
+    `labels` holds the index of the zone of every pixel, -1 outside all zones, where
+    zones overlap the first one keeps the pixel. Every zone gets an integral image of
+    its pixels over its bounding box, so the overlap of a box with a zone is four
+    lookups whatever the shape of the zone.
+    """
+
+    def __init__(self, specs, width, height):
+        self.width = int(width)
+        self.height = int(height)
+        self.labels = np.full((self.height, self.width), -1, dtype=np.int16)
+        bounds = []  # x0, y0, x1, y1 of every zone in pixels
+        integrals = []
+        for index, spec in enumerate(specs):
+            mask, (x0, y0) = self.rasterize(spec)
+            ys, xs = np.nonzero(mask)
+            if not len(xs):
+                print(f'Warning: zone {index + 1} has no pixel inside the video')
+                bounds.append((0, 0, 0, 0))
+                integrals.append(np.zeros((1, 1), dtype=np.int32))
+                continue
+            x0, y0, x1, y1 = x0 + xs.min(), y0 + ys.min(), x0 + xs.max() + 1, y0 + ys.max() + 1
+            mask = mask[ys.min():ys.max() + 1, xs.min():xs.max() + 1]
+            labels = self.labels[y0:y1, x0:x1]
+            labels[(labels < 0) & mask] = index
+            bounds.append((x0, y0, x1, y1))
+            integrals.append(cv2.integral((labels == index).view(np.uint8)))
+
+        # all integral images in one buffer, a zone's (row, col) entry is at offset + row * stride + col
+        self.bounds = np.asarray(bounds, dtype=np.int64).reshape(-1, 4)
+        self.strides = self.bounds[:, 2] - self.bounds[:, 0] + 1
+        self.offsets = np.cumsum([0] + [integral.size for integral in integrals[:-1]], dtype=np.int64)
+        self.integral = np.concatenate([integral.ravel() for integral in integrals]) if integrals else np.zeros(0)
+
+    def rasterize(self, spec):
+        """Mask of a zone and the pixel of its top left corner."""
+        if "polygon" in spec:
+            points = view_to_video(spec["polygon"], self.width, self.height)
+            x0, y0 = np.clip(np.floor(points.min(axis=0)).astype(int), 0, [self.width, self.height])
+            x1, y1 = np.clip(np.ceil(points.max(axis=0)).astype(int) + 1, 0, [self.width, self.height])
+            mask = np.zeros((max(y1 - y0, 0), max(x1 - x0, 0)), dtype=np.uint8)
+            if mask.size:
+                # 4 fractional bits, pixel centres are at integer coordinates for fillPoly
+                polygon = np.round((points - (x0 + 0.5, y0 + 0.5)) * 16).astype(np.int32)
+                cv2.fillPoly(mask, [polygon], 1, lineType=cv2.LINE_8, shift=4)
+            return mask.astype(bool), (x0, y0)
+        mask = cv2.imread(spec["mask"], cv2.IMREAD_GRAYSCALE)
+        if mask is None:
+            raise ValueError(f"Error: cannot read the zone mask {spec['mask']}")
+        if mask.shape != (self.height, self.width):
+            mask = cv2.resize(mask, (self.width, self.height), interpolation=cv2.INTER_NEAREST)
+        return mask > 0, (0, 0)
+
+    def overlap(self, tlwhs, zones=None):
+        """Pixels of every zone inside every box, (boxes, zones), or of zones[i] inside box i."""
+        tlwhs = np.asarray(tlwhs, dtype=np.float64).reshape(-1, 4)
+        if zones is None:
+            tlwhs = tlwhs[:, None, :]
+            zones = slice(None)
+        # np.rint rounds as np.round, and minimum(maximum()) clips as np.clip, at a fraction of their call overhead
+        x0 = np.rint(tlwhs[..., 0]).astype(np.int64)
+        y0 = np.rint(tlwhs[..., 1]).astype(np.int64)
+        x1 = np.rint(tlwhs[..., 0] + tlwhs[..., 2]).astype(np.int64)
+        y1 = np.rint(tlwhs[..., 1] + tlwhs[..., 3]).astype(np.int64)
+        bx0, by0, bx1, by1 = self.bounds[zones].T
+        strides, offsets = self.strides[zones], self.offsets[zones]
+        width, height = bx1 - bx0, by1 - by0
+        left = np.minimum(np.maximum(x0 - bx0, 0), width)
+        right = np.minimum(np.maximum(x1 - bx0, 0), width)
+        top = np.minimum(np.maximum(y0 - by0, 0), height) * strides + offsets
+        bottom = np.minimum(np.maximum(y1 - by0, 0), height) * strides + offsets
+        integral = self.integral
+        return (integral[bottom + right] - integral[top + right] - integral[bottom + left] +
+                integral[top + left]).astype(np.float64)
+
+
+class ZoneGrid(object):
+    """Uniform grid over the video listing the zones whose bounding box reaches every cell.
+
+    A box can only overlap the zones listed in the cells it reaches, so with hundreds of
+    small zones a box is tested against a handful of them instead of all. Cells are about
+    the size of the median zone.
+    """
+
+    def __init__(self, bounds, width, height):
+        bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)  # x0, y0, x1, y1
+        sizes = bounds[:, 2:] - bounds[:, :2]
+        self.cell_width, self.cell_height = np.maximum(np.median(sizes, axis=0), 8) if len(bounds) else (width, height)
+        self.cols = int(np.ceil(width / self.cell_width))
+        self.rows = int(np.ceil(height / self.cell_height))
+
+        cx0, cy0, cx1, cy1 = self.cells(bounds)
+        ncx, ncy = cx1 - cx0 + 1, cy1 - cy0 + 1
+        zones = np.repeat(np.arange(len(bounds)), ncx * ncy)
+        cells = self.expand(cx0, cy0, ncx, ncy)
+        order = np.argsort(cells, kind='stable')
+        # zones of cell c are cell_zones[cell_start[c]:cell_start[c] + cell_count[c]], by index
+        self.cell_zones = zones[order]
+        self.cell_count = np.bincount(cells, minlength=self.rows * self.cols)
+        self.cell_start = np.cumsum(self.cell_count) - self.cell_count
+
+    def cells(self, bounds):
+        """First and last column and row of the cells every (x0, y0, x1, y1) reaches, clipped to the grid."""
+        cells = np.floor(bounds / (self.cell_width, self.cell_height, self.cell_width, self.cell_height))
+        cells = np.minimum(np.maximum(cells, 0), (self.cols - 1, self.rows - 1, self.cols - 1, self.rows - 1))
+        cx0, cy0, cx1, cy1 = cells.astype(np.int64).T
+        return cx0, cy0, cx1, cy1
+
+    def expand(self, cx0, cy0, ncx, ncy):
+        """Cell indices of every block of ncx x ncy cells, block after block."""
+        counts = ncx * ncy
+        block = np.repeat(np.arange(len(counts)), counts)
+        k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return (cy0[block] + k // ncx[block]) * self.cols + cx0[block] + k % ncx[block]
+
+    def pairs(self, tlwhs):
+        """(box, zone) pairs of every box with the zones it can overlap, a zone may come more than once."""
+        tlwhs = np.asarray(tlwhs, dtype=np.float64).reshape(-1, 4)
+        cx0, cy0, cx1, cy1 = self.cells(np.concatenate([tlwhs[:, :2], tlwhs[:, :2] + tlwhs[:, 2:]], axis=1))
+        ncx, ncy = cx1 - cx0 + 1, cy1 - cy0 + 1
+        boxes = np.repeat(np.arange(len(tlwhs)), ncx * ncy)
+        cells = self.expand(cx0, cy0, ncx, ncy)
+        counts = self.cell_count[cells]
+        k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return np.repeat(boxes, counts), self.cell_zones[np.repeat(self.cell_start[cells], counts) + k]